@@ -0,0 +1,47 @@
+"""
+对比每次请求新建连接 (requests.post) 与 Chat 连接池复用的单次请求延迟。
+用法: python benchmarks/bench_chat_session.py [请求次数]
+"""
+import os
+import statistics
+import sys
+import time
+
+import requests
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from dependencies.chat import Chat
+from benchmarks.mock_services import MockChatServer
+
+
+def measure(send, n):
+    latencies = []
+    for _ in range(n):
+        start = time.perf_counter()
+        send()
+        latencies.append((time.perf_counter() - start) * 1000)
+    latencies.sort()
+    return statistics.mean(latencies), latencies[len(latencies) // 2], latencies[int(len(latencies) * 0.95) - 1]
+
+
+def main(n=500):
+    with MockChatServer() as server:
+        chat = Chat(api_key="test", model="mock-model", baseurl=server.url, pool_size=1)
+        headers = {"Authorization": "Bearer test", "Content-Type": "application/json"}
+        data = {"model": "mock-model", "stream": False, "messages": [{"role": "user", "content": "ping"}],
+                "temperature": 0.7, "top_p": 1}
+
+        results = {
+            "no reuse (requests.post)": measure(lambda: requests.post(server.url, headers=headers, json=data).json(), n),
+            "pooled (Chat.session)": measure(lambda: chat("ping"), n),
+        }
+        chat.close()
+
+    print(f"{n} requests against {server.url}")
+    for name, (mean, p50, p95) in results.items():
+        print(f"{name:<28} mean {mean:6.2f} ms   p50 {p50:6.2f} ms   p95 {p95:6.2f} ms")
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 500)
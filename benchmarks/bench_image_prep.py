@@ -0,0 +1,46 @@
+"""
+对比不同图像预处理设置 (分辨率、颜色模式、编码格式和质量) 下每页的字节数和预处理+编码耗时。
+用法: python benchmarks/bench_image_prep.py [PDF 路径]
+"""
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from dependencies.pdfpreprocesser import iter_page_images, prepare_image, encode_image
+
+# (名称, 渲染 DPI, 长边上限, 颜色模式, 编码格式, 质量)
+SETTINGS = [
+    ("baseline PNG RGB", 200, None, None, 'PNG', None),
+    ("PNG gray", 200, None, 'L', 'PNG', None),
+    ("JPEG q85 RGB", 200, None, None, 'JPEG', 85),
+    ("JPEG q85 gray", 200, None, 'L', 'JPEG', 85),
+    ("JPEG q70 gray", 200, None, 'L', 'JPEG', 70),
+    ("WEBP q80 gray", 200, None, 'L', 'WEBP', 80),
+    ("PNG 1-bit", 200, None, '1', 'PNG', None),
+    ("JPEG q85 gray 150dpi", 150, None, 'L', 'JPEG', 85),
+    ("JPEG q85 gray edge 1568", 200, 1568, 'L', 'JPEG', 85),
+    ("PNG 1-bit edge 1568", 200, 1568, '1', 'PNG', None),
+]
+
+
+def main(pdf_path):
+    pages = {}
+    print(f"{'setting':<26} {'KB/page':>9} {'ms/page':>9} {'size':>12}")
+    for name, dpi, max_long_edge, color_mode, image_format, quality in SETTINGS:
+        if dpi not in pages:
+            pages[dpi] = [image for _, image in iter_page_images(pdf_path, dpi=dpi)]
+        total_bytes, total_seconds = 0, 0.0
+        for image in pages[dpi]:
+            start = time.perf_counter()
+            data, _ = encode_image(prepare_image(image, max_long_edge, color_mode), image_format, quality)
+            total_seconds += time.perf_counter() - start
+            total_bytes += len(data)
+        n = len(pages[dpi])
+        size = prepare_image(pages[dpi][0], max_long_edge).size
+        print(f"{name:<26} {total_bytes / n / 1024:9.1f} {total_seconds / n * 1000:9.2f} {f'{size[0]}x{size[1]}':>12}")
+
+
+if __name__ == "__main__":
+    main(sys.argv[1] if len(sys.argv) > 1 else "test.pdf")
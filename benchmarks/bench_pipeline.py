@@ -0,0 +1,230 @@
+"""
+离线的端到端压测: 用本地模拟的 OpenAI 兼容接口和对象存储运行 OCR 与翻译流水线, 不产生任何 API 费用。
+每个场景在独立的子进程中运行, 记录 pages/min (OCR)、chunks/min (翻译)、峰值内存和各阶段耗时, 结果写入 JSON。
+用法: python benchmarks/bench_pipeline.py [--scenario 名称 ...] [--output bench_pipeline.json]
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import fitz  # PyMuPDF
+
+import mainOCR
+import translator
+from benchmarks.mock_services import MockChatServer, MockBucket
+from dependencies.async_chat import AsyncChat_Retry
+from dependencies.chat import Chat_Retry
+from dependencies.metrics import metrics
+from dependencies.ratelimit import ConcurrencyController
+from dependencies.text_translater import Translator, AsyncTranslator, iter_split_file, estimate_text_tokens
+from dependencies.uplaod2 import OSSUploader
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# server: MockChatServer 的参数 (延迟、429 概率、回复长度); bucket: MockBucket 的参数, 仅 image_transport='oss' 时使用
+# options: 传给 OCR 主流程或翻译的参数
+SCENARIOS = [
+    {"name": "ocr_inline", "kind": "ocr",
+     "server": {"latency": 0.3, "response_size": 2500},
+     "options": {"image_transport": "inline", "ocr_max_workers": 8, "images_per_long": 4, "max_pixels": 5_000_000,
+                 "max_output_tokens": 3000, "render_workers": 2, "color_mode": "L", "image_format": "PNG", "text_layer": False}},
+    {"name": "ocr_oss", "kind": "ocr",
+     "server": {"latency": 0.3, "response_size": 2500},
+     "bucket": {"latency": 0.05, "bandwidth": 20 * 1024 * 1024},
+     "options": {"image_transport": "oss", "ocr_max_workers": 8, "images_per_long": 4, "max_pixels": 5_000_000,
+                 "max_output_tokens": 3000, "render_workers": 2, "color_mode": "L", "image_format": "PNG", "text_layer": False}},
+    {"name": "ocr_throttled", "kind": "ocr",
+     "server": {"latency": 0.3, "response_size": 2500, "throttle_rate": 0.2, "retry_after": 0.5},
+     "options": {"image_transport": "inline", "ocr_max_workers": 8, "images_per_long": 4, "max_pixels": 5_000_000,
+                 "max_output_tokens": 3000, "render_workers": 2, "color_mode": "L", "image_format": "PNG", "text_layer": False}},
+    {"name": "ocr_text_layer", "kind": "ocr",
+     "server": {"latency": 0.3, "response_size": 2500},
+     "options": {"image_transport": "inline", "ocr_max_workers": 8, "images_per_long": 4, "max_pixels": 5_000_000,
+                 "max_output_tokens": 3000, "render_workers": 2, "color_mode": "L", "image_format": "PNG", "text_layer": True}},
+    {"name": "ocr_async", "kind": "ocr", "async": True,
+     "server": {"latency": 0.3, "response_size": 2500},
+     "options": {"image_transport": "inline", "max_concurrency": 32, "images_per_long": 4, "max_pixels": 5_000_000,
+                 "max_output_tokens": 3000, "render_workers": 2, "color_mode": "L", "image_format": "PNG", "text_layer": False}},
+    {"name": "translate_batch", "kind": "translate",
+     "server": {"latency": 0.5, "response_size": 8000},
+     "options": {"translation_workers": 4, "polishing_workers": 4}},
+    {"name": "translate_throttled", "kind": "translate",
+     "server": {"latency": 0.5, "response_size": 8000, "throttle_rate": 0.2, "retry_after": 0.5},
+     "options": {"translation_workers": 4, "polishing_workers": 4}},
+    {"name": "translate_async", "kind": "translate", "async": True,
+     "server": {"latency": 0.5, "response_size": 8000},
+     "options": {"max_concurrency": 32}},
+]
+
+
+def peak_rss_mb():
+    """
+    :return: (本进程峰值内存, 已结束子进程中的最大峰值内存), 单位 MB; 无法获取时为 None
+    """
+    try:
+        import resource
+    except ImportError:
+        # Windows 没有 resource 模块, 安装了 psutil 时使用它 (只能获取本进程)
+        try:
+            import psutil
+        except ImportError:
+            return None, None
+        return psutil.Process().memory_info().peak_wset / 1024 / 1024, None
+    # Linux 上 ru_maxrss 的单位是 KB, macOS 上是字节
+    unit = 1 if sys.platform == 'darwin' else 1024
+    return (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * unit / 1024 / 1024,
+            resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * unit / 1024 / 1024)
+
+
+def repeat_pdf(pdf_path, copies, output_path):
+    # test.pdf 只有几页, 重复多份得到足够长的文档, 吞吐量才有意义
+    with fitz.open(pdf_path) as src, fitz.open() as doc:
+        for _ in range(copies):
+            doc.insert_pdf(src)
+        doc.save(output_path)
+    return output_path
+
+
+def run_ocr(scenario, pdf_path, workdir, server):
+    options = dict(scenario["options"])
+    output_txt_path = os.path.join(workdir, "ocr.txt")
+    # 替换 mainOCR 中的模块级上传器, page_group_source 上传时使用的就是它
+    bucket = MockBucket(**scenario.get("bucket", {}))
+    mainOCR.oss_uploader = OSSUploader("bench", "mock-oss", "https://mock-oss", second_folder="pdf_ocr", max_workers=8, bucket=bucket)
+
+    if scenario.get("async"):
+        concurrency = options["max_concurrency"]
+        chat = AsyncChat_Retry(api_key="bench", model="mock-model", baseurl=server.url, max_retries=5, pool_size=concurrency,
+                               concurrency=ConcurrencyController(initial=8, max_concurrency=concurrency), metrics_stage='llm.ocr')
+
+        async def run():
+            try:
+                await mainOCR.async_process_pdf_with_ocr_in_one(pdf_path, output_txt_path, chat, **options)
+            finally:
+                await chat.close()
+        asyncio.run(run())
+    else:
+        workers = options["ocr_max_workers"]
+        chat = Chat_Retry(api_key="bench", model="mock-model", baseurl=server.url, max_retries=5, pool_size=workers,
+                          concurrency=ConcurrencyController(initial=2, max_concurrency=workers), metrics_stage='llm.ocr')
+        mainOCR.process_pdf_with_ocr_in_one(pdf_path, None, output_txt_path, chat, **options)
+        chat.close()
+    return {"uploads": bucket.request_count, "upload_bytes": bucket.bytes_received}
+
+
+def run_translate(scenario, text_path, server):
+    options = scenario["options"]
+    texts = list(iter_split_file(text_path, min_length=translator.CHUNK_MIN_TOKENS, max_length=translator.CHUNK_MAX_TOKENS,
+                                 numbered_headings=True, length_function=estimate_text_tokens))
+    if scenario.get("async"):
+        async_translator = AsyncTranslator("mock-translate", "mock-polish", "bench", server.url, max_retries_translater=translator.MAX_RETRIES,
+                                           max_concurrency=options["max_concurrency"])
+
+        async def run():
+            try:
+                return await async_translator.translate(texts, polish=True, return_exceptions=True)
+            finally:
+                await async_translator.close()
+        results = asyncio.run(run())
+        failed = sum(1 for result in results if isinstance(result, Exception))
+    else:
+        workers = max(options["translation_workers"], options["polishing_workers"])
+        sync_translator = Translator("mock-translate", "mock-polish", "bench", server.url, max_retries_translater=translator.MAX_RETRIES,
+                                     pool_size=workers)
+        _, errors = sync_translator.translate_batch(texts, polish=True, **options)
+        failed = len(errors)
+    metrics.count('chunks', len(texts))
+    return {"failed_chunks": failed}
+
+
+def run_scenario(scenario, pdf_path, text_path):
+    """
+    在当前进程中运行一个场景。
+    :return: 结果 dict (metrics 汇总加上模拟服务的统计和峰值内存)
+    """
+    with tempfile.TemporaryDirectory() as workdir, MockChatServer(**scenario["server"]) as server:
+        metrics.reset()
+        start = time.perf_counter()
+        if scenario["kind"] == "ocr":
+            extra = run_ocr(scenario, pdf_path, workdir, server)
+        else:
+            extra = run_translate(scenario, text_path, server)
+        elapsed = time.perf_counter() - start
+        summary = metrics.summary()
+        rss, children_rss = peak_rss_mb()
+        result = {
+            "name": scenario["name"],
+            "scenario": scenario,
+            "elapsed_s": round(elapsed, 3),
+            "peak_rss_mb": rss and round(rss, 1),
+            "children_peak_rss_mb": children_rss and round(children_rss, 1),
+            "llm_requests": server.server.request_count,
+            "throttled": server.server.throttled_count,
+        }
+        result.update(extra)
+        result.update({key: value for key, value in summary.items() if key not in ("started", "elapsed_s")})
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scenario", action="append", help="只运行指定的场景, 可以重复; 默认运行全部")
+    parser.add_argument("--pdf", default=os.path.join(ROOT, "test.pdf"))
+    parser.add_argument("--pdf-copies", type=int, default=10, help="将 PDF 重复多少份作为 OCR 的输入")
+    parser.add_argument("--text", default=os.path.join(ROOT, "256-287.txt"))
+    parser.add_argument("--output", default="bench_pipeline.json")
+    parser.add_argument("--child", help=argparse.SUPPRESS)     # 子进程模式: 运行单个场景并把结果写入 --output
+    args = parser.parse_args()
+
+    scenarios = {scenario["name"]: scenario for scenario in SCENARIOS}
+    if args.child:
+        result = run_scenario(scenarios[args.child], args.pdf, args.text)
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(result, f, ensure_ascii=False)
+        return
+
+    names = args.scenario or list(scenarios)
+    unknown = [name for name in names if name not in scenarios]
+    if unknown:
+        parser.error(f"unknown scenario(s): {', '.join(unknown)}; available: {', '.join(scenarios)}")
+
+    results = []
+    with tempfile.TemporaryDirectory() as workdir:
+        pdf_path = repeat_pdf(args.pdf, args.pdf_copies, os.path.join(workdir, "bench.pdf"))
+        for name in names:
+            # 每个场景使用独立的进程, 峰值内存互不影响
+            child_output = os.path.join(workdir, f"{name}.json")
+            subprocess.run([sys.executable, os.path.abspath(__file__), "--child", name, "--pdf", pdf_path, "--text", args.text,
+                            "--output", child_output], check=True, stdout=subprocess.DEVNULL)
+            with open(child_output, encoding='utf-8') as f:
+                results.append(json.load(f))
+
+    report = {
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "pdf": os.path.basename(args.pdf),
+        "pdf_copies": args.pdf_copies,
+        "text": os.path.basename(args.text),
+        "results": results,
+    }
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+
+    print(f"{'scenario':<22} {'elapsed s':>10} {'pages/min':>10} {'chunks/min':>11} {'requests':>9} {'429':>5} {'peak MB':>8}")
+    for result in results:
+        print(f"{result['name']:<22} {result['elapsed_s']:>10.2f} {result.get('pages_per_min', '-'):>10} "
+              f"{result.get('chunks_per_min', '-'):>11} {result['llm_requests']:>9} {result['throttled']:>5} {result['peak_rss_mb'] or '-':>8}")
+    print(f"Results written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
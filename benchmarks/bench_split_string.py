@@ -0,0 +1,110 @@
+"""
+在合成的大型 Markdown 文件上对比旧版 split_string 与新版 split_string / iter_split_file 的耗时。
+用法: python benchmarks/bench_split_string.py [文件大小MB]
+"""
+import os
+import random
+import re
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from dependencies.text_translater import split_string, iter_split_file, estimate_text_tokens
+
+
+def legacy_split_string(text, min_length=14000, max_length=18000, numbered_headings=True):
+    # 旧版实现, 保留用于对比
+    if numbered_headings:
+        heading_pattern = re.compile(r'^(#+\s+\d+(\.\d+)*\.?\s+.*)', re.MULTILINE)
+    else:
+        heading_pattern = re.compile(r'^(#+\s+.*)', re.MULTILINE)
+
+    headings = [(m.start(), m.group(1)) for m in heading_pattern.finditer(text)]
+    if not headings:
+        return [text]
+
+    segments = []
+    if headings[0][0] > 0:
+        segments.append(text[:headings[0][0]])
+    for i in range(len(headings)):
+        start_pos = headings[i][0]
+        end_pos = headings[i + 1][0] if i + 1 < len(headings) else len(text)
+        segments.append(text[start_pos:end_pos])
+
+    result = []
+    current_segment = ""
+
+    def add_segment(segment):
+        nonlocal current_segment
+        if len(current_segment) + len(segment) > max_length:
+            result.append(current_segment)
+            current_segment = segment
+        else:
+            current_segment += segment
+
+    for segment in segments:
+        if len(current_segment) + len(segment) < min_length:
+            current_segment += segment
+        else:
+            add_segment(segment)
+
+    if current_segment:
+        result.append(current_segment)
+    return result
+
+
+def make_markdown(size_mb, seed=0):
+    """
+    生成带编号标题、段落和代码块的合成 Markdown 文本。
+    """
+    rng = random.Random(seed)
+    words = "the compiler evaluates each expression operand before the operator is applied to its result".split()
+    target = size_mb * 1024 * 1024
+    parts, size, chapter, section = [], 0, 1, 0
+    while size < target:
+        if rng.random() < 0.05:
+            chapter, section = chapter + 1, 0
+            block = f"# {chapter} Chapter {chapter}\n\n"
+        elif rng.random() < 0.3:
+            section += 1
+            block = f"## {chapter}.{section} Section\n\n"
+        elif rng.random() < 0.1:
+            block = "```cpp\n" + "\n".join(f"int x{i} = {i};" for i in range(rng.randint(3, 30))) + "\n```\n\n"
+        else:
+            block = " ".join(rng.choice(words) for _ in range(rng.randint(40, 200))) + "\n\n"
+        parts.append(block)
+        size += len(block)
+    return "".join(parts)
+
+
+def timed(fn):
+    start = time.perf_counter()
+    result = fn()
+    return time.perf_counter() - start, result
+
+
+def main(size_mb=50):
+    text = make_markdown(size_mb)
+    with tempfile.NamedTemporaryFile('w', suffix='.md', encoding='utf-8', delete=False) as f:
+        f.write(text)
+        path = f.name
+
+    try:
+        print(f"synthetic markdown: {len(text) / 1024 / 1024:.1f} MB")
+        cases = [
+            ("legacy split_string (chars)", lambda: legacy_split_string(text, 8000, 12000)),
+            ("split_string (chars)", lambda: split_string(text, 8000, 12000)),
+            ("iter_split_file (chars)", lambda: list(iter_split_file(path, 8000, 12000))),
+            ("split_string (estimated tokens)", lambda: split_string(text, 2000, 3000, length_function=estimate_text_tokens)),
+        ]
+        for name, fn in cases:
+            seconds, chunks = timed(fn)
+            print(f"{name:<34} {seconds:7.2f} s   {len(chunks):6d} chunks   max chunk {max(len(c) for c in chunks):8d} chars")
+    finally:
+        os.remove(path)
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 50)
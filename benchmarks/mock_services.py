@@ -0,0 +1,398 @@
+"""
+本地模拟服务, 用于在不调用真实 API 和 OSS 的情况下测试和压测。
+"""
+import base64
+import hashlib
+import itertools
+import json
+import random
+import threading
+import time
+from email.parser import BytesParser
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import oss2
+
+
+class _ChatHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"   # 支持 keep-alive
+    disable_nagle_algorithm = True  # 响应头和响应体分两次写出, 不关闭 Nagle 会在 keep-alive 连接上引入约 40ms 的延迟
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        request = json.loads(self.rfile.read(length) or b"{}")
+        self.server.request_count += 1
+        if self.server.latency:
+            time.sleep(self.server.latency)
+
+        if self.server.throttle_rate and random.random() < self.server.throttle_rate:
+            self.server.throttled_count += 1
+            body = b'{"error": {"message": "rate limited", "type": "rate_limit_error"}}'
+            self.send_response(429)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Retry-After', str(self.server.retry_after))
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+
+        content = self.server.response_text
+        if self.server.response_size:
+            # 生成指定长度的回复, 模拟模型输出较长的 Markdown
+            content = (content + "\n") * (self.server.response_size // (len(content) + 1) + 1)
+            content = content[:self.server.response_size]
+        if self.server.echo:
+            # 回显第一条消息中的文本, 便于校验结果顺序 (续写请求的最后一条消息是续写要求)
+            message = request["messages"][0]["content"]
+            content = message if isinstance(message, str) else next(part["text"] for part in message if part["type"] == "text")
+        if request.get("stream"):
+            self._send_stream(request, content)
+            return
+        body = json.dumps({
+            "id": "chatcmpl-mock",
+            "object": "chat.completion",
+            "model": request.get("model"),
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+            # 粗略的 token 数 (约四个字节一个 token), 用于测试用量统计
+            "usage": {"prompt_tokens": length // 4, "completion_tokens": len(content) // 4 + 1},
+        }).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_stream(self, request, content, chunk_size=16):
+        # 续写请求: 只发送 assistant 消息 (已收到的前缀) 之后的部分
+        prefix = next((m["content"] for m in request["messages"] if m["role"] == "assistant"), "")
+        if prefix and content.startswith(prefix):
+            content = content[len(prefix):]
+        # 按概率在发送到一半时断开连接, 模拟流式响应中途中断
+        cut = None
+        if self.server.stream_drop_rate and random.random() < self.server.stream_drop_rate:
+            self.server.dropped_count += 1
+            cut = len(content) // 2
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Connection', 'close')
+        self.end_headers()
+        self.close_connection = True
+
+        def event(payload):
+            self.wfile.write(f"data: {payload}\n\n".encode('utf-8'))
+
+        for offset in range(0, len(content), chunk_size):
+            if cut is not None and offset >= cut:
+                return
+            event(json.dumps({"choices": [{"index": 0, "delta": {"content": content[offset:offset + chunk_size]}, "finish_reason": None}]}))
+        event(json.dumps({"choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}]}))
+        if (request.get("stream_options") or {}).get("include_usage"):
+            usage = {"prompt_tokens": len(json.dumps(request["messages"])) // 4, "completion_tokens": len(content) // 4 + 1}
+            event(json.dumps({"choices": [], "usage": usage}))
+        event("[DONE]")
+
+
+class _Server(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024   # 默认的 listen backlog 只有 5, 高并发压测时会拒绝连接
+
+
+class MockChatServer:
+    def __init__(self, host="127.0.0.1", port=0, response_text="mock response", latency=0.0,
+                 throttle_rate=0.0, retry_after=1, echo=False, response_size=None, stream_drop_rate=0.0):
+        """
+        模拟 OpenAI 兼容的 /v1/chat/completions 接口。
+        :param port: 端口, 0 表示自动分配
+        :param response_text: 每次返回的回复内容
+        :param latency: 每个请求的模拟处理延迟（秒）
+        :param throttle_rate: 以该概率返回 429 限流响应
+        :param retry_after: 429 响应中 Retry-After 头的秒数
+        :param echo: 为 True 时回显请求中的文本, 而不是返回 response_text
+        :param response_size: 设置后将 response_text 重复到该字符数作为回复
+        :param stream_drop_rate: 流式请求 (stream=True) 以该概率在发送到一半时断开连接
+        """
+        self.server = _Server((host, port), _ChatHandler)
+        self.server.request_count = 0
+        self.server.response_text = response_text
+        self.server.latency = latency
+        self.server.throttle_rate = throttle_rate
+        self.server.retry_after = retry_after
+        self.server.throttled_count = 0
+        self.server.echo = echo
+        self.server.response_size = response_size
+        self.server.stream_drop_rate = stream_drop_rate
+        self.server.dropped_count = 0
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}/v1/chat/completions"
+
+    def start(self):
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+class _BatchHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, payload, status=200):
+        body = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _read_body(self):
+        return self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+    def do_POST(self):
+        server = self.server.mock
+        body = self._read_body()
+        if self.path == "/v1/files":
+            # multipart/form-data: 借助 email 解析器取出 file 字段
+            message = BytesParser().parsebytes(f"Content-Type: {self.headers['Content-Type']}\r\n\r\n".encode() + body)
+            data = next(part.get_payload(decode=True) for part in message.get_payload() if part.get_param('name', header='content-disposition') == 'file')
+            self._send_json(server.add_file(data))
+        elif self.path == "/v1/batches":
+            request = json.loads(body)
+            if request["input_file_id"] not in server.files:
+                self._send_json({"error": {"message": "input file not found"}}, 404)
+                return
+            self._send_json(server.create_batch(request))
+        elif self.path.startswith("/v1/batches/") and self.path.endswith("/cancel"):
+            batch = server.batches.get(self.path.split("/")[3])
+            if batch is None:
+                self._send_json({"error": {"message": "batch not found"}}, 404)
+                return
+            batch["status"] = "cancelled"
+            self._send_json(batch)
+        else:
+            self._send_json({"error": {"message": "not found"}}, 404)
+
+    def do_GET(self):
+        server = self.server.mock
+        parts = self.path.split("/")
+        if self.path.startswith("/v1/batches/") and parts[3] in server.batches:
+            self._send_json(server.poll_batch(parts[3]))
+        elif self.path.startswith("/v1/files/") and self.path.endswith("/content") and parts[3] in server.files:
+            data = server.files[parts[3]]
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/octet-stream')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+        else:
+            self._send_json({"error": {"message": "not found"}}, 404)
+
+
+class MockBatchServer:
+    def __init__(self, host="127.0.0.1", port=0, processing_time=0.5, failure_rate=0.0, response_text="mock response", echo=False):
+        """
+        模拟 OpenAI 兼容的批处理接口: /v1/files (上传和下载) 与 /v1/batches (创建、查询、取消)。
+        任务创建 processing_time 秒后在下一次查询时完成, 并生成结果文件和错误文件。
+        :param failure_rate: 每个请求以该概率失败 (写入错误文件)
+        :param response_text: 每个请求的回复内容
+        :param echo: 为 True 时回显请求中第一条消息的文本
+        """
+        self.server = _Server((host, port), _BatchHandler)
+        self.server.mock = self
+        self.processing_time = processing_time
+        self.failure_rate = failure_rate
+        self.response_text = response_text
+        self.echo = echo
+        self.files = {}
+        self.batches = {}
+        self.submitted_requests = 0
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def add_file(self, data):
+        with self._lock:
+            file_id = f"file-{next(self._ids)}"
+            self.files[file_id] = data
+        return {"id": file_id, "object": "file", "bytes": len(data), "purpose": "batch"}
+
+    def create_batch(self, request):
+        lines = [line for line in self.files[request["input_file_id"]].decode('utf-8').splitlines() if line.strip()]
+        with self._lock:
+            batch_id = f"batch_{next(self._ids)}"
+            self.submitted_requests += len(lines)
+            self.batches[batch_id] = {
+                "id": batch_id, "object": "batch", "endpoint": request["endpoint"], "input_file_id": request["input_file_id"],
+                "status": "validating", "created_at": time.time(), "output_file_id": None, "error_file_id": None,
+                "request_counts": {"total": len(lines), "completed": 0, "failed": 0}, "metadata": request.get("metadata"),
+            }
+        return self.batches[batch_id]
+
+    def _reply(self, body):
+        if not self.echo:
+            return self.response_text
+        message = body["messages"][0]["content"]
+        return message if isinstance(message, str) else next(part["text"] for part in message if part["type"] == "text")
+
+    def poll_batch(self, batch_id):
+        batch = self.batches[batch_id]
+        if batch["status"] not in ("validating", "in_progress"):
+            return batch
+        if time.time() - batch["created_at"] < self.processing_time:
+            batch["status"] = "in_progress"
+            return batch
+
+        outputs, errors = [], []
+        for line in self.files[batch["input_file_id"]].decode('utf-8').splitlines():
+            if not line.strip():
+                continue
+            request = json.loads(line)
+            if self.failure_rate and random.random() < self.failure_rate:
+                errors.append({"custom_id": request["custom_id"], "response": {"status_code": 500, "body": {
+                    "error": {"message": "mock server error", "type": "server_error"}}}, "error": None})
+                continue
+            content = self._reply(request["body"])
+            outputs.append({"custom_id": request["custom_id"], "error": None, "response": {"status_code": 200, "body": {
+                "object": "chat.completion", "model": request["body"].get("model"),
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+                "usage": {"prompt_tokens": len(line) // 4, "completion_tokens": len(content) // 4 + 1}}}})
+        for key, entries in (("output_file_id", outputs), ("error_file_id", errors)):
+            if entries:
+                batch[key] = self.add_file("".join(json.dumps(entry) + "\n" for entry in entries).encode('utf-8'))["id"]
+        batch["request_counts"] = {"total": len(outputs) + len(errors), "completed": len(outputs), "failed": len(errors)}
+        batch["status"] = "completed"
+        return batch
+
+    def start(self):
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+class _Result:
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+class MockBucket:
+    def __init__(self, latency=0.0, failure_rate=0.0, corrupt_rate=0.0, bandwidth=None):
+        """
+        模拟 oss2.Bucket 中 OSSUploader 用到的接口, 对象保存在内存中。
+        :param latency: 每个请求的模拟往返延迟（秒）
+        :param failure_rate: 以该概率抛出异常, 模拟网络错误
+        :param corrupt_rate: 以该概率返回错误的 ETag, 模拟传输损坏
+        :param bandwidth: 可选的模拟带宽（字节/秒）
+        """
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.corrupt_rate = corrupt_rate
+        self.bandwidth = bandwidth
+        self.objects = {}
+        self.request_count = 0
+        self.bytes_received = 0
+        self._uploads = {}
+        self._upload_ids = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def _request(self, size=0):
+        with self._lock:
+            self.request_count += 1
+            self.bytes_received += size
+        delay = self.latency + (size / self.bandwidth if self.bandwidth else 0)
+        if delay:
+            time.sleep(delay)
+        if self.failure_rate and random.random() < self.failure_rate:
+            raise ConnectionError("mock network error")
+
+    def _etag(self, data):
+        if self.corrupt_rate and random.random() < self.corrupt_rate:
+            return hashlib.md5(data + b"corrupt").hexdigest().upper()
+        return hashlib.md5(data).hexdigest().upper()
+
+    @staticmethod
+    def _check_md5(data, headers):
+        expected = (headers or {}).get('Content-MD5')
+        if expected is not None and expected != base64.b64encode(hashlib.md5(data).digest()).decode():
+            raise ValueError("InvalidDigest")
+
+    def _check_overwrite(self, key, headers):
+        # 与 OSS 相同: 带 x-oss-forbid-overwrite: true 的上传在对象已存在时返回 409 FileAlreadyExists (调用时已持有锁)
+        if (headers or {}).get('x-oss-forbid-overwrite') == 'true' and key in self.objects:
+            raise oss2.exceptions.Conflict(409, {}, b"", {'Code': 'FileAlreadyExists', 'Message': 'The object you specified already exists.'})
+
+    def put_object(self, key, data, headers=None):
+        data = data.getvalue() if hasattr(data, 'getvalue') else bytes(data)
+        self._request(len(data))
+        self._check_md5(data, headers)
+        with self._lock:
+            self._check_overwrite(key, headers)
+            self.objects[key] = data
+        return _Result(etag=self._etag(data), status=200)
+
+    def object_exists(self, key):
+        self._request()
+        with self._lock:
+            return key in self.objects
+
+    def init_multipart_upload(self, key, headers=None):
+        self._request()
+        with self._lock:
+            self._check_overwrite(key, headers)
+            upload_id = f"upload-{next(self._upload_ids)}"
+            self._uploads[upload_id] = {}
+        return _Result(upload_id=upload_id)
+
+    def upload_part(self, key, upload_id, part_number, data, headers=None):
+        data = bytes(data)
+        self._request(len(data))
+        self._check_md5(data, headers)
+        with self._lock:
+            self._uploads[upload_id][part_number] = data
+        return _Result(etag=self._etag(data))
+
+    def complete_multipart_upload(self, key, upload_id, parts, headers=None):
+        self._request()
+        with self._lock:
+            self._check_overwrite(key, headers)
+            uploaded = self._uploads.pop(upload_id)
+            self.objects[key] = b"".join(uploaded[part.part_number] for part in parts)
+        return _Result(status=200)
+
+    def abort_multipart_upload(self, key, upload_id):
+        self._request()
+        with self._lock:
+            self._uploads.pop(upload_id, None)
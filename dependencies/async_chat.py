@@ -0,0 +1,208 @@
+import asyncio
+import inspect
+import time
+import requests
+
+from dependencies.chat import (build_chat_request, record_usage, strip_overlap, stream_partial, StreamAccumulator, StreamInterrupted,
+                               _HttpxResponse, _short_url)
+from dependencies.metrics import metrics
+from dependencies.ratelimit import RetryError, backoff_delay, classify_error, estimate_tokens
+
+try:
+    import httpx  # 异步客户端依赖 httpx (见 requirements.txt)
+except ImportError:
+    httpx = None
+
+
+class AsyncChat:
+    def __init__(self, api_key=None, model=None, baseurl=None, temperature=0.7, top_p=1, stream=False,
+                 pool_size=100, timeout=(10, 300), http2=False, metrics_stage='llm'):
+        """
+        基于 asyncio 的 Chat 客户端, 参数和调用方式与 Chat 相同, 只是需要 await。
+        单个事件循环中可以同时挂起上百个请求, 不再受线程数限制。
+        :param pool_size: 最大连接数, 应不小于调用方的并发上限
+        :param timeout: (连接超时, 读取超时) 秒
+        :param http2: 是否使用 HTTP/2 (需要安装 httpx[http2])
+        """
+        if httpx is None:
+            raise ImportError("AsyncChat requires httpx, install it with pip install -r requirements.txt")
+        self.api_key = api_key
+        self.model = model
+        self.baseurl = baseurl
+        self.temperature = temperature
+        self.top_p = top_p
+        self.stream = stream
+        self.timeout = timeout
+        self.metrics_stage = metrics_stage
+        limits = httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size)
+        self.client = httpx.AsyncClient(http2=http2, limits=limits, timeout=httpx.Timeout(timeout[1], connect=timeout[0]))
+
+    async def send_request(self, prompt, img_url=None, api_key=None, model=None, baseurl=None, temperature=None, top_p=None, stream=None,
+                           prefix=None, on_delta=None):
+        """
+        :param prompt: 用户输入的文本提示 string
+        :param img_url: 可选的图片 URL 或 data: URL
+        :param prefix: 续写前缀, 见 Chat.send_request
+        :param on_delta: 可选的回调 (普通函数), 见 Chat.send_request
+        :return: API 返回的响应文本
+        """
+        api_key = api_key or self.api_key
+        model = model or self.model
+        baseurl = baseurl or self.baseurl
+        temperature = temperature if temperature is not None else self.temperature
+        top_p = top_p if top_p is not None else self.top_p
+        stream = stream if stream is not None else self.stream
+
+        headers, data = build_chat_request(prompt, img_url, api_key, model, baseurl, temperature, top_p, stream, prefix)
+        if stream:
+            return await self._send_stream(baseurl, headers, data, prompt, img_url, prefix, on_delta)
+
+        # 错误统一转换为 requests 的异常类型, 与同步版本的重试逻辑保持一致
+        start = time.perf_counter()
+        try:
+            response = _HttpxResponse(await self.client.post(baseurl, headers=headers, json=data))
+        except httpx.TimeoutException as e:
+            raise requests.exceptions.Timeout(str(e)) from e
+        except httpx.HTTPError as e:
+            raise requests.exceptions.ConnectionError(str(e)) from e
+        response.raise_for_status()
+        body = response.json()
+        content = body['choices'][0]['message']['content']
+        record_usage(self.metrics_stage, time.perf_counter() - start, prompt, img_url, body)
+        if prefix:
+            content = strip_overlap(prefix, content)
+        if on_delta is not None:
+            on_delta(content)
+        return (prefix or "") + content
+
+    async def _send_stream(self, baseurl, headers, data, prompt, img_url, prefix, on_delta):
+        start = time.perf_counter()
+        accumulator = StreamAccumulator(prefix, on_delta)
+        try:
+            async with self.client.stream("POST", baseurl, headers=headers, json=data) as response:
+                if response.status_code >= 400:
+                    await response.aread()
+                    _HttpxResponse(response).raise_for_status()
+                try:
+                    async for line in response.aiter_lines():
+                        if line and accumulator.feed(line):
+                            break
+                except httpx.HTTPError as e:
+                    accumulator.flush()
+                    raise StreamInterrupted(f"Stream interrupted: {e}", accumulator.text()) from e
+        except httpx.TimeoutException as e:
+            raise requests.exceptions.Timeout(str(e)) from e
+        except httpx.HTTPError as e:
+            raise requests.exceptions.ConnectionError(str(e)) from e
+        accumulator.flush()
+        if not accumulator.finished:
+            raise StreamInterrupted("Stream ended before the response was complete", accumulator.text())
+        record_usage(self.metrics_stage, time.perf_counter() - start, prompt, img_url, {'usage': accumulator.usage})
+        return accumulator.text()
+
+    async def __call__(self, prompt, img_url=None, api_key=None, model=None, baseurl=None, temperature=None, top_p=None, stream=None,
+                       prefix=None, on_delta=None):
+        return await self.send_request(prompt, img_url, api_key, model, baseurl, temperature, top_p, stream, prefix, on_delta)
+
+    async def close(self):
+        await self.client.aclose()
+
+
+class AsyncChat_Retry(AsyncChat):
+    def __init__(self, api_key=None, model=None, baseurl=None, temperature=0.7, top_p=1, stream=False, max_retries=3, retry_delay=2,
+                 pool_size=100, timeout=(10, 300), http2=False, rate_limiter=None, concurrency=None, max_retry_delay=60,
+                 metrics_stage='llm'):
+        """
+        带重试机制的 AsyncChat, 重试间隔期间不占用线程。重试、限流和并发控制的规则与 Chat_Retry 相同。
+        :param max_retries: 最大重试次数
+        :param retry_delay: 指数退避的基础延迟时间（秒）
+        :param rate_limiter: 可选的 RateLimiter
+        :param concurrency: 可选的 ConcurrencyController
+        :param max_retry_delay: 单次重试等待时间的上限（秒）
+        """
+        super().__init__(api_key, model, baseurl, temperature, top_p, stream, pool_size, timeout, http2, metrics_stage)
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self.rate_limiter = rate_limiter
+        self.concurrency = concurrency
+        self.max_retry_delay = max_retry_delay
+
+    async def send_request(self, prompt, img_url=None, api_key=None, model=None, baseurl=None, temperature=None, top_p=None, stream=None,
+                           prefix=None, on_delta=None):
+        for attempt in range(self.max_retries):
+            if self.concurrency is not None:
+                await self.concurrency.acquire_async()
+            try:
+                if self.rate_limiter is not None:
+                    await self.rate_limiter.acquire_async(estimate_tokens(prompt, img_url))
+                start = time.monotonic()
+                result = await super().send_request(prompt, img_url, api_key, model, baseurl, temperature, top_p, stream, prefix, on_delta)
+                if self.concurrency is not None:
+                    self.concurrency.on_success(time.monotonic() - start)
+                return result
+            except requests.exceptions.RequestException as e:
+                retryable, throttled, retry_after = classify_error(e)
+                prefix = stream_partial(e) or prefix
+                print(f"Request failed (attempt {attempt + 1}/{self.max_retries}): {e}"
+                      + (f", resuming after {len(prefix)} characters" if prefix else ""))
+                if throttled:
+                    if self.concurrency is not None:
+                        self.concurrency.on_throttle()
+                    if self.rate_limiter is not None and retry_after:
+                        self.rate_limiter.pause(retry_after)
+                if not retryable or attempt == self.max_retries - 1:
+                    metrics.record(self.metrics_stage, errors=1)
+                    if not retryable:
+                        raise
+                    raise RetryError(f"Max retries exceeded. Last error: {e}") from e
+                metrics.record(self.metrics_stage, retries=1)
+            finally:
+                if self.concurrency is not None:
+                    self.concurrency.release()
+
+            delay = retry_after if retry_after is not None else backoff_delay(attempt, self.retry_delay, self.max_retry_delay)
+            await asyncio.sleep(min(delay, self.max_retry_delay))
+
+
+async def async_ocr_with_chatgpt(prompt, image_url, chat_instance, ocr_max_retries=5, cache=None, image_hash=None, on_delta=None,
+                                 encoding=None):
+    """
+    ocr_with_chatgpt 的异步版本。
+    :param image_url: 图片 URL, 或返回 URL 的无参函数/协程函数（命中缓存时不会被调用）
+    :param on_delta: 可选的回调 (普通函数), 模型输出的文本按到达顺序逐段传入
+    """
+    cache_key = None
+    if cache is not None and image_hash is not None:
+        cache_key = cache.make_key(image_hash, prompt, chat_instance.model, chat_instance.temperature, chat_instance.top_p, encoding)
+        cached = cache.get(cache_key)
+        if cached is not None:
+            metrics.count('ocr_cache_hits')
+            return cached
+
+    if callable(image_url):
+        try:
+            image_url = image_url()
+            if inspect.isawaitable(image_url):
+                image_url = await image_url
+        except Exception as e:
+            metrics.record('ocr', errors=1)
+            return f"OCR failed for image: {e}"
+
+    start = time.perf_counter()
+    prefix = None
+    for attempt in range(ocr_max_retries):
+        try:
+            result = await chat_instance(prompt, img_url=image_url, prefix=prefix, on_delta=on_delta)
+            metrics.record('ocr', time.perf_counter() - start, retries=attempt)
+            if cache_key is not None:
+                cache.put(cache_key, result)
+            return result
+        except Exception as e:
+            retryable, _, retry_after = classify_error(e)
+            prefix = stream_partial(e) or prefix
+            if retryable and attempt < ocr_max_retries - 1:
+                print(f"OCR attempt ({attempt + 1} / {ocr_max_retries}) failed for {_short_url(image_url)}. Retrying...")
+                await asyncio.sleep(retry_after if retry_after is not None else backoff_delay(attempt, 3, 60))
+            else:
+                metrics.record('ocr', time.perf_counter() - start, retries=attempt, errors=1)
+                return f"OCR failed for {_short_url(image_url)}: {e}"
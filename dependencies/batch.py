@@ -0,0 +1,274 @@
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+
+import requests
+
+from dependencies.chat import create_session
+from dependencies.metrics import metrics
+from dependencies.ratelimit import backoff_delay, classify_error
+
+# 批处理任务的终止状态, 其余状态 (validating / in_progress / finalizing / cancelling) 需要继续轮询
+TERMINAL_STATUSES = {"completed", "failed", "expired", "cancelled"}
+
+
+def api_root(chat_url):
+    """
+    由 chat/completions 的完整地址得到 API 根地址, 例如 https://host/v1/chat/completions -> https://host/v1
+    """
+    chat_url = chat_url.rstrip("/")
+    suffix = "/chat/completions"
+    return chat_url[:-len(suffix)] if chat_url.endswith(suffix) else chat_url
+
+
+def batch_lines(batch_requests, endpoint="/v1/chat/completions"):
+    """
+    将 [(custom_id, 请求体), ...] 序列化为批处理输入文件的各行 (JSONL)。
+    """
+    return [json.dumps({"custom_id": custom_id, "method": "POST", "url": endpoint, "body": body}, ensure_ascii=False)
+            for custom_id, body in batch_requests]
+
+
+def requests_key(batch_requests):
+    # 一组请求的内容哈希, 输入有任何变化都会开始新的任务, 而不是沿用旧的结果
+    h = hashlib.sha256()
+    for line in batch_lines(batch_requests):
+        h.update(line.encode('utf-8'))
+        h.update(b"\n")
+    return h.hexdigest()
+
+
+class BatchClient:
+    def __init__(self, api_key, baseurl, timeout=(10, 300), max_retries=5, retry_delay=2):
+        """
+        OpenAI 风格的批处理接口客户端: 上传 JSONL 输入文件 (/v1/files), 创建并查询批处理任务 (/v1/batches), 下载结果文件。
+        批处理通常在 24 小时内完成, 价格约为实时请求的一半, 且不占用实时接口的限流额度。
+        :param baseurl: API 根地址 (如 https://host/v1), 也可以直接传入 chat/completions 的完整地址
+        :param max_retries: 网络错误、429 和 5xx 的最大重试次数
+        """
+        self.api_key = api_key
+        self.root = api_root(baseurl)
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self.session = create_session(pool_size=2)
+
+    def _request(self, method, path, **kwargs):
+        headers = {"Authorization": f"Bearer {self.api_key}"}
+        for attempt in range(self.max_retries):
+            try:
+                response = self.session.request(method, f"{self.root}{path}", headers=headers, timeout=self.timeout, **kwargs)
+                response.raise_for_status()
+                return response
+            except requests.exceptions.RequestException as e:
+                retryable, _, retry_after = classify_error(e)
+                if not retryable or attempt == self.max_retries - 1:
+                    raise
+                print(f"Batch API request {method} {path} failed (attempt {attempt + 1}/{self.max_retries}): {e}")
+                time.sleep(retry_after if retry_after is not None else backoff_delay(attempt, self.retry_delay, 60))
+
+    def upload_file(self, data, filename="batch.jsonl"):
+        """
+        :param data: JSONL 文件内容 (字节串)
+        :return: 文件 ID
+        """
+        response = self._request("POST", "/files", data={"purpose": "batch"},
+                                 files={"file": (filename, data, "application/jsonl")})
+        return response.json()["id"]
+
+    def create_batch(self, input_file_id, endpoint="/v1/chat/completions", completion_window="24h", metadata=None):
+        """
+        :return: 批处理任务对象 (dict), 包含 id 和 status
+        """
+        payload = {"input_file_id": input_file_id, "endpoint": endpoint, "completion_window": completion_window}
+        if metadata:
+            payload["metadata"] = metadata
+        return self._request("POST", "/batches", json=payload).json()
+
+    def get_batch(self, batch_id):
+        return self._request("GET", f"/batches/{batch_id}").json()
+
+    def cancel_batch(self, batch_id):
+        return self._request("POST", f"/batches/{batch_id}/cancel").json()
+
+    def download_file(self, file_id):
+        """
+        :return: 文件内容 (文本)
+        """
+        return self._request("GET", f"/files/{file_id}/content").content.decode('utf-8')
+
+    def close(self):
+        self.session.close()
+
+
+class BatchJobStore:
+    def __init__(self, db_path):
+        """
+        基于 SQLite 的批处理任务状态, 进程中断后重新运行时继续轮询已提交的任务, 已完成的请求不会重复提交。
+        每个任务以名称区分 (如 "文档名:ocr"), 请求内容变化时自动丢弃旧的状态和结果。
+        :param db_path: SQLite 数据库文件路径
+        """
+        self.db_path = db_path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.execute("CREATE TABLE IF NOT EXISTS batch_jobs ("
+                           "name TEXT PRIMARY KEY, key TEXT NOT NULL, batch_id TEXT, status TEXT, updated REAL NOT NULL)")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS batch_results ("
+                           "name TEXT NOT NULL, custom_id TEXT NOT NULL, result TEXT NOT NULL, PRIMARY KEY (name, custom_id))")
+        self._conn.commit()
+
+    def start(self, name, key):
+        """
+        开始 (或继续) 一个任务。key 与已保存的不同时清空该任务的状态和结果。
+        :return: 任务记录 dict(key, batch_ids, status), batch_ids 为本轮提交的批处理任务 ID 列表
+        """
+        with self._lock:
+            row = self._conn.execute("SELECT key, batch_id, status FROM batch_jobs WHERE name = ?", (name,)).fetchone()
+            if row is not None and row[0] == key:
+                # batch_id 列保存 JSON 列表; 早期版本保存的是单个 ID
+                batch_ids = [] if not row[1] else json.loads(row[1]) if row[1].startswith("[") else [row[1]]
+                return {"key": row[0], "batch_ids": batch_ids, "status": row[2]}
+            self._conn.execute("DELETE FROM batch_results WHERE name = ?", (name,))
+            self._conn.execute("INSERT OR REPLACE INTO batch_jobs (name, key, batch_id, status, updated) VALUES (?, ?, NULL, NULL, ?)",
+                               (name, key, time.time()))
+            self._conn.commit()
+            return {"key": key, "batch_ids": [], "status": None}
+
+    def set_batches(self, name, batch_ids, status):
+        with self._lock:
+            self._conn.execute("UPDATE batch_jobs SET batch_id = ?, status = ?, updated = ? WHERE name = ?",
+                               (json.dumps(batch_ids), status, time.time(), name))
+            self._conn.commit()
+
+    def results(self, name):
+        """
+        :return: {custom_id: 结果文本}, 只包含已成功的请求
+        """
+        with self._lock:
+            return dict(self._conn.execute("SELECT custom_id, result FROM batch_results WHERE name = ?", (name,)).fetchall())
+
+    def save_results(self, name, results):
+        with self._lock:
+            self._conn.executemany("INSERT OR REPLACE INTO batch_results (name, custom_id, result) VALUES (?, ?, ?)",
+                                   [(name, custom_id, result) for custom_id, result in results.items()])
+            self._conn.commit()
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+def parse_batch_output(text):
+    """
+    解析批处理的结果文件或错误文件。
+    :return: ({custom_id: 回复文本}, {custom_id: 错误信息})
+    """
+    results, errors = {}, {}
+    for line in text.splitlines():
+        if not line.strip():
+            continue
+        entry = json.loads(line)
+        custom_id = entry["custom_id"]
+        response = entry.get("response") or {}
+        body = response.get("body") or {}
+        if entry.get("error") or response.get("status_code") != 200:
+            errors[custom_id] = entry.get("error") or body.get("error") or f"HTTP {response.get('status_code')}"
+            continue
+        try:
+            results[custom_id] = body["choices"][0]["message"]["content"]
+        except (KeyError, IndexError, TypeError):
+            errors[custom_id] = f"unexpected response body: {str(body)[:200]}"
+            continue
+        usage = body.get("usage") or {}
+        metrics.record('llm.batch', prompt_tokens=usage.get('prompt_tokens') or 0, completion_tokens=usage.get('completion_tokens') or 0)
+    return results, errors
+
+
+def _split_requests(batch_requests, max_requests, max_bytes):
+    # 按服务商对单个输入文件的限制 (请求数和文件大小) 取出下一批请求
+    lines, size = [], 0
+    for line in batch_lines(batch_requests):
+        line_size = len(line.encode('utf-8')) + 1
+        if lines and (len(lines) >= max_requests or size + line_size > max_bytes):
+            break
+        lines.append(line)
+        size += line_size
+    return lines
+
+
+def run_batch(client, store, name, batch_requests, poll_interval=30, max_rounds=3, max_requests=50000, max_bytes=190 * 1024 * 1024,
+              completion_window="24h"):
+    """
+    通过批处理接口完成一组 chat/completions 请求, 阻塞直到全部完成 (或重试轮数用尽)。
+    状态保存在 store 中, 中断后用相同的参数重新调用会继续等待已提交的任务, 只提交尚未成功的请求。
+    :param client: BatchClient
+    :param store: BatchJobStore
+    :param name: 任务名称, 同一个文档的 OCR、翻译、润色应使用不同的名称
+    :param batch_requests: [(custom_id, 请求体), ...], 请求体可由 build_chat_body 生成
+    :param poll_interval: 轮询任务状态的间隔（秒）
+    :param max_rounds: 提交的轮数上限: 第一轮提交全部请求, 之后每一轮重新提交上一轮失败的请求
+    :param max_requests: 单个输入文件的请求数上限, 超出时同一轮内拆成多个批处理任务一起提交
+    :param max_bytes: 单个输入文件的大小上限
+    :return: ({custom_id: 回复文本}, {custom_id: 错误信息}), 全部成功时错误为空
+    """
+    job = store.start(name, requests_key(batch_requests))
+    batch_ids = job["batch_ids"] if job["status"] not in TERMINAL_STATUSES else []
+    errors = {}
+    rounds = 0
+    while True:
+        if not batch_ids:
+            done = store.results(name)
+            pending = [(custom_id, body) for custom_id, body in batch_requests if custom_id not in done]
+            if not pending or rounds >= max_rounds:
+                break
+            # 按输入文件的限制拆分, 本轮的所有分片一起提交
+            remaining = pending
+            while remaining:
+                lines = _split_requests(remaining, max_requests, max_bytes)
+                file_id = client.upload_file(("\n".join(lines) + "\n").encode('utf-8'), f"{name.replace(':', '_')}.jsonl")
+                batch = client.create_batch(file_id, completion_window=completion_window, metadata={"job": name})
+                batch_ids.append(batch["id"])
+                store.set_batches(name, batch_ids, "in_progress")
+                remaining = remaining[len(lines):]
+                print(f"Submitted batch {batch['id']} for {name}: {len(lines)} of {len(pending)} pending requests")
+            rounds += 1
+        else:
+            print(f"Resuming batches {', '.join(batch_ids)} for {name}")
+
+        start = time.perf_counter()
+        finished = {}
+        while True:
+            for batch_id in batch_ids:
+                if batch_id not in finished:
+                    batch = client.get_batch(batch_id)
+                    if batch["status"] in TERMINAL_STATUSES:
+                        finished[batch_id] = batch
+                    else:
+                        counts = batch.get("request_counts") or {}
+                        print(f"Batch {batch_id} {batch['status']}: {counts.get('completed', 0)}/{counts.get('total', '?')} completed")
+            if len(finished) == len(batch_ids):
+                break
+            time.sleep(poll_interval)
+        metrics.record('batch', time.perf_counter() - start)
+
+        results, errors = {}, {}
+        for batch_id, batch in finished.items():
+            batch_results, batch_errors = {}, {}
+            for file_key in ("output_file_id", "error_file_id"):
+                if batch.get(file_key):
+                    file_results, file_errors = parse_batch_output(client.download_file(batch[file_key]))
+                    batch_results.update(file_results)
+                    batch_errors.update(file_errors)
+            results.update(batch_results)
+            errors.update(batch_errors)
+            print(f"Batch {batch_id} {batch['status']}: {len(batch_results)} succeeded, {len(batch_errors)} failed"
+                  + (f", errors: {batch['errors']}" if batch.get("errors") else ""))
+        store.save_results(name, results)
+        store.set_batches(name, batch_ids, "completed")
+        batch_ids = []
+
+    done = store.results(name)
+    remaining = {custom_id: errors.get(custom_id, "not completed") for custom_id, _ in batch_requests if custom_id not in done}
+    return {custom_id: done[custom_id] for custom_id, _ in batch_requests if custom_id in done}, remaining
@@ -1,8 +1,251 @@
+import base64
+import json
 import requests
 import time
+from requests.adapters import HTTPAdapter
+from dependencies.ratelimit import RetryError, backoff_delay, classify_error, estimate_tokens
+from dependencies.metrics import metrics
+
+try:
+    import httpx  # 仅在 http2=True 时使用 (httpx 和 h2 见 requirements.txt)
+except ImportError:
+    httpx = None
+
+
+class _HttpxResponse:
+    """
+    将 httpx 的响应包装成与 requests.Response 相同的用法, 错误统一抛出 requests 的异常类型,
+    这样 Chat_Retry 等上层逻辑不需要区分底层使用的是哪个 HTTP 客户端。
+    """
+    def __init__(self, response):
+        self._response = response
+        self.status_code = response.status_code
+        self.headers = response.headers
+
+    @property
+    def text(self):
+        return self._response.text
+
+    def json(self):
+        return self._response.json()
+
+    def iter_lines(self):
+        try:
+            yield from self._response.iter_lines()
+        except httpx.TimeoutException as e:
+            raise requests.exceptions.Timeout(str(e)) from e
+        except httpx.HTTPError as e:
+            raise requests.exceptions.ConnectionError(str(e)) from e
+
+    def close(self):
+        self._response.close()
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.exceptions.HTTPError(f"{self.status_code} Error for url: {self._response.url}", response=self)
+
+
+class _HttpxSession:
+    def __init__(self, pool_size):
+        limits = httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size)
+        self._client = httpx.Client(http2=True, limits=limits)
+
+    def post(self, url, headers=None, json=None, timeout=None, stream=False):
+        if isinstance(timeout, tuple):
+            timeout = httpx.Timeout(timeout[1], connect=timeout[0])
+        try:
+            if stream:
+                request = self._client.build_request("POST", url, headers=headers, json=json, timeout=timeout)
+                response = self._client.send(request, stream=True)
+                if response.status_code >= 400:
+                    response.read()
+                return _HttpxResponse(response)
+            return _HttpxResponse(self._client.post(url, headers=headers, json=json, timeout=timeout))
+        except httpx.TimeoutException as e:
+            raise requests.exceptions.Timeout(str(e)) from e
+        except httpx.HTTPError as e:
+            raise requests.exceptions.ConnectionError(str(e)) from e
+
+    def close(self):
+        self._client.close()
+
+
+def create_session(pool_size=10, http2=False):
+    """
+    创建带连接池的 HTTP 会话, 多个线程共享同一个连接池, 复用 TCP/TLS 连接 (keep-alive)。
+    :param pool_size: 连接池大小, 应与并发请求的线程数一致
+    :param http2: 是否使用 HTTP/2 (需要安装 httpx[http2])
+    """
+    if http2:
+        if httpx is None:
+            raise ImportError("http2=True requires httpx and h2, install them with pip install -r requirements.txt")
+        return _HttpxSession(pool_size)
+
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+def record_usage(stage, seconds, prompt, img_url, body):
+    """
+    记录一次成功的模型请求: 耗时、请求大小和响应中 usage 字段的 token 数 (网关不返回 usage 时记为 0)。
+    """
+    usage = body.get('usage') or {}
+    metrics.record(stage, seconds, bytes=len(prompt) + len(img_url or ''),
+                   prompt_tokens=usage.get('prompt_tokens') or 0, completion_tokens=usage.get('completion_tokens') or 0)
+
+
+# 流式输出中断后的续写请求: 已收到的部分作为 assistant 消息发回, 要求模型从断点继续
+CONTINUE_PROMPT = ("Your previous reply was cut off. Continue exactly where it stopped. "
+                   "Do not repeat any text that was already written and do not add any explanation.")
+OVERLAP_WINDOW = 200    # 续写内容开头与已收到内容结尾的最大重叠检查长度 (字符)
+
+
+class StreamInterrupted(requests.exceptions.ConnectionError):
+    """
+    流式响应在结束前断开。partial 是已经收到的全部文本 (包括之前的续写前缀), 重试时作为续写的前缀。
+    """
+    def __init__(self, message, partial=""):
+        super().__init__(message)
+        self.partial = partial
+
+
+def stream_partial(exc):
+    """
+    :return: 异常 (或被 RetryError 等包装的原始异常) 中保存的已收到文本, 没有时返回 None
+    """
+    while exc is not None:
+        if isinstance(exc, StreamInterrupted):
+            return exc.partial or None
+        exc = exc.__cause__
+    return None
+
+
+def strip_overlap(prefix, continuation, max_overlap=OVERLAP_WINDOW, min_overlap=20):
+    """
+    模型续写时常常会重复已输出内容的最后几个词, 去掉续写开头与前缀结尾重叠的部分。
+    重叠少于 min_overlap 个字符时不处理, 避免误删恰好与前缀结尾相同的正常内容。
+    """
+    for size in range(min(len(prefix), len(continuation), max_overlap), min_overlap - 1, -1):
+        if prefix.endswith(continuation[:size]):
+            return continuation[size:]
+    return continuation
+
+
+class StreamAccumulator:
+    def __init__(self, prefix=None, on_delta=None):
+        """
+        逐行解析 SSE (text/event-stream) 响应, 累积增量文本, 同步和异步客户端共用。
+        续写请求 (prefix 非空) 时先缓存开头的 OVERLAP_WINDOW 个字符, 去掉与前缀重叠的部分后再交给 on_delta。
+        :param prefix: 续写前缀, 即上次中断前已收到的文本
+        :param on_delta: 可选的回调, 每收到一段新文本调用一次 on_delta(文本)
+        """
+        self.prefix = prefix or ""
+        self.on_delta = on_delta
+        self.parts = []
+        self.usage = None
+        self.finished = False
+        self._held = "" if prefix else None     # None 表示不需要检查重叠
+
+    def feed(self, line):
+        """
+        处理一行 SSE 数据。
+        :return: 是否收到了结束标记 [DONE]
+        """
+        if isinstance(line, bytes):
+            # 按字节读取再按 UTF-8 解码: text/event-stream 没有声明编码时 requests 会按 ISO-8859-1 解码
+            line = line.decode('utf-8')
+        if not line.startswith('data:'):
+            return False
+        payload = line[5:].strip()
+        if payload == '[DONE]':
+            self.finished = True
+            return True
+        event = json.loads(payload)
+        if event.get('usage'):
+            self.usage = event['usage']
+        if event.get('choices'):
+            choice = event['choices'][0]
+            content = (choice.get('delta') or {}).get('content')
+            if content:
+                self._emit(content)
+            if choice.get('finish_reason'):
+                self.finished = True
+        return False
+
+    def _emit(self, text):
+        if self._held is not None:
+            self._held += text
+            if len(self._held) < OVERLAP_WINDOW:
+                return
+            text, self._held = strip_overlap(self.prefix, self._held), None
+        if text:
+            self.parts.append(text)
+            if self.on_delta is not None:
+                self.on_delta(text)
+
+    def flush(self):
+        # 流结束 (或中断) 时交出仍在缓存中的开头部分
+        if self._held is not None:
+            held, self._held = self._held, None
+            self._emit(strip_overlap(self.prefix, held))
+
+    def text(self):
+        return self.prefix + "".join(self.parts)
+
+
+def build_chat_body(prompt, img_url, model, temperature, top_p, stream=False, prefix=None):
+    """
+    构造 chat/completions 的请求体, 实时请求和批处理 (见 dependencies/batch.py) 共用。
+    :param prefix: 续写前缀, 设置后追加已收到的回复和续写要求, 模型只需输出剩余部分
+    """
+    messages = [{"role": 'user', "content": prompt}]  
+
+    # 如果有 img_url，则添加图片内容
+    if img_url:
+        messages[0]['content'] = [
+            {"type": "image_url", "image_url": {"url": img_url}},
+            {"type": "text", "text": prompt}
+        ]
+
+    if prefix:
+        messages.append({"role": 'assistant', "content": prefix})
+        messages.append({"role": 'user', "content": CONTINUE_PROMPT})
+
+    data = {
+        "model": model,
+        "stream": stream,
+        "messages": messages,
+        "temperature": temperature,
+        "top_p": top_p
+    }
+    if stream:
+        # 让流的最后一个事件带上 usage, 用于 token 统计
+        data["stream_options"] = {"include_usage": True}
+    return data
+
+
+def build_chat_request(prompt, img_url, api_key, model, baseurl, temperature, top_p, stream, prefix=None):
+    """
+    构造 chat/completions 请求的请求头和请求体, 同步和异步客户端共用。
+    :param prefix: 续写前缀, 见 build_chat_body
+    :return: (headers, data)
+    """
+    if not api_key or not model or not baseurl:
+        raise ValueError("API key, model, and baseurl are required.")
+
+    headers = {
+        "Authorization": f"Bearer {api_key}",
+        "Content-Type": "application/json"
+    }
+    return headers, build_chat_body(prompt, img_url, model, temperature, top_p, stream, prefix)
+
 
 class Chat:
-    def __init__(self, api_key=None, model=None, baseurl=None, temperature=0.7, top_p=1, stream=False):
+    def __init__(self, api_key=None, model=None, baseurl=None, temperature=0.7, top_p=1, stream=False,
+                 pool_size=10, timeout=(10, 300), http2=False, metrics_stage='llm'):
         """
         初始化 ChatGPT 类并设置默认参数。
         :param api_key: API 密钥
@@ -10,7 +253,11 @@ class Chat:
         :param baseurl: API 基础 URL
         :param temperature: 生成文本的随机性
         :param top_p: 控制生成文本的多样性
-        :param stream: 是否启用流式传输
+        :param stream: 是否启用流式传输 (SSE), 启用后可以通过 on_delta 实时获得输出, 连接中断时从已收到的部分续写
+        :param pool_size: 连接池大小, 建议与调用该实例的线程数 (max_workers) 一致
+        :param timeout: (连接超时, 读取超时) 秒, 避免连接卡死时线程永久阻塞
+        :param http2: 是否使用 HTTP/2 (需要安装 httpx[http2])
+        :param metrics_stage: 记录请求耗时和 token 用量时使用的阶段名称, 如 'llm.ocr'
         """
         self.api_key = api_key
         self.model = model
@@ -18,11 +265,17 @@ class Chat:
         self.temperature = temperature
         self.top_p = top_p
         self.stream = stream  
+        self.timeout = timeout
+        self.metrics_stage = metrics_stage
+        self.session = create_session(pool_size, http2)
 
-    def send_request(self, prompt, img_url=None, api_key=None, model=None, baseurl=None, temperature=None, top_p=None, stream=None):
+    def send_request(self, prompt, img_url=None, api_key=None, model=None, baseurl=None, temperature=None, top_p=None, stream=None,
+                     prefix=None, on_delta=None):
         """
         :param prompt: 用户输入的文本提示 string
-        :param img_url: 可选的图片 URL
+        :param img_url: 可选的图片 URL, 可以是 http(s) 地址, 也可以是 make_data_url 生成的 data: URL (图片内嵌在请求中)
+        :param prefix: 续写前缀 (上次中断前已收到的文本), 返回值包含该前缀
+        :param on_delta: 可选的回调, 流式传输时每收到一段文本调用一次; 非流式时收到完整回复后调用一次
         :return: API 返回的响应文本
         """
         # 使用传入的参数或默认值
@@ -33,79 +286,170 @@ class Chat:
         top_p = top_p if top_p is not None else self.top_p
         stream = stream if stream is not None else self.stream  
 
-        if not api_key or not model or not baseurl:
-            raise ValueError("API key, model, and baseurl are required.")
-
-        headers = {
-            "Authorization": f"Bearer {api_key}",
-            "Content-Type": "application/json"
-        }
-
-        messages = [{"role": 'user', "content": prompt}]  
-
-        # 如果有 img_url，则添加图片内容
-        if img_url:
-            messages[0]['content'] = [
-                {"type": "image_url", "image_url": {"url": img_url}},
-                {"type": "text", "text": prompt}
-            ]
-
-        data = {
-            "model": model,
-            "stream": stream,
-            "messages": messages,
-            "temperature": temperature,
-            "top_p": top_p
-        }
+        headers, data = build_chat_request(prompt, img_url, api_key, model, baseurl, temperature, top_p, stream, prefix)
+        if stream:
+            return self._send_stream(baseurl, headers, data, prompt, img_url, prefix, on_delta)
 
         try:
             # 发送请求
-            response = requests.post(baseurl, headers=headers, json=data)
+            start = time.perf_counter()
+            response = self.session.post(baseurl, headers=headers, json=data, timeout=self.timeout)
             response.raise_for_status()  
-            return response.json()['choices'][0]['message']['content']
+            body = response.json()
+            content = body['choices'][0]['message']['content']
+            record_usage(self.metrics_stage, time.perf_counter() - start, prompt, img_url, body)
         except requests.exceptions.HTTPError as e:
             # print(f"HTTPError: {e}")
             # print(f"Response content: {response.text}")
             raise e
+        if prefix:
+            content = strip_overlap(prefix, content)
+        if on_delta is not None:
+            on_delta(content)
+        return (prefix or "") + content
+
+    def _send_stream(self, baseurl, headers, data, prompt, img_url, prefix, on_delta):
+        # 逐个 SSE 事件读取回复; 结束前断开时抛出 StreamInterrupted, 其中保存已收到的文本
+        start = time.perf_counter()
+        response = self.session.post(baseurl, headers=headers, json=data, timeout=self.timeout, stream=True)
+        try:
+            response.raise_for_status()
+            accumulator = StreamAccumulator(prefix, on_delta)
+            try:
+                for line in response.iter_lines():
+                    if line and accumulator.feed(line):
+                        break
+            except requests.exceptions.RequestException as e:
+                accumulator.flush()
+                raise StreamInterrupted(f"Stream interrupted: {e}", accumulator.text()) from e
+            accumulator.flush()
+            if not accumulator.finished:
+                raise StreamInterrupted("Stream ended before the response was complete", accumulator.text())
+        finally:
+            response.close()
+        record_usage(self.metrics_stage, time.perf_counter() - start, prompt, img_url, {'usage': accumulator.usage})
+        return accumulator.text()
 
-    def __call__(self, prompt, img_url=None, api_key=None, model=None, baseurl=None, temperature=None, top_p=None, stream=None):
-        return self.send_request(prompt, img_url, api_key, model, baseurl, temperature, top_p, stream)
+    def __call__(self, prompt, img_url=None, api_key=None, model=None, baseurl=None, temperature=None, top_p=None, stream=None,
+                 prefix=None, on_delta=None):
+        return self.send_request(prompt, img_url, api_key, model, baseurl, temperature, top_p, stream, prefix, on_delta)
+
+    def close(self):
+        self.session.close()
 
 
 class Chat_Retry(Chat):
-    def __init__(self, api_key=None, model=None, baseurl=None, temperature=0.7, top_p=1, stream=False, max_retries=3, retry_delay=2):
+    def __init__(self, api_key=None, model=None, baseurl=None, temperature=0.7, top_p=1, stream=False, max_retries=3, retry_delay=2,
+                 pool_size=10, timeout=(10, 300), http2=False, rate_limiter=None, concurrency=None, max_retry_delay=60,
+                 metrics_stage='llm'):
         """
         初始化 ChatGPT_Retry 类，增加重试机制。
         :param max_retries: 最大重试次数
-        :param retry_delay: 每次重试之间的延迟时间（秒）
+        :param retry_delay: 指数退避的基础延迟时间（秒）, 实际等待时间带随机抖动
+        :param rate_limiter: 可选的 RateLimiter, 按每分钟请求数/token 数限流 (同一模型的实例应共享, 见 get_rate_limiter)
+        :param concurrency: 可选的 ConcurrencyController, 根据 429 和延迟自适应调整同时在途的请求数
+        :param max_retry_delay: 单次重试等待时间的上限（秒）
         """
-        super().__init__(api_key, model, baseurl, temperature, top_p, stream)  
+        super().__init__(api_key, model, baseurl, temperature, top_p, stream, pool_size, timeout, http2, metrics_stage)  
         self.max_retries = max_retries  # 设置最大重试次数
         self.retry_delay = retry_delay  # 设置重试间隔时间
+        self.rate_limiter = rate_limiter
+        self.concurrency = concurrency
+        self.max_retry_delay = max_retry_delay
 
-    def send_request(self, prompt, img_url=None, api_key=None, model=None, baseurl=None, temperature=None, top_p=None, stream=None):
+    def send_request(self, prompt, img_url=None, api_key=None, model=None, baseurl=None, temperature=None, top_p=None, stream=None,
+                     prefix=None, on_delta=None):
         """
         重写父类的 send_request 方法，增加重试机制。
+        只重试网络错误、429 和 5xx, 优先按 Retry-After 等待, 否则使用带抖动的指数退避; 400/401 等错误直接抛出。
+        流式响应中途断开时, 下一次请求以已收到的文本作为前缀续写, 而不是从头生成。
         """
         for attempt in range(self.max_retries):
+            if self.concurrency is not None:
+                self.concurrency.acquire()
             try:
-                return super().send_request(prompt, img_url, api_key, model, baseurl, temperature, top_p, stream)
+                if self.rate_limiter is not None:
+                    self.rate_limiter.acquire(estimate_tokens(prompt, img_url))
+                start = time.monotonic()
+                result = super().send_request(prompt, img_url, api_key, model, baseurl, temperature, top_p, stream, prefix, on_delta)
+                if self.concurrency is not None:
+                    self.concurrency.on_success(time.monotonic() - start)
+                return result
             except requests.exceptions.RequestException as e:
-                print(f"Request failed (attempt {attempt + 1}/{self.max_retries}): {e}")
-                if attempt < self.max_retries - 1:
-                    time.sleep(self.retry_delay)  
-                else:
-                    raise Exception(f"Max retries exceeded. Last error: {e}")
+                retryable, throttled, retry_after = classify_error(e)
+                prefix = stream_partial(e) or prefix
+                print(f"Request failed (attempt {attempt + 1}/{self.max_retries}): {e}"
+                      + (f", resuming after {len(prefix)} characters" if prefix else ""))
+                if throttled:
+                    if self.concurrency is not None:
+                        self.concurrency.on_throttle()
+                    if self.rate_limiter is not None and retry_after:
+                        self.rate_limiter.pause(retry_after)
+                if not retryable or attempt == self.max_retries - 1:
+                    metrics.record(self.metrics_stage, errors=1)
+                    if not retryable:
+                        raise
+                    raise RetryError(f"Max retries exceeded. Last error: {e}") from e
+                metrics.record(self.metrics_stage, retries=1)
+            finally:
+                if self.concurrency is not None:
+                    self.concurrency.release()
+
+            delay = retry_after if retry_after is not None else backoff_delay(attempt, self.retry_delay, self.max_retry_delay)
+            time.sleep(min(delay, self.max_retry_delay))
 
 
 
-def ocr_with_chatgpt(prompt, image_url, chat_instance, ocr_max_retries=5):
+def make_data_url(data, mime_type='image/png'):
+    """
+    将图片字节串编码为 base64 的 data: URL，可直接作为 img_url 发送，无需先上传到对象存储。
+    """
+    return f"data:{mime_type};base64,{base64.b64encode(data).decode('ascii')}"
+
+
+def _short_url(url):
+    # data: URL 可能有几 MB, 日志和错误信息里只保留开头
+    return url[:48] + '...' if url.startswith('data:') else url
+
+
+def ocr_with_chatgpt(prompt, image_url, chat_instance, ocr_max_retries=5, cache=None, image_hash=None, on_delta=None, encoding=None):
+    """
+    :param image_url: 图片 URL，也可以是返回 URL 的无参函数（例如上传函数），命中缓存时不会被调用
+    :param cache: 可选的 OCRCache 实例
+    :param image_hash: 页面组图像的内容哈希，和 cache 一起使用
+    :param encoding: 图片的编码参数 (见 ocr_cache.encoding_key), 和 image_hash 一起组成缓存键
+    :param on_delta: 可选的回调, 模型输出的文本按到达顺序逐段传入 (见 Chat.send_request), 命中缓存时不会被调用
+    """
+    cache_key = None
+    if cache is not None and image_hash is not None:
+        cache_key = cache.make_key(image_hash, prompt, chat_instance.model, chat_instance.temperature, chat_instance.top_p, encoding)
+        cached = cache.get(cache_key)
+        if cached is not None:
+            metrics.count('ocr_cache_hits')
+            return cached
+
+    if callable(image_url):
+        try:
+            image_url = image_url()
+        except Exception as e:
+            metrics.record('ocr', errors=1)
+            return f"OCR failed for image: {e}"
+
+    start = time.perf_counter()
+    prefix = None
     for attempt in range(ocr_max_retries):
         try:
-            return chat_instance(prompt, img_url=image_url)
+            result = chat_instance(prompt, img_url=image_url, prefix=prefix, on_delta=on_delta)
+            metrics.record('ocr', time.perf_counter() - start, retries=attempt)
+            if cache_key is not None:
+                cache.put(cache_key, result)
+            return result
         except Exception as e:
-            if attempt < ocr_max_retries - 1:
-                print(f"OCR attempt ({attempt + 1} / {ocr_max_retries}) failed for {image_url}. Retrying...")
-                time.sleep(3)
+            retryable, _, retry_after = classify_error(e)
+            prefix = stream_partial(e) or prefix
+            if retryable and attempt < ocr_max_retries - 1:
+                print(f"OCR attempt ({attempt + 1} / {ocr_max_retries}) failed for {_short_url(image_url)}. Retrying...")
+                time.sleep(retry_after if retry_after is not None else backoff_delay(attempt, 3, 60))
             else:
-                return f"OCR failed for {image_url}: {e}"
\ No newline at end of file
+                metrics.record('ocr', time.perf_counter() - start, retries=attempt, errors=1)
+                return f"OCR failed for {_short_url(image_url)}: {e}"
\ No newline at end of file
@@ -0,0 +1,167 @@
+import json
+import math
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+
+def percentile(sorted_values, q):
+    """
+    最近秩法计算百分位数。
+    :param sorted_values: 已排序的数值列表
+    :param q: 0~100
+    """
+    if not sorted_values:
+        return 0.0
+    index = max(0, min(len(sorted_values) - 1, math.ceil(q / 100 * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+
+class StageStats:
+    def __init__(self):
+        self.latencies = []
+        self.bytes = 0
+        self.retries = 0
+        self.errors = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+
+    def summary(self):
+        latencies = sorted(self.latencies)
+        return {
+            "count": len(latencies),
+            "total_s": round(sum(latencies), 4),
+            "p50_s": round(percentile(latencies, 50), 4),
+            "p95_s": round(percentile(latencies, 95), 4),
+            "max_s": round(latencies[-1], 4) if latencies else 0.0,
+            "bytes": self.bytes,
+            "retries": self.retries,
+            "errors": self.errors,
+            "prompt_tokens": self.prompt_tokens,
+            "completion_tokens": self.completion_tokens,
+        }
+
+
+class Metrics:
+    def __init__(self):
+        """
+        轻量的流水线指标收集器 (线程安全), 按阶段记录耗时、字节数、重试次数和 token 用量。
+        常用阶段: crop, render, trim, layout, text_layer, stitch, prepare, upload, encode, ocr, translate, polish, 以及 llm.* (单次模型请求)。
+        """
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.stages = {}
+            self.counters = {}
+            self.started = time.time()
+
+    def _stage(self, stage):
+        if stage not in self.stages:
+            self.stages[stage] = StageStats()
+        return self.stages[stage]
+
+    def record(self, stage, seconds=None, bytes=0, retries=0, errors=0, prompt_tokens=0, completion_tokens=0):
+        """
+        记录一次事件。seconds 为 None 时只累加字节数、重试次数等, 不计入耗时分布。
+        """
+        with self._lock:
+            stats = self._stage(stage)
+            if seconds is not None:
+                stats.latencies.append(seconds)
+            stats.bytes += bytes
+            stats.retries += retries
+            stats.errors += errors
+            stats.prompt_tokens += prompt_tokens
+            stats.completion_tokens += completion_tokens
+
+    @contextmanager
+    def timer(self, stage, **kwargs):
+        """
+        with metrics.timer('render'): ... 记录代码块的耗时, 其余参数与 record 相同。
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(stage, time.perf_counter() - start, **kwargs)
+
+    def count(self, name, value=1):
+        """
+        累加计数器, 例如处理的页数 (pages) 和翻译片段数 (chunks)。
+        """
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def summary(self):
+        """
+        :return: dict, 包含运行时长、各阶段的 p50/p95 耗时、计数器以及每分钟页数/片段数
+        """
+        with self._lock:
+            elapsed = time.time() - self.started
+            summary = {
+                "started": self.started,
+                "elapsed_s": round(elapsed, 3),
+                "stages": {stage: stats.summary() for stage, stats in sorted(self.stages.items())},
+                "counters": dict(self.counters),
+            }
+        for name in ("pages", "chunks"):
+            if name in summary["counters"] and elapsed > 0:
+                summary[f"{name}_per_min"] = round(summary["counters"][name] / elapsed * 60, 2)
+        return summary
+
+    def report(self):
+        """
+        打印本次运行的汇总。
+        """
+        summary = self.summary()
+        print(f"Run time {summary['elapsed_s']:.1f}s, counters: {summary['counters']}"
+              + "".join(f", {name} {summary[name]}" for name in ("pages_per_min", "chunks_per_min") if name in summary))
+        print(f"{'stage':<16} {'count':>7} {'total s':>9} {'p50 s':>8} {'p95 s':>8} {'MB':>9} {'retries':>8} {'errors':>7} {'tokens in/out':>16}")
+        for stage, s in summary["stages"].items():
+            print(f"{stage:<16} {s['count']:>7} {s['total_s']:>9.2f} {s['p50_s']:>8.3f} {s['p95_s']:>8.3f} {s['bytes'] / 1024 / 1024:>9.2f} "
+                  f"{s['retries']:>8} {s['errors']:>7} {s['prompt_tokens']:>8}/{s['completion_tokens']:<7}")
+
+    def write_jsonl(self, path):
+        """
+        将本次运行的汇总追加为 JSONL 中的一行。
+        """
+        with open(path, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(self.summary(), ensure_ascii=False) + "\n")
+
+    def to_prometheus(self, prefix="pdf_ocr"):
+        """
+        :return: Prometheus 文本格式 (可用 node_exporter 的 textfile collector 采集)
+        """
+        summary = self.summary()
+        lines = [f"# TYPE {prefix}_stage_seconds summary"]
+        for stage, s in summary["stages"].items():
+            lines.append(f'{prefix}_stage_seconds{{stage="{stage}",quantile="0.5"}} {s["p50_s"]}')
+            lines.append(f'{prefix}_stage_seconds{{stage="{stage}",quantile="0.95"}} {s["p95_s"]}')
+            lines.append(f'{prefix}_stage_seconds_sum{{stage="{stage}"}} {s["total_s"]}')
+            lines.append(f'{prefix}_stage_seconds_count{{stage="{stage}"}} {s["count"]}')
+        for metric, key in (("bytes", "bytes"), ("retries", "retries"), ("errors", "errors")):
+            lines.append(f"# TYPE {prefix}_stage_{metric}_total counter")
+            lines.extend(f'{prefix}_stage_{metric}_total{{stage="{stage}"}} {s[key]}' for stage, s in summary["stages"].items())
+        lines.append(f"# TYPE {prefix}_tokens_total counter")
+        for stage, s in summary["stages"].items():
+            lines.append(f'{prefix}_tokens_total{{stage="{stage}",type="prompt"}} {s["prompt_tokens"]}')
+            lines.append(f'{prefix}_tokens_total{{stage="{stage}",type="completion"}} {s["completion_tokens"]}')
+        lines.append(f"# TYPE {prefix}_items_total counter")
+        lines.extend(f'{prefix}_items_total{{name="{name}"}} {value}' for name, value in summary["counters"].items())
+        lines.append(f"# TYPE {prefix}_run_seconds gauge")
+        lines.append(f"{prefix}_run_seconds {summary['elapsed_s']}")
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self, path, prefix="pdf_ocr"):
+        # 先写临时文件再替换, 采集方不会读到写了一半的文件
+        tmp_path = path + ".tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(self.to_prometheus(prefix))
+        os.replace(tmp_path, path)
+
+
+# 进程内共享的默认实例, 各模块直接记录到这里
+metrics = Metrics()
@@ -0,0 +1,114 @@
+import hashlib
+import sqlite3
+import threading
+import time
+
+FAILED_PREFIX = "OCR failed for"
+
+
+def image_hash(image):
+    """
+    计算图像内容的哈希（基于像素数据，与编码格式无关）。
+    :param image: PIL 图像
+    :return: 十六进制哈希字符串
+    """
+    h = hashlib.sha256()
+    h.update(f"{image.mode}:{image.width}x{image.height}:".encode())
+    h.update(image.tobytes())
+    return h.hexdigest()
+
+
+def encoding_key(image_format, quality=None):
+    """
+    图片编码参数的标识, 作为缓存键的一部分: 同一页面以低质量 JPEG 识别的结果不应在要求 PNG 时复用。
+    PNG 是无损编码, 忽略 quality。
+    """
+    image_format = image_format.upper()
+    if image_format == 'JPG':
+        image_format = 'JPEG'
+    return image_format if image_format == 'PNG' or quality is None else f"{image_format}:{quality}"
+
+
+class OCRCache:
+    def __init__(self, db_path, max_bytes=512 * 1024 * 1024):
+        """
+        基于 SQLite 的 OCR 结果缓存，按内容寻址。
+        缓存键由页面组图像哈希、图片编码参数、提示词、模型、temperature 和 top_p 共同决定，任何一项变化都会重新 OCR。
+        :param db_path: SQLite 数据库文件路径
+        :param max_bytes: 缓存结果的总大小上限（字节），超出后按最近最少使用淘汰
+        """
+        self.db_path = db_path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.execute("CREATE TABLE IF NOT EXISTS ocr_cache ("
+                           "key TEXT PRIMARY KEY, result TEXT NOT NULL, size INTEGER NOT NULL, last_access REAL NOT NULL)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_ocr_cache_last_access ON ocr_cache(last_access)")
+        self._conn.commit()
+
+    @staticmethod
+    def make_key(image_digest, prompt, model, temperature, top_p, encoding=None):
+        """
+        :param encoding: 图片的编码参数, 见 encoding_key
+        """
+        key_parts = [image_digest, prompt, str(model), repr(float(temperature)), repr(float(top_p))]
+        if encoding is not None:
+            key_parts.append(encoding)
+        key_source = "\x1f".join(key_parts)
+        return hashlib.sha256(key_source.encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        """
+        查询缓存，命中时刷新访问时间。
+        :return: 缓存的 OCR 结果，未命中返回 None
+        """
+        with self._lock:
+            row = self._conn.execute("SELECT result FROM ocr_cache WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self._conn.execute("UPDATE ocr_cache SET last_access = ? WHERE key = ?", (time.time(), key))
+            self._conn.commit()
+            self.hits += 1
+            return row[0]
+
+    def put(self, key, result):
+        """
+        写入一条 OCR 结果，失败的结果不会被缓存。
+        """
+        if result is None or result.startswith(FAILED_PREFIX):
+            return
+        size = len(result.encode('utf-8'))
+        with self._lock:
+            self._conn.execute("INSERT OR REPLACE INTO ocr_cache (key, result, size, last_access) VALUES (?, ?, ?, ?)",
+                               (key, result, size, time.time()))
+            self.stores += 1
+            self._evict()
+            self._conn.commit()
+
+    def _evict(self):
+        total = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM ocr_cache").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        expired = []
+        for key, size in self._conn.execute("SELECT key, size FROM ocr_cache ORDER BY last_access"):
+            if total <= self.max_bytes:
+                break
+            expired.append((key,))
+            total -= size
+        self._conn.executemany("DELETE FROM ocr_cache WHERE key = ?", expired)
+        self.evictions += len(expired)
+
+    def summary(self):
+        lookups = self.hits + self.misses
+        hit_rate = self.hits / lookups * 100 if lookups else 0.0
+        return (f"OCR cache: {self.hits} hits, {self.misses} misses ({hit_rate:.1f}% hit rate), "
+                f"{self.stores} stored, {self.evictions} evicted")
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
@@ -0,0 +1,126 @@
+import json
+import os
+import threading
+
+from dependencies.ocr_cache import FAILED_PREFIX
+
+
+class OCRJournal:
+    def __init__(self, journal_path):
+        """
+        只追加写入的 OCR 进度日志（JSONL），每完成一个页面组就写入一行，进程中断后可以据此续跑。
+        每行格式: {"index": 组序号, "hash": 图像哈希, "first_page": 起始页, "last_page": 结束页, "result": OCR 结果}
+        :param journal_path: 日志文件路径
+        """
+        self.journal_path = journal_path
+        self._lock = threading.Lock()
+
+    def load(self):
+        """
+        读取日志中已成功完成的页面组，同一组出现多次时以最后一次为准。
+        失败的结果和因进程中断而写了一半的最后一行会被忽略。
+        :return: {组序号: 日志记录}
+        """
+        entries = {}
+        if not os.path.exists(self.journal_path):
+            return entries
+        with open(self.journal_path, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                if 'index' not in entry:
+                    continue    # record_skipped 写入的空白页记录
+                if entry['result'].startswith(FAILED_PREFIX):
+                    entries.pop(entry['index'], None)
+                else:
+                    entries[entry['index']] = entry
+        return entries
+
+    def append(self, index, digest, result, first_page=None, last_page=None):
+        entry = {"index": index, "hash": digest, "first_page": first_page, "last_page": last_page, "result": result}
+        with self._lock:
+            with open(self.journal_path, 'a', encoding='utf-8') as f:
+                f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+
+    def record_skipped(self, pages):
+        """
+        记录因空白而跳过 (没有发给模型、也没有写入结果) 的页码, 每行格式: {"skipped_pages": [页码, ...]}
+        """
+        if not pages:
+            return
+        with self._lock:
+            with open(self.journal_path, 'a', encoding='utf-8') as f:
+                f.write(json.dumps({"skipped_pages": sorted(pages)}) + "\n")
+
+    def reset(self):
+        with self._lock:
+            open(self.journal_path, 'w', encoding='utf-8').close()
+
+
+class OrderedResultWriter:
+    def __init__(self, output_file, journal=None):
+        """
+        按页面组序号顺序写出 OCR 结果：结果可以乱序到达，只要前面的组都已完成就立即写入文件。
+        流式输出的中间结果通过 partial 传入, 轮到该组时边生成边写入文件。
+        :param output_file: 已打开的输出文件对象
+        :param journal: 可选的 OCRJournal，新完成的结果会同时追加到日志
+        """
+        self.output_file = output_file
+        self.journal = journal
+        self.next_index = 0
+        self._pending = {}
+        self._partials = {}         # 组序号 -> 尚未写出的流式输出片段
+        self._streamed = []         # 当前组已经写入文件的流式输出
+        self._stream_start = None   # 当前组流式输出在文件中的起始位置
+        self._lock = threading.Lock()   # partial 会在工作线程中被调用
+
+    def partial(self, index, text):
+        """
+        流式输出的增量文本 (可直接作为 on_delta 回调)。轮到该组时立即追加到文件, 否则先缓存到前面的组写完。
+        """
+        with self._lock:
+            if index < self.next_index or index in self._pending:
+                return
+            self._partials.setdefault(index, []).append(text)
+            if index == self.next_index:
+                self._write_partial()
+
+    def _write_partial(self):
+        parts = self._partials.pop(self.next_index, None)
+        if not parts:
+            return
+        if self._stream_start is None:
+            self._stream_start = self.output_file.tell()
+        self.output_file.write("".join(parts))
+        self.output_file.flush()
+        self._streamed.extend(parts)
+
+    def add(self, index, result, digest=None, first_page=None, last_page=None, journal=True):
+        """
+        :param journal: 是否写入进度日志，从日志恢复的结果不需要重复写入
+        """
+        with self._lock:
+            if journal and self.journal is not None:
+                self.journal.append(index, digest, result, first_page, last_page)
+            self._pending[index] = result
+            while self.next_index in self._pending:
+                text = f"{self._pending.pop(self.next_index)}"
+                self._partials.pop(self.next_index, None)
+                if self._stream_start is not None:
+                    streamed = "".join(self._streamed)
+                    if text.startswith(streamed):
+                        text = text[len(streamed):]
+                    else:
+                        # 最终结果与已写出的流式输出不一致 (例如请求最终失败), 回到该组的起始位置重写
+                        self.output_file.seek(self._stream_start)
+                        self.output_file.truncate()
+                self.output_file.write(f"{text}\n")
+                self.output_file.flush()
+                self.next_index += 1
+                self._streamed, self._stream_start = [], None
+            # 下一组如果已经有流式输出, 现在轮到它了
+            self._write_partial()
@@ -1,34 +1,72 @@
 import fitz  # PyMuPDF
-import pdfplumber
 from PyPDF2 import PdfReader, PdfWriter
 from PIL import Image    #, ImageChops
 import numpy as np
 import os
-from pdf2image import convert_from_path
+from io import BytesIO
+import concurrent.futures
+import time
+from dependencies.text_layer import has_text_layer, page_to_markdown
+from dependencies.metrics import metrics
+
+def _page_margins(page, band_ratio=0.1):
+    """
+    根据文本块的包围盒估计单页的页眉/页脚高度。
+    最靠上的文本块若落在页面顶部 band_ratio 范围内则视为页眉，页脚同理。
+    :return: (页眉高度, 页脚高度)，单位为 PDF 点
+    """
+    page_height = page.rect.height
+    # block: (x0, y0, x1, y1, text, block_no, block_type)，block_type 为 0 表示文本块
+    blocks = [b for b in page.get_text("blocks") if b[6] == 0 and b[4].strip()]
+    if not blocks:
+        return 0, 0
 
-def auto_detect_margins(input_pdf):
-    doc = fitz.open(input_pdf)
     header_height = 0
+    top_block = min(blocks, key=lambda b: b[1])
+    if top_block[3] <= page_height * band_ratio:
+        header_height = max(0, top_block[3])
+
     footer_height = 0
+    bottom_block = max(blocks, key=lambda b: b[3])
+    if bottom_block[1] >= page_height * (1 - band_ratio):
+        footer_height = max(0, page_height - bottom_block[1])
+
+    return header_height, footer_height
 
-    for page_num in range(len(doc)):
-        page = doc.load_page(page_num)
-        text = page.get_text("text")
-        lines = text.split('\n')
 
-        # 使用pdfplumber加载页面，以获取页面尺寸
-        with pdfplumber.open(input_pdf) as pdf:
-            pdf_page = pdf.pages[page_num]
-            page_width = pdf_page.width
-            page_height = pdf_page.height
+def auto_detect_margins(input_pdf, sample_pages=None, aggregate='median', per_page=False, band_ratio=0.1):
+    """
+    单次打开文档，根据每页文本块的包围盒检测页眉和页脚高度。
+    :param input_pdf: PDF 路径
+    :param sample_pages: 只均匀抽取这么多页进行检测，None 表示检测全部页面（适合超大文件）
+    :param aggregate: 汇总方式，'max'、'median'，或 0-100 之间的数字表示百分位数。默认取中位数:
+                      少数页面的正文第一行落在页面顶部的 band_ratio 范围内时会被误判为页眉, 'max' 会按这些页面裁掉所有页面的正文
+    :param per_page: 为 True 时返回每页的页眉高度列表和页脚高度列表（按检测的页面顺序）
+    :param band_ratio: 页眉/页脚所在区域占页面高度的比例上限
+    :return: (页眉高度, 页脚高度)
+    """
+    with fitz.open(input_pdf) as doc:
+        page_count = len(doc)
+        if sample_pages and sample_pages < page_count:
+            page_numbers = np.unique(np.linspace(0, page_count - 1, sample_pages).round().astype(int))
+        else:
+            page_numbers = range(page_count)
 
-        # 假设页眉和页脚的文本在页面的前几行和最后几行
-        if len(lines) > 0:
-            header_height = max(header_height, page.search_for(lines[0])[0].y1 if page.search_for(lines[0]) else 0)
-        if len(lines) > 1:
-            footer_height = max(footer_height, page.search_for(lines[-1])[0].y1 if page.search_for(lines[-1]) else 0)
+        margins = [_page_margins(doc.load_page(int(page_num)), band_ratio) for page_num in page_numbers]
 
-    return header_height, footer_height
+    if not margins:
+        return ([], []) if per_page else (0, 0)
+
+    headers = np.array([m[0] for m in margins], dtype=float)
+    footers = np.array([m[1] for m in margins], dtype=float)
+    if per_page:
+        return headers.tolist(), footers.tolist()
+
+    if aggregate == 'max':
+        return float(headers.max()), float(footers.max())
+    if aggregate == 'median':
+        return float(np.median(headers)), float(np.median(footers))
+    return float(np.percentile(headers, aggregate)), float(np.percentile(footers, aggregate))
 
 def crop_pdf(input_path, output_path, top_margin=None, bottom_margin=None):
     if top_margin is None or bottom_margin is None:
@@ -70,18 +108,31 @@ def trim_left_right(im, margin=10):
         return im.crop((left, 0, right, im.height))
     return im
 
-def trim_top_bottom(im, margin=10):
-    
-    gray = im.convert('L')
-    
-    arr = np.array(gray)
-    
-    
+def row_content_profile(im):
+    """
+    按行计算灰度方差, 返回每一行是否有内容的布尔数组。
+    """
+    arr = np.asarray(im.convert('L'))
     row_variances = np.var(arr, axis=1)
-    
-    
     threshold = np.mean(row_variances) / 10  # 方差阈值, 低于会被认为是空白行
-    content_rows = np.where(row_variances > threshold)[0]
+    return row_variances > threshold
+
+
+def estimate_output_tokens(im, tokens_per_line=20):
+    """
+    根据行方差曲线估计 OCR 该图像会输出多少 token: 连续的内容行算作一行文字, 每行文字约 tokens_per_line 个 token。
+    :param tokens_per_line: 每行文字的 token 数, 默认按一行约 80 个英文字符估计
+    """
+    profile = row_content_profile(im)
+    if profile.size == 0:
+        return 0
+    text_lines = int(profile[0]) + np.count_nonzero(profile[1:] & ~profile[:-1])
+    return text_lines * tokens_per_line
+
+
+def trim_top_bottom(im, margin=10):
+    
+    content_rows = np.where(row_content_profile(im))[0]
     
     if len(content_rows) > 0:
         top = max(0, content_rows[0] - margin)
@@ -90,70 +141,466 @@ def trim_top_bottom(im, margin=10):
     return im
 
 
-def pdf_to_images(pdf_path, output_folder, images_per_long=2):
-    if not os.path.exists(output_folder):
-        os.makedirs(output_folder)
-    
-    images = convert_from_path(pdf_path, use_cropbox=True)
-    
-    # 裁剪每个图像的上下空白并更新 images 列表
-    for i in range(len(images)):
-        images[i] = trim_top_bottom(images[i]) 
-        # images[i] = trim_left_right(images[i])
-        
-    
-    image_paths = []
-    
-    for i in range(0, len(images), images_per_long):
-        max_width = max(img.width for img in images[i:i+images_per_long])
-        total_height = sum(img.height for img in images[i:i+images_per_long])
-        long_image = Image.new('RGB', (max_width, total_height))
-        
-        # 将指定数量的图片粘贴到长图上
-        current_height = 0
-        for j in range(images_per_long):
-            if i + j < len(images):
-                long_image.paste(images[i + j], (0, current_height))
-                current_height += images[i + j].height
-        
-        image_path = os.path.join(output_folder, f"{os.path.splitext(os.path.basename(pdf_path))[0]}_pages_{i + 1}-{min(i + images_per_long, len(images))}.png")
-        long_image.save(image_path, 'PNG')
-        image_paths.append(image_path)
-    
-    return image_paths
+def _runs(mask):
+    # 布尔数组中连续为 True 的区间 [(起点, 终点), ...], 终点不含
+    edges = np.flatnonzero(np.diff(np.concatenate(([0], mask.astype(np.int8), [0]))))
+    return list(zip(edges[::2].tolist(), edges[1::2].tolist()))
 
 
-def pdf_to_images(pdf_path, output_folder = None, images_per_long=1, save_to_disk=False):
+def _is_figure(block, min_height, max_gap_rows=0.05, min_fill=0.15):
+    # 正文的行与行之间有几乎没有墨迹的空隙行; 照片、底纹等图片区域几乎每一行都有大量墨迹
+    # 线条图的墨迹稀疏, 不会被判定为图片 (宁可多发给模型, 也不丢掉可能有文字的区域)
+    if block.shape[0] < min_height:
+        return False
+    row_fill = block.mean(axis=1)
+    return np.count_nonzero(row_fill < 0.02) < max_gap_rows * block.shape[0] and block.mean() > min_fill
+
+
+def _line_slack(block):
+    # 有墨迹的各行右端到区域右边界的空白, 取中位数并换算为区域宽度的比例
+    rows = block.any(axis=1)
+    if not rows.any():
+        return 1.0
+    slack = np.argmax(block[rows, ::-1], axis=1)
+    return float(np.median(slack)) / block.shape[1]
+
+
+def _column_fill(band, side):
+    # 列投影 (每一列有墨迹的行数) 的中位数, 除以该侧上下范围内整条横带有墨迹的行数
+    # 正文栏每一行都有文字, 中位数约为 0.2; 代码只有部分行带注释且行长不一, 两侧都明显更低
+    rows = np.flatnonzero(side.any(axis=1))
+    if rows.size == 0:
+        return 0.0
+    band_rows = np.count_nonzero(band[rows[0]:rows[-1] + 1].any(axis=1))
+    return float(np.median(side.sum(axis=0))) / band_rows
+
+
+def segment_page(im, min_gutter_ratio=0.02, min_column_ratio=0.2, min_column_height_ratio=0.2, max_line_slack=0.15,
+                 min_column_fill=0.14, min_gap_ratio=0.02, line_gap_ratio=0.008, min_figure_ratio=0.1, drop_figures=True,
+                 ink_contrast=64):
+    """
+    基于投影轮廓的版面分割 (递归 XY-cut): 在墨迹的列投影中寻找分栏的空白间隔, 在行投影中寻找段落间的大块空白,
+    把页面切成按阅读顺序 (先上后下, 同一横带内先左栏后右栏) 排列的文本区域, 并去掉大块的非文本区域 (照片、底纹)。
+    全部用 NumPy 的投影和游程计算, 200 DPI 的整页耗时在十毫秒级。
+    :param im: PIL 图像 (整页)
+    :param min_gutter_ratio: 分栏间隔的最小宽度 (占页宽的比例)
+    :param min_column_ratio: 每一栏的最小宽度 (占页宽的比例), 表格中较窄的列不会被当作分栏
+    :param min_column_height_ratio: 分栏的最小高度 (占页高的比例), 较矮的代码块、表格不会被当作分栏
+    :param max_line_slack: 间隔左侧各行右端空白的中位数上限 (占该栏宽度的比例)。正文的行会写到栏的右边界附近,
+                           代码和右侧注释之间的空白长短不一, 不会被当作分栏
+    :param min_column_fill: 不满足 max_line_slack 时 (非两端对齐的正文), 间隔两侧的列投影中位数都达到该比例
+                            (相对于横带有墨迹的行数) 也算分栏: 两侧都是逐行排满的文字栏, 而不是代码和稀疏的注释
+    :param min_gap_ratio: 横向切分所需的空白行高度 (占页高的比例), 大于段落间距, 避免两栏的段落空隙恰好对齐时把栏切成横带
+    :param line_gap_ratio: 判断图片时区域内再按该高度的空白细分, 图片与图注间距较小时也能分开
+    :param min_figure_ratio: 判定为图片的最小高度 (占页高的比例), 较矮的区域一律保留
+    :param drop_figures: 是否去掉判定为图片的区域
+    :param ink_contrast: 比背景 (灰度中位数) 暗多少才算墨迹, 与 page_ink_stats 相同
+    :return: [(left, top, right, bottom), ...], 阅读顺序的区域列表, 空白页为空列表
+    """
+    arr = np.asarray(im.convert('L'))
+    ink = arr < np.median(arr) - ink_contrast
+    height, width = ink.shape
+    min_gutter = max(1, int(width * min_gutter_ratio))
+    min_column = int(width * min_column_ratio)
+    min_column_height = int(height * min_column_height_ratio)
+    min_gap = max(1, int(height * min_gap_ratio))
+    line_gap = max(1, int(height * line_gap_ratio))
+    min_figure = int(height * min_figure_ratio)
+    boxes = []
+
+    def leaf(top, bottom, left, right):
+        block = ink[top:bottom, left:right]
+        if np.count_nonzero(block) < 20:
+            return      # 孤立的噪点
+        if not drop_figures:
+            boxes.append((left, top, right, bottom))
+            return
+        # 按较小的空白细分成若干块, 去掉其中的图片, 相邻的文本块合并为一个区域
+        rows = block.any(axis=1)
+        pieces = []
+        for start, end in _runs(rows):
+            if pieces and start - pieces[-1][1] < line_gap:
+                pieces[-1][1] = end
+            else:
+                pieces.append([start, end])
+        kept = None
+        for start, end in pieces:
+            if _is_figure(block[start:end], min_figure):
+                if kept is not None:
+                    boxes.append((left, top + kept[0], right, top + kept[1]))
+                kept = None
+            elif kept is None:
+                kept = [start, end]
+            else:
+                kept[1] = end
+        if kept is not None:
+            boxes.append((left, top + kept[0], right, top + kept[1]))
+
+    def cut(top, bottom, left, right):
+        block = ink[top:bottom, left:right]
+        rows = np.flatnonzero(block.any(axis=1))
+        cols = np.flatnonzero(block.any(axis=0))
+        if rows.size == 0:
+            return
+        # 收紧到有墨迹的范围
+        top, bottom = top + rows[0], top + rows[-1] + 1
+        left, right = left + cols[0], left + cols[-1] + 1
+        block = ink[top:bottom, left:right]
+
+        # 先按列切分: 两侧都足够宽的空白列间隔才是分栏
+        col_ink = block.any(axis=0)
+        splits = [left]
+        for start, end in _runs(~col_ink) if bottom - top >= min_column_height else []:
+            if end - start >= min_gutter and start >= min_column and right - left - end >= min_column \
+                    and left + start - splits[-1] >= min_column \
+                    and (_line_slack(block[:, splits[-1] - left:start]) <= max_line_slack
+                         or min(_column_fill(block, block[:, splits[-1] - left:start]),
+                                _column_fill(block, block[:, end:])) >= min_column_fill):
+                splits.extend([left + start, left + end])
+        if len(splits) > 1:
+            splits.append(right)
+            for column_left, column_right in zip(splits[::2], splits[1::2]):
+                cut(top, bottom, column_left, column_right)
+            return
+
+        # 再按行切分: 较高的空白行把区域分成上下几块
+        row_ink = block.any(axis=1)
+        gaps = [(start, end) for start, end in _runs(~row_ink) if end - start >= min_gap]
+        if gaps:
+            edges = [0] + [edge for gap in gaps for edge in gap] + [bottom - top]
+            for piece_top, piece_bottom in zip(edges[::2], edges[1::2]):
+                cut(top + piece_top, top + piece_bottom, left, right)
+            return
+        leaf(top, bottom, left, right)
+
+    cut(0, height, 0, width)
+    return boxes
+
+
+def layout_crop(im, margin=10, spacing=20, **kwargs):
+    """
+    按 segment_page 的结果裁剪页面, 并把各区域按阅读顺序自上而下拼成一张窄图 (双栏页面变成先左栏后右栏),
+    去掉左右页边距和图片区域, 发给模型的像素更少, 阅读顺序也不会混乱。
+    :param margin: 每个区域四周保留的空白像素
+    :param spacing: 区域之间的空白像素
+    :param kwargs: 传给 segment_page 的参数
+    :return: PIL 图像; 没有找到任何区域时返回 trim_top_bottom 的结果
+    """
+    boxes = segment_page(im, **kwargs)
+    if not boxes:
+        return trim_top_bottom(im, margin)
+    regions = [im.crop((max(0, left - margin), max(0, top - margin), min(im.width, right + margin), min(im.height, bottom + margin)))
+               for left, top, right, bottom in boxes]
+    if len(regions) == 1:
+        return regions[0]
+    canvas = Image.new(im.mode, (max(region.width for region in regions),
+                                 sum(region.height for region in regions) + spacing * (len(regions) - 1)), 'white')
+    y = 0
+    for region in regions:
+        canvas.paste(region, (0, y))
+        y += region.height + spacing
+    return canvas
+
+
+def page_ink_stats(im, sample_step=2, ink_contrast=64):
+    """
+    计算页面的内容密度: 比背景 (灰度中位数) 暗 ink_contrast 以上的像素所占比例, 以及含有这类像素的行所占比例。
+    全部用 NumPy 向量化计算, 并按 sample_step 隔行隔列采样, 单页耗时在毫秒级。
+    :param im: PIL 图像 (裁剪空白之前的整页)
+    :return: (墨迹像素比例, 墨迹行比例), 均在 0~1 之间
+    """
+    arr = np.asarray(im.convert('L'))[::sample_step, ::sample_step]
+    if arr.size == 0:
+        return 0.0, 0.0
+    ink = arr < np.median(arr) - ink_contrast
+    return np.count_nonzero(ink) / ink.size, np.count_nonzero(ink.any(axis=1)) / ink.shape[0]
+
+
+def is_blank_page(im, max_ink_ratio=0.00002, max_ink_rows=0.002):
+    """
+    判断页面图像是否空白 (只有扫描噪点或一两个孤立的点)。两个比例都与渲染分辨率无关。
+    只有一个短词的页面也必须保留: "12" (8pt) 的墨迹约占 0.003%、"x = 1;" 约 0.007%、"Part II" (14pt) 约 0.025%,
+    墨迹行约占 0.7%~1.3%, 因此阈值取得很低, 且两个条件同时满足才视为空白。
+    必须在 trim_top_bottom 之前判断, 否则只有页码的页面会被裁剪成只剩页码的一小条。
+    """
+    ink_ratio, ink_rows = page_ink_stats(im)
+    return ink_ratio < max_ink_ratio and ink_rows < max_ink_rows
+
+
+def stitch_images(images):
+    """
+    将多张图片自上而下拼接成一张长图。
+    :param images: PIL 图像列表
+    :return: 拼接后的长图
+    """
+    max_width = max(img.width for img in images)
+    total_height = sum(img.height for img in images)
+    long_image = Image.new('RGB', (max_width, total_height))
+
+    current_height = 0
+    for img in images:
+        long_image.paste(img, (0, current_height))
+        current_height += img.height
+    return long_image
+
+
+def page_clip_rect(page, top_margin=0, bottom_margin=0):
+    """
+    计算裁掉上下边距后的区域（页面坐标）。
+    边距与 auto_detect_margins 的结果一致, 是相对于 page.rect (即 CropBox 可见区域) 的高度, 直接从 page.rect 上下裁掉,
+    不再像 crop_pdf 那样按 MediaBox 换算。
+    :return: fitz.Rect
+    """
+    rect = page.rect
+    top_cut = max(0, top_margin or 0)
+    bottom_cut = max(0, bottom_margin or 0)
+    return fitz.Rect(rect.x0, rect.y0 + top_cut, rect.x1, max(rect.y0 + top_cut, rect.y1 - bottom_cut))
+
+
+def render_page(page, top_margin=0, bottom_margin=0, dpi=200):
+    """
+    直接从原始 PDF 页面渲染裁剪后的区域，不需要生成中间 PDF。
+    :param dpi: 渲染分辨率，默认为 200
+    :return: PIL RGB 图像
+    """
+    clip = page_clip_rect(page, top_margin, bottom_margin)
+    pix = page.get_pixmap(dpi=dpi, clip=clip, alpha=False)
+    return Image.frombytes("RGB", (pix.width, pix.height), pix.samples)
+
+
+def _prepare_page(page, top_margin=0, bottom_margin=0, dpi=200, blank_ink_ratio=None, text_layer=False, timings=None, layout=False):
+    # 渲染一页并裁剪空白, 空白页返回 None, 文本层可用的页面直接返回 Markdown 字符串 (不渲染)
+    # layout 为 True 时按版面分割 (layout_crop), 只保留文本区域并把多栏按阅读顺序排成一栏
+    # timings 为列表时追加各步骤的 (阶段, 秒数), 由调用方汇总到 metrics (子进程中记录的指标不会回到主进程)
+    timings = timings if timings is not None else []
+    start = time.perf_counter()
+    if text_layer:
+        clip = page_clip_rect(page, top_margin, bottom_margin)
+        if has_text_layer(page, clip):
+            markdown = page_to_markdown(page, clip)
+            timings.append(('text_layer', time.perf_counter() - start))
+            return markdown
+    image = render_page(page, top_margin, bottom_margin, dpi)
+    rendered = time.perf_counter()
+    timings.append(('render', rendered - start))
+    # 文本层中有任何字符的页面都不算空白 (图像几乎空白时文本可能是极小的字号或浅色文字)
+    if blank_ink_ratio is not None and is_blank_page(image, blank_ink_ratio) \
+            and not page.get_text("text", clip=page_clip_rect(page, top_margin, bottom_margin)).strip():
+        timings.append(('trim', time.perf_counter() - rendered))
+        return None
+    if layout:
+        image = layout_crop(image)
+        timings.append(('layout', time.perf_counter() - rendered))
+        return image
+    image = trim_top_bottom(image)
+    # image = trim_left_right(image)
+    timings.append(('trim', time.perf_counter() - rendered))
+    return image
+
+
+def _record_timings(timings):
+    for stage, seconds in timings:
+        metrics.record(stage, seconds)
+
+
+def _render_page_range(pdf_path, first_page, last_page, top_margin=0, bottom_margin=0, dpi=200, blank_ink_ratio=None, text_layer=False,
+                       layout=False):
+    """
+    在子进程中渲染并裁剪一段连续页面。
+    为了减少进程间传输的开销，返回原始像素缓冲区而不是 PIL 对象。
+    :return: [(页码, (宽, 高), RGB 字节, 各步骤耗时), ...]，空白页为 (页码, None, None, 耗时)，
+             从文本层提取的页面为 (页码, None, Markdown, 耗时)
+    """
+    pages = []
+    with fitz.open(pdf_path) as doc:
+        for page_num in range(first_page, last_page + 1):
+            timings = []
+            image = _prepare_page(doc.load_page(page_num - 1), top_margin, bottom_margin, dpi, blank_ink_ratio, text_layer, timings, layout)
+            if image is None or isinstance(image, str):
+                pages.append((page_num, None, image, timings))
+            else:
+                pages.append((page_num, image.size, image.tobytes(), timings))
+    return pages
+
+
+def iter_page_images(pdf_path, top_margin=0, bottom_margin=0, dpi=200, render_workers=1, pages_per_task=4, blank_ink_ratio=None, text_layer=False,
+                     layout=False):
+    """
+    按页码顺序逐页产出渲染并裁剪好空白的页面图像（生成器）。
+    render_workers > 1 时把文档按页码区间切分，交给进程池并行渲染和裁剪，产出顺序仍与页码一致。
+    同时提交的区间数量不超过 render_workers 的两倍，避免渲染速度远快于消费速度时占用过多内存。
+    :param render_workers: 渲染进程数，1 表示在当前进程内渲染
+    :param pages_per_task: 每个子进程任务渲染的页数
+    :param blank_ink_ratio: 设置后内容密度低于该值的页面视为空白页（见 is_blank_page），产出的图像为 None
+    :param text_layer: 是否启用文本层快速通道，文本层可用的页面不渲染，产出的是从文本层生成的 Markdown 字符串
+    :param layout: 是否按版面分割页面 (见 layout_crop)，去掉非文本区域，多栏页面按阅读顺序排成一栏
+    :return: 依次产出 (页码, 图像)，页码从 1 开始
+    """
+    with fitz.open(pdf_path) as doc:
+        page_count = len(doc)
+
+        if render_workers <= 1:
+            for page_num in range(1, page_count + 1):
+                timings = []
+                image = _prepare_page(doc.load_page(page_num - 1), top_margin, bottom_margin, dpi, blank_ink_ratio, text_layer, timings, layout)
+                _record_timings(timings)
+                yield page_num, image
+            return
+
+    ranges = [(first_page, min(first_page + pages_per_task - 1, page_count))
+              for first_page in range(1, page_count + 1, pages_per_task)]
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=render_workers) as executor:
+        pending = []
+        next_range = 0
+        while next_range < len(ranges) or pending:
+            # 保持固定数量的区间在途，按提交顺序取结果以保证页码顺序
+            while next_range < len(ranges) and len(pending) < render_workers * 2:
+                first_page, last_page = ranges[next_range]
+                pending.append(executor.submit(_render_page_range, pdf_path, first_page, last_page, top_margin, bottom_margin, dpi,
+                                               blank_ink_ratio, text_layer, layout))
+                next_range += 1
+            for page_num, size, data, timings in pending.pop(0).result():
+                _record_timings(timings)
+                yield page_num, data if size is None else Image.frombytes("RGB", size, data)
+
+
+def iter_long_images(pdf_path, output_folder=None, images_per_long=1, save_to_disk=False,
+                     top_margin=0, bottom_margin=0, dpi=200, render_workers=1, skip_blank=False, blank_ink_ratio=0.00002, skipped_pages=None,
+                     text_layer=False, max_pixels=None, max_output_tokens=None, group_sizes=None, layout=False, max_long_edge=None):
+    """
+    按组逐步渲染 PDF 页面并拼接成长图（生成器）。
+    每次只渲染 images_per_long 页，内存中只保留当前这一组，调用方可以边渲染边上传/OCR。
+    页面直接在进程内用 PyMuPDF 按裁剪区域 (page_clip_rect) 渲染，不需要生成中间 PDF。
+    :param pdf_path: PDF 路径
+    :param output_folder: 保存长图的目录（save_to_disk=True 时使用）
+    :param images_per_long: 每张长图包含的页数；设置了 max_pixels 或 max_output_tokens 时为每张长图的最多页数
+    :param save_to_disk: 是否将长图保存到本地
+    :param top_margin: 顶部裁剪的边距（PDF 点），相对于页面可见区域, 与 auto_detect_margins 的结果含义相同
+    :param bottom_margin: 底部裁剪的边距（PDF 点）
+    :param dpi: 渲染分辨率
+    :param render_workers: 渲染和裁剪使用的进程数，见 iter_page_images
+    :param skip_blank: 是否跳过空白页。空白页不占用长图的名额, 每组仍凑满 images_per_long 张有内容的页面
+    :param blank_ink_ratio: 空白页的内容密度阈值，见 is_blank_page
+    :param skipped_pages: 可选的列表，被跳过的空白页页码会追加到其中
+    :param text_layer: 是否启用文本层快速通道。文本层可用的页面单独成组，长图的位置是已生成的 Markdown 字符串，
+                       不需要上传和 OCR；当前组在这类页面处提前结束，以保证结果顺序与页码一致
+    :param max_pixels: 每张长图的像素上限（宽 × 高），内容稀疏、裁剪后较矮的页面可以多拼几页
+    :param max_output_tokens: 每张长图预计输出 token 数的上限（见 estimate_output_tokens），避免内容密集时输出被截断
+    :param group_sizes: 可选的列表，每张长图包含的页数会追加到其中
+    :param layout: 是否按版面分割页面，见 iter_page_images
+    :param max_long_edge: 拼接前将每一页的长边缩小到该像素数以内, None 表示不缩放。
+                          按页缩放而不是缩放整张长图, 多页拼接时每页的宽度 (文字大小) 不会随页数减小
+    :return: 依次产出 (组序号, 起始页码, 结束页码, 长图或 Markdown 字符串)，页码从 1 开始
+    """
     if save_to_disk and not os.path.exists(output_folder):
         os.makedirs(output_folder)
-    
-    images = convert_from_path(pdf_path, use_cropbox=True)
-    
-    # 裁剪每个图像的上下空白
-    for i in range(len(images)):
-        images[i] = trim_top_bottom(images[i]) 
-        # images[i] = trim_left_right(images[i])
-    
-    long_images = []  # 用于存储长图像对象
-    
-    for i in range(0, len(images), images_per_long):
-        max_width = max(img.width for img in images[i:i+images_per_long])
-        total_height = sum(img.height for img in images[i:i+images_per_long])
-        long_image = Image.new('RGB', (max_width, total_height))
-        
-        # 将指定数量的图片粘贴到长图上
-        current_height = 0
-        for j in range(images_per_long):
-            if i + j < len(images):
-                long_image.paste(images[i + j], (0, current_height))
-                current_height += images[i + j].height
-        
+
+    def emit(group_index, group):
+        first_page, last_page = group[0][0], group[-1][0]
+        with metrics.timer('stitch'):
+            long_image = stitch_images([image for _, image in group])
+        if group_sizes is not None:
+            group_sizes.append(len(group))
+
         # 如果需要保存到本地
         if save_to_disk:
-            image_path = os.path.join(output_folder, f"{os.path.splitext(os.path.basename(pdf_path))[0]}_pages_{i + 1}-{min(i + images_per_long, len(images))}.png")
+            image_path = os.path.join(output_folder, f"{os.path.splitext(os.path.basename(pdf_path))[0]}_pages_{first_page}-{last_page}.png")
             long_image.save(image_path, 'PNG')
-        long_images.append(long_image)
-    
-    return long_images
+        return group_index, first_page, last_page, long_image
+
+    def over_budget(group, image, tokens):
+        # 加入这一页之后是否会超出像素或 token 预算
+        if max_pixels is not None:
+            width = max([image.width] + [img.width for _, img in group])
+            height = image.height + sum(img.height for _, img in group)
+            if width * height > max_pixels:
+                return True
+        return max_output_tokens is not None and group_tokens + tokens > max_output_tokens
+
+    group, group_index, group_tokens = [], 0, 0
+    for page_num, image in iter_page_images(pdf_path, top_margin, bottom_margin, dpi, render_workers,
+                                            blank_ink_ratio=blank_ink_ratio if skip_blank else None, text_layer=text_layer, layout=layout):
+        if image is None:
+            if skipped_pages is not None:
+                skipped_pages.append(page_num)
+            continue
+        if isinstance(image, str):
+            if group:
+                yield emit(group_index, group)
+                group, group_index, group_tokens = [], group_index + 1, 0
+            yield group_index, page_num, page_num, image
+            group_index += 1
+            continue
+        if max_long_edge:
+            with metrics.timer('prepare'):
+                image = prepare_image(image, max_long_edge)
+
+        tokens = estimate_output_tokens(image) if max_output_tokens is not None else 0
+        if group and over_budget(group, image, tokens):
+            yield emit(group_index, group)
+            group, group_index, group_tokens = [], group_index + 1, 0
+        group.append((page_num, image))
+        group_tokens += tokens
+        if len(group) == images_per_long:
+            yield emit(group_index, group)
+            group, group_index, group_tokens = [], group_index + 1, 0
+    if group:
+        yield emit(group_index, group)
+
 
+IMAGE_MIME_TYPES = {'PNG': 'image/png', 'JPEG': 'image/jpeg', 'WEBP': 'image/webp'}
+IMAGE_EXTENSIONS = {'PNG': 'png', 'JPEG': 'jpg', 'WEBP': 'webp'}
+
+
+def prepare_image(image, max_long_edge=None, color_mode=None, threshold=160):
+    """
+    上传前的图像预处理: 缩小分辨率并转换颜色模式, 减少上传和模型下载的数据量。
+    视觉模型本身会把大图缩小到约 1500 像素的长边, 过高的分辨率只会增加传输量。
+    :param max_long_edge: 长边的像素上限, None 表示不缩放
+    :param color_mode: None/'RGB' 保持彩色, 'L' 灰度, '1' 黑白二值 (适合纯文字页面, PNG 编码时体积最小)
+    :param threshold: 二值化的灰度阈值, 高于该值为白色
+    :return: 处理后的 PIL 图像
+    """
+    if max_long_edge and max(image.size) > max_long_edge:
+        scale = max_long_edge / max(image.size)
+        image = image.resize((max(1, round(image.width * scale)), max(1, round(image.height * scale))), Image.LANCZOS)
+    if color_mode == 'L':
+        image = image.convert('L')
+    elif color_mode == '1':
+        image = image.convert('L').point(lambda p: 255 if p > threshold else 0, mode='1')
+    return image
+
+
+def normalize_image_format(image_format):
+    image_format = image_format.upper()
+    if image_format == 'JPG':
+        image_format = 'JPEG'
+    if image_format not in IMAGE_MIME_TYPES:
+        raise ValueError(f"Unsupported image format: {image_format}")
+    return image_format
+
+
+def encode_image(image, image_format='PNG', quality=None):
+    """
+    将图像编码为指定格式的字节串。
+    :param image_format: 'PNG'、'JPEG' 或 'WEBP'
+    :param quality: JPEG/WEBP 的压缩质量（1-100），PNG 忽略该参数
+    :return: (字节串, MIME 类型)
+    """
+    image_format = normalize_image_format(image_format)
+    if image.mode == '1' and image_format != 'PNG':
+        # JPEG/WEBP 不支持二值图像
+        image = image.convert('L')
+
+    params = {}
+    if quality is not None and image_format != 'PNG':
+        params['quality'] = quality
+    buffer = BytesIO()
+    image.save(buffer, format=image_format, **params)
+    return buffer.getvalue(), IMAGE_MIME_TYPES[image_format]
+
+
+def pdf_to_images(pdf_path, output_folder = None, images_per_long=1, save_to_disk=False):
+    return [long_image for _, _, _, long_image in iter_long_images(pdf_path, output_folder, images_per_long, save_to_disk)]
 
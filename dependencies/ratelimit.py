@@ -0,0 +1,222 @@
+import asyncio
+import random
+import threading
+import time
+from email.utils import parsedate_to_datetime
+
+import requests
+
+# 这些状态码表示服务端暂时不可用或限流, 可以重试; 其余 4xx (如 400/401/403/404) 重试也不会成功
+RETRYABLE_STATUS_CODES = {408, 409, 425, 429, 500, 502, 503, 504, 529}
+
+
+class RetryError(Exception):
+    """重试次数用尽后抛出, 原始异常保存在 __cause__ 中。"""
+
+
+def parse_retry_after(headers):
+    """
+    解析 Retry-After 响应头, 支持秒数和 HTTP 日期两种格式。
+    :return: 需要等待的秒数, 没有该响应头时返回 None
+    """
+    if not headers:
+        return None
+    value = headers.get('Retry-After') or headers.get('retry-after')
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def classify_error(exc):
+    """
+    判断请求异常是否值得重试。
+    RetryError 表示内层 (Chat_Retry) 的重试已经用尽, 一律不再重试, 避免外层循环再跑一遍内层的全部重试 (5×5 次);
+    是否被限流和 Retry-After 仍按原始异常判断。
+    :return: (是否可以重试, 是否被限流, Retry-After 秒数或 None)
+    """
+    if isinstance(exc, RetryError):
+        _, throttled, retry_after = classify_error(exc.__cause__) if exc.__cause__ is not None else (False, False, None)
+        return False, throttled, retry_after
+
+    # 其他包装异常按原始异常判断
+    while not isinstance(exc, requests.exceptions.RequestException) and exc.__cause__ is not None:
+        exc = exc.__cause__
+
+    if isinstance(exc, requests.exceptions.HTTPError) and exc.response is not None:
+        status = exc.response.status_code
+        retry_after = parse_retry_after(exc.response.headers)
+        return status in RETRYABLE_STATUS_CODES, status == 429, retry_after
+    if isinstance(exc, requests.exceptions.RequestException):
+        # 超时、连接断开等网络错误
+        return True, False, None
+    if isinstance(exc, (KeyError, IndexError)):
+        # 网关返回了不完整的响应体
+        return True, False, None
+    return False, False, None
+
+
+def backoff_delay(attempt, base_delay=1.0, max_delay=60.0):
+    """
+    带随机抖动的指数退避 (full jitter), 避免多个线程在同一时刻集中重试。
+    :param attempt: 已失败的次数, 从 0 开始
+    """
+    return random.uniform(0, min(max_delay, base_delay * (2 ** attempt)))
+
+
+def estimate_tokens(prompt, img_url=None, image_tokens=1500):
+    """
+    粗略估计一次请求消耗的输入 token 数, 用于 tokens/min 限流。
+    英文约 4 个字符一个 token, 中文约 1 个字符一个 token, 这里按 3 个字符折中估计。
+    """
+    return len(prompt) // 3 + (image_tokens if img_url else 0)
+
+
+class TokenBucket:
+    def __init__(self, rate_per_minute):
+        """
+        令牌桶, 容量为一分钟的配额, 按速率持续补充。
+        """
+        self.capacity = float(rate_per_minute)
+        self.rate = rate_per_minute / 60.0
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def reserve(self, amount, now):
+        """
+        预占 amount 个令牌 (允许透支), 返回需要等待多久之后才能真正使用。调用方需自行加锁。
+        """
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        amount = min(amount, self.capacity)
+        self.tokens -= amount
+        return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+
+class RateLimiter:
+    def __init__(self, requests_per_minute=None, tokens_per_minute=None):
+        """
+        同时限制每分钟请求数和每分钟 token 数, 同一模型的所有线程/协程共享。
+        :param requests_per_minute: 每分钟请求数上限, None 表示不限制
+        :param tokens_per_minute: 每分钟 token 数上限, None 表示不限制
+        """
+        self.request_bucket = TokenBucket(requests_per_minute) if requests_per_minute else None
+        self.token_bucket = TokenBucket(tokens_per_minute) if tokens_per_minute else None
+        self.paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def _reserve(self, tokens):
+        with self._lock:
+            now = time.monotonic()
+            delay = max(0.0, self.paused_until - now)
+            if self.request_bucket is not None:
+                delay = max(delay, self.request_bucket.reserve(1, now))
+            if self.token_bucket is not None and tokens:
+                delay = max(delay, self.token_bucket.reserve(tokens, now))
+            return delay
+
+    def acquire(self, tokens=0):
+        """
+        阻塞直到配额允许发出一次消耗 tokens 个 token 的请求。
+        """
+        delay = self._reserve(tokens)
+        if delay > 0:
+            time.sleep(delay)
+
+    async def acquire_async(self, tokens=0):
+        delay = self._reserve(tokens)
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    def pause(self, seconds):
+        """
+        收到 429 和 Retry-After 后, 让所有共享该限流器的请求都暂停 seconds 秒。
+        """
+        with self._lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+
+_rate_limiters = {}
+_rate_limiters_lock = threading.Lock()
+
+
+def get_rate_limiter(model, requests_per_minute=None, tokens_per_minute=None):
+    """
+    按模型名称获取共享的 RateLimiter, 第一次调用时按给定的配额创建。
+    """
+    with _rate_limiters_lock:
+        if model not in _rate_limiters:
+            _rate_limiters[model] = RateLimiter(requests_per_minute, tokens_per_minute)
+        return _rate_limiters[model]
+
+
+class ConcurrencyController:
+    def __init__(self, initial=2, min_concurrency=1, max_concurrency=16, latency_target=None, cooldown=5.0):
+        """
+        AIMD (加性增、乘性减) 并发控制器。
+        每个成功的请求使并发上限增加 1/当前上限 (约每一轮增加 1); 遇到 429 或延迟超过 latency_target 时上限减半。
+        同一个 cooldown 时间窗内只减半一次, 避免同一批并发请求同时收到 429 时把上限一路降到最低。
+        :param initial: 初始并发数
+        :param min_concurrency: 并发下限
+        :param max_concurrency: 并发上限, 通常等于线程池的 max_workers
+        :param latency_target: 可选的目标延迟（秒）, 超过时视为拥塞
+        :param cooldown: 两次减半之间的最小间隔（秒）
+        """
+        self.limit = float(initial)
+        self.min_concurrency = min_concurrency
+        self.max_concurrency = max_concurrency
+        self.latency_target = latency_target
+        self.cooldown = cooldown
+        self.in_flight = 0
+        self.throttled = 0
+        self._last_decrease = 0.0
+        self._condition = threading.Condition()
+
+    def _try_acquire(self):
+        with self._condition:
+            if self.in_flight < int(self.limit):
+                self.in_flight += 1
+                return True
+            return False
+
+    def acquire(self):
+        with self._condition:
+            while self.in_flight >= int(self.limit):
+                self._condition.wait()
+            self.in_flight += 1
+
+    async def acquire_async(self):
+        while not self._try_acquire():
+            await asyncio.sleep(0.05)
+
+    def release(self):
+        with self._condition:
+            self.in_flight -= 1
+            self._condition.notify_all()
+
+    def on_success(self, latency=None):
+        if self.latency_target is not None and latency is not None and latency > self.latency_target:
+            self._decrease()
+            return
+        with self._condition:
+            self.limit = min(self.max_concurrency, self.limit + 1.0 / self.limit)
+            self._condition.notify_all()
+
+    def on_throttle(self):
+        with self._condition:
+            self.throttled += 1
+        self._decrease()
+
+    def _decrease(self):
+        with self._condition:
+            now = time.monotonic()
+            if now - self._last_decrease < self.cooldown:
+                return
+            self._last_decrease = now
+            self.limit = max(self.min_concurrency, self.limit / 2)
@@ -0,0 +1,209 @@
+import re
+import unicodedata
+from collections import Counter
+
+# 与 PROMPT 第 4 条规则一致: 以 w, w.x, w.x.y ... 开头的单独短行是标题, 编号段数即标题级别
+# 加上 # 之后正好匹配 split_string 中带编号标题的正则 ^(#+\s+\d+(\.\d+)*\.?\s+.*)
+_NUMBERED_HEADING = re.compile(r'^(\d+(?:\.\d+)*)\.?\s+\S.{0,80}$')
+# 代码行的特征: 以 ; { } 结尾 (后面可以跟行尾注释), 或是注释/预处理指令
+_CODE_LINE = re.compile(r'([;{}]\s*(//.*)?$)|(^\s*(//|/\*|#include|#define))')
+_MONOSPACE_FONTS = ('mono', 'courier', 'consolas', 'menlo', 'code')
+_LIGATURES = str.maketrans({'ﬀ': 'ff', 'ﬁ': 'fi', 'ﬂ': 'fl', 'ﬃ': 'ffi', 'ﬄ': 'ffl', 'ﬅ': 'st', 'ﬆ': 'st'})
+
+FONT_FLAG_BOLD = 16
+FONT_FLAG_MONOSPACE = 8
+
+
+def _rect_area(bbox):
+    return max(0.0, bbox[2] - bbox[0]) * max(0.0, bbox[3] - bbox[1])
+
+
+def _clipped_area(bbox, clip):
+    return _rect_area((max(bbox[0], clip.x0), max(bbox[1], clip.y0), min(bbox[2], clip.x1), min(bbox[3], clip.y1)))
+
+
+def text_layer_stats(page, clip=None):
+    """
+    统计页面内嵌文本层的质量。
+    :param page: fitz.Page
+    :param clip: 只统计该区域内的内容 (通常是去掉页眉页脚后的区域), None 表示整页
+    :return: dict(chars=非空白字符数, coverage=文本块面积占比, bad_ratio=乱码字符占比, image_ratio=图片面积占比)
+    """
+    clip = clip if clip is not None else page.rect
+    clip_area = _rect_area(tuple(clip)) or 1.0
+
+    text = page.get_text("text", clip=clip)
+    chars = [c for c in text if not c.isspace()]
+    # U+FFFD、私有区、未分配和控制字符通常意味着字体没有 ToUnicode 映射, 提取出来的是乱码
+    bad = sum(1 for c in chars if c == '�' or unicodedata.category(c) in ('Co', 'Cn', 'Cc'))
+
+    blocks = page.get_text("blocks", clip=clip)
+    coverage = sum(_clipped_area(block[:4], clip) for block in blocks if block[6] == 0) / clip_area
+    image_ratio = sum(_clipped_area(info['bbox'], clip) for info in page.get_image_info()) / clip_area
+
+    return {
+        'chars': len(chars),
+        'coverage': coverage,
+        'bad_ratio': bad / len(chars) if chars else 1.0,
+        'image_ratio': min(1.0, image_ratio),
+    }
+
+
+def has_text_layer(page, clip=None, min_chars=50, min_coverage=0.02, max_bad_ratio=0.02, max_image_ratio=0.3, allow_listings=False):
+    """
+    判断页面是否有可直接使用的文本层 (原生数字 PDF)。
+    扫描件即使带有 OCR 文字层, 也会因为整页图片的面积占比过高而交给视觉模型处理。
+    :param min_chars: 文本层至少包含的字符数
+    :param min_coverage: 文本块至少覆盖的面积比例
+    :param max_bad_ratio: 乱码字符比例上限
+    :param max_image_ratio: 图片面积比例上限, 图片较多的页面 (截图、插图中的文字) 仍交给视觉模型
+    :param allow_listings: 为 False 时含有代码或多行短行块 (语法、公式、列表) 的页面交给视觉模型, 见 has_listing_blocks
+    """
+    stats = text_layer_stats(page, clip)
+    return (stats['chars'] >= min_chars and stats['coverage'] >= min_coverage
+            and stats['bad_ratio'] <= max_bad_ratio and stats['image_ratio'] <= max_image_ratio
+            and (allow_listings or not has_listing_blocks(page, clip)))
+
+
+def _is_monospace(span):
+    return span['flags'] & FONT_FLAG_MONOSPACE or any(name in span['font'].lower() for name in _MONOSPACE_FONTS)
+
+
+def _line_text(line):
+    return "".join(span['text'] for span in line['spans']).translate(_LIGATURES)
+
+
+def _rows(lines):
+    """
+    PyMuPDF 有时会把同一基线上的内容 (如代码和行尾注释) 拆成两个 line, 这里按垂直方向的重叠重新合并成行。
+    :return: [(行的 bbox, 行文本, 字号), ...]
+    """
+    groups = []
+    for line in sorted(lines, key=lambda line: (line['bbox'][1] + line['bbox'][3]) / 2):
+        x0, y0, x1, y1 = line['bbox']
+        if groups:
+            gy0, gy1 = groups[-1][0]
+            if min(y1, gy1) - max(y0, gy0) >= 0.5 * min(y1 - y0, gy1 - gy0):
+                groups[-1][0] = (min(y0, gy0), max(y1, gy1))
+                groups[-1][1].append(line)
+                continue
+        groups.append([(y0, y1), [line]])
+
+    rows = []
+    for (y0, y1), group in groups:
+        group.sort(key=lambda line: line['bbox'][0])
+        size = max(span['size'] for line in group for span in line['spans'])
+        text, right = "", None
+        for line in group:
+            if right is not None:
+                text = text.rstrip() + " " * max(1, int(round((line['bbox'][0] - right) / (0.55 * size))))
+            text += _line_text(line) if right is None else _line_text(line).lstrip()
+            right = line['bbox'][2]
+        rows.append(((group[0]['bbox'][0], y0, right, y1), text, size))
+    return rows
+
+
+def _body_font(blocks):
+    # 页面中字符数最多的字体视为正文字体, 书籍中的代码常用与正文不同的非等宽字体 (如 Helvetica)
+    counts = Counter(span['font'] for block in blocks if block['type'] == 0
+                     for line in block['lines'] for span in line['spans'] for c in span['text'] if not c.isspace())
+    return counts.most_common(1)[0][0] if counts else None
+
+
+def _block_rows(block):
+    lines = [line for line in block['lines'] if _line_text(line).strip()]
+    spans = [span for line in lines for span in line['spans'] if span['text'].strip()]
+    return (_rows(lines) if lines else []), spans
+
+
+def _is_code(rows, spans, body_font):
+    # 等宽字体; 或有代码特征的行且完全不使用正文字体 (单行的 "struct Token {" 也算); 或多数行具有代码特征
+    code_lines = sum(1 for _, text, _ in rows if _CODE_LINE.search(text))
+    return (all(_is_monospace(span) for span in spans)
+            or (code_lines and all(span['font'] != body_font for span in spans))
+            or code_lines * 2 >= len(rows) > 1)
+
+
+def has_listing_blocks(page, clip=None, max_row_ratio=0.6):
+    """
+    页面中是否有文本层难以还原的块: 代码块, 或每一行都明显短于正文行宽的多行块 (语法、公式、输入输出示例)。
+    这类块在文本层中常被拆散或合并成段落, 交给视觉模型更可靠。
+    :param max_row_ratio: 行宽低于正文最大行宽的该比例时视为短行
+    """
+    blocks = page.get_text("dict", clip=clip if clip is not None else page.rect, sort=True)['blocks']
+    body_font = _body_font(blocks)
+    parsed = [_block_rows(block) for block in blocks if block['type'] == 0]
+    widths = [bbox[2] - bbox[0] for rows, _ in parsed for bbox, _, _ in rows]
+    if not widths:
+        return False
+    max_width = max(widths)
+    for rows, spans in parsed:
+        if rows and _is_code(rows, spans, body_font):
+            return True
+        if len(rows) > 1 and all(bbox[2] - bbox[0] < max_row_ratio * max_width for bbox, _, _ in rows):
+            return True
+    return False
+
+
+def _block_to_markdown(block, body_font=None):
+    """
+    :return: ('heading' / 'text', Markdown 文本) 或 ('code', [(行的 bbox, 行文本, 字号), ...]), 代码行由 page_to_markdown 统一排版
+    """
+    rows, spans = _block_rows(block)
+    if not rows:
+        return 'text', ""
+    texts = [text for _, text, _ in rows]
+
+    # 单独的一行带编号的短文本 -> 标题
+    if len(rows) == 1:
+        m = _NUMBERED_HEADING.match(texts[0].strip())
+        if m and all(span['flags'] & FONT_FLAG_BOLD for span in spans):
+            return 'heading', "#" * len(m.group(1).split(".")) + " " + texts[0].strip()
+
+    # 代码块保留换行和缩进
+    if _is_code(rows, spans, body_font):
+        return 'code', rows
+
+    # 普通段落: 去掉因页面宽度产生的换行, 行尾连字符与下一行合并
+    paragraph = ""
+    for text in texts:
+        text = text.strip()
+        if paragraph.endswith("-") and text[:1].islower():
+            paragraph = paragraph[:-1] + text
+        else:
+            paragraph = f"{paragraph} {text}" if paragraph else text
+    return 'text', paragraph
+
+
+def page_to_markdown(page, clip=None):
+    """
+    从文本层直接生成 Markdown, 规则与 OCR 提示词相同: 带编号的单独短行为标题, 段落内不保留换行, 代码放在代码块中。
+    :param page: fitz.Page
+    :param clip: 只提取该区域内的文本 (去掉页眉页脚)
+    :return: Markdown 字符串
+    """
+    blocks = page.get_text("dict", clip=clip if clip is not None else page.rect, sort=True)['blocks']
+    body_font = _body_font(blocks)
+    parts = []
+    for kind, text in (_block_to_markdown(block, body_font) for block in blocks if block['type'] == 0):
+        if not text:
+            continue
+        # PyMuPDF 会按空行, 甚至逐行把一段代码拆成多个块, 相邻的代码块合并到同一个代码块中
+        if kind == 'code' and parts and parts[-1][0] == 'code':
+            parts[-1][1].extend(text)
+        else:
+            parts.append((kind, list(text) if kind == 'code' else text))
+    return "\n\n".join(f"```\n{_format_code(text)}\n```" if kind == 'code' else text for kind, text in parts)
+
+
+def _format_code(rows):
+    # 以整段代码最左侧的行为基准换算缩进; 行间距明显大于行高时保留一个空行
+    x0 = min(bbox[0] for bbox, _, _ in rows)
+    char_width = max(1.0, 0.55 * max(size for _, _, size in rows))
+    lines, bottom = [], None
+    for bbox, text, size in rows:
+        if bottom is not None and bbox[1] - bottom > 0.6 * size:
+            lines.append("")
+        lines.append(" " * int(round((bbox[0] - x0) / char_width)) + text.strip())
+        bottom = bbox[3]
+    return "\n".join(lines)
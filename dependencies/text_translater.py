@@ -1,56 +1,199 @@
 import re
+import time
+import asyncio
+import concurrent.futures
 from dependencies.chat import *
-def split_string(text, min_length=14000, max_length=18000, numbered_headings=True):
+from dependencies.async_chat import AsyncChat_Retry
+from dependencies.translation_memory import Segment, TranslationMemory, join_segments
+from dependencies.metrics import metrics
+from dependencies.batch import run_batch
+
+
+# 中日韩字符大约一个字符一个 token, 其他字符大约四个字符一个 token
+_CJK_PATTERN = re.compile(r'[\u3040-\u30ff\u3400-\u9fff\uf900-\ufaff\uac00-\ud7af]')
+_PARAGRAPH_BREAK = re.compile(r'\n[ \t]*\n')
+_LINE_BREAK = re.compile(r'\n')
+
+
+def estimate_text_tokens(text):
+    """
+    不依赖分词器, 粗略估计文本的 token 数, 可作为 split_string 的 length_function。
+    """
+    cjk = len(_CJK_PATTERN.findall(text))
+    return cjk + (len(text) - cjk + 3) // 4
+
+
+def tiktoken_counter(model="gpt-4o"):
+    """
+    返回基于 tiktoken 的精确 token 计数函数 (需要安装可选依赖 tiktoken)。
+    """
+    try:
+        import tiktoken
+    except ImportError:
+        raise ImportError("tiktoken_counter requires the optional dependency tiktoken")
+    try:
+        encoding = tiktoken.encoding_for_model(model)
+    except KeyError:
+        encoding = tiktoken.get_encoding("o200k_base")
+    return lambda text: len(encoding.encode(text, disallowed_special=()))
+
+
+def _heading_pattern(numbered_headings):
     if numbered_headings:
         # 匹配带编号的标题 (如 # 1. 标题 或 ## 2.3 标题)
-        heading_pattern = re.compile(r'^(#+\s+\d+(\.\d+)*\.?\s+.*)', re.MULTILINE)
-    else:
-        # 匹配所有标题 (如 # 标题 或 ## 标题)
-        heading_pattern = re.compile(r'^(#+\s+.*)', re.MULTILINE)
-    
-    headings = [(m.start(), m.group(1)) for m in heading_pattern.finditer(text)]
-    
-    # 如果没有匹配到标题，直接返回整个文本
-    if not headings:
-        return [text]
+        return re.compile(r'^(#+\s+\d+(\.\d+)*\.?\s+.*)', re.MULTILINE)
+    # 匹配所有标题 (如 # 标题 或 ## 标题)
+    return re.compile(r'^(#+\s+.*)', re.MULTILINE)
 
-    segments = []
-    
-    if headings[0][0] > 0:
-        segments.append(text[:headings[0][0]])
 
-    for i in range(len(headings)):
-        start_pos = headings[i][0]
-        end_pos = headings[i + 1][0] if i + 1 < len(headings) else len(text)
-        segments.append(text[start_pos:end_pos])
-    
-    # 合并段落，确保每段的长度在 min_length 和 max_length 之间
-    result = []
-    current_segment = ""
-    
-    def add_segment(segment):
-        nonlocal current_segment
-        if len(current_segment) + len(segment) > max_length:
-            result.append(current_segment)
-            current_segment = segment
-        else:
-            current_segment += segment
-    
-    for segment in segments:
-        if len(current_segment) + len(segment) < min_length:
-            current_segment += segment
+def _split_at(text, pattern):
+    # 在分隔符之后切开, 分隔符保留在前一段末尾, 拼接后与原文完全一致
+    pieces, start = [], 0
+    for m in pattern.finditer(text):
+        pieces.append(text[start:m.end()])
+        start = m.end()
+    if start < len(text):
+        pieces.append(text[start:])
+    return pieces
+
+
+def _pack(pieces, max_length, length_function):
+    # 贪心地把相邻的小段拼在一起, 每组不超过 max_length
+    packed, parts, size = [], [], 0
+    for piece in pieces:
+        piece_size = length_function(piece)
+        if parts and size + piece_size > max_length:
+            packed.append("".join(parts))
+            parts, size = [], 0
+        parts.append(piece)
+        size += piece_size
+    if parts:
+        packed.append("".join(parts))
+    return packed
+
+
+def _split_oversized(section, max_length, length_function):
+    """
+    切分超过 max_length 的章节: 先按段落, 段落仍然过长再按行, 最后按字符硬切。
+    """
+    pieces = [section]
+    for pattern in (_PARAGRAPH_BREAK, _LINE_BREAK, None):
+        result = []
+        for piece in pieces:
+            piece_size = length_function(piece)
+            if piece_size <= max_length:
+                result.append(piece)
+            elif pattern is not None:
+                result.extend(_pack(_split_at(piece, pattern), max_length, length_function))
+            else:
+                step = -(-len(piece) * max_length // piece_size) or 1
+                result.extend(piece[i:i + step] for i in range(0, len(piece), step))
+        pieces = result
+    return pieces
+
+
+def _merge_sections(sections, min_length, max_length, length_function):
+    """
+    依次合并章节, 确保每段的长度在 min_length 和 max_length 之间。
+    当前段用列表收集, 输出时一次性拼接, 总耗时与文本长度成线性关系。
+    """
+    parts, size = [], 0
+    for section in sections:
+        section_size = length_function(section)
+        if section_size > max_length:
+            pieces = [(piece, length_function(piece)) for piece in _split_oversized(section, max_length, length_function)]
         else:
-            add_segment(segment)
-    
-    if current_segment:
-        result.append(current_segment)
-    
-    return result
+            pieces = [(section, section_size)]
+
+        for piece, piece_size in pieces:
+            if size + piece_size < min_length or size + piece_size <= max_length:
+                parts.append(piece)
+                size += piece_size
+            else:
+                if parts:
+                    yield "".join(parts)
+                parts, size = [piece], piece_size
+
+    if parts:
+        yield "".join(parts)
+
+
+def split_string(text, min_length=14000, max_length=18000, numbered_headings=True, length_function=len):
+    """
+    按 Markdown 标题把文本切成若干段, 每段长度在 min_length 和 max_length 之间。
+    单个章节超过 max_length 时会在段落边界处继续切分。
+    :param numbered_headings: 为 True 时只在带编号的标题处切分
+    :param length_function: 长度计算函数, 默认按字符数; 传入 estimate_text_tokens 或 tiktoken_counter() 可按 token 数切分
+    :return: 文本片段列表
+    """
+    heading_pattern = _heading_pattern(numbered_headings)
+    starts = [m.start() for m in heading_pattern.finditer(text)]
+    if not starts or starts[0] > 0:
+        starts.insert(0, 0)
+    bounds = starts + [len(text)]
+    sections = (text[bounds[i]:bounds[i + 1]] for i in range(len(starts)))
+    return list(_merge_sections(sections, min_length, max_length, length_function))
+
+
+def split_with_anchors(text, anchors, min_length=14000, max_length=18000, numbered_headings=True, length_function=len):
+    """
+    增量翻译用的切分: 先在上一次各片段的起始标题 (anchors) 处切开, 再对每一部分分别调用 split_string。
+    修改某一章只会影响该章所在的片段, 后面的片段边界不会因为贪心合并而整体移动。
+    :param anchors: 上一次切分结果中各片段的第一行, 按顺序排列; 不是标题的行和已被删除的标题会被忽略
+    其余参数与 split_string 相同
+    """
+    heading_pattern = _heading_pattern(numbered_headings)
+    anchors = [anchor for anchor in anchors if heading_pattern.match(anchor)]
+    cuts, next_anchor = [0], 0
+    for m in heading_pattern.finditer(text):
+        line = m.group(1)
+        # 标题只能按顺序匹配, 中间被删除的锚点直接跳过
+        if line in anchors[next_anchor:]:
+            next_anchor = anchors.index(line, next_anchor) + 1
+            if m.start() > 0:
+                cuts.append(m.start())
+    cuts.append(len(text))
+
+    chunks = []
+    for i in range(len(cuts) - 1):
+        chunks.extend(split_string(text[cuts[i]:cuts[i + 1]], min_length, max_length, numbered_headings, length_function))
+    return chunks
+
+
+def _iter_file_sections(file_path, heading_pattern, encoding):
+    lines = []
+    with open(file_path, 'r', encoding=encoding) as f:
+        for line in f:
+            if lines and heading_pattern.match(line):
+                yield "".join(lines)
+                lines = []
+            lines.append(line)
+    if lines:
+        yield "".join(lines)
+
+
+def iter_split_file(file_path, min_length=14000, max_length=18000, numbered_headings=True, length_function=len, encoding='utf-8'):
+    """
+    split_string 的流式版本: 逐行读取文件, 每凑满一段就产出, 不需要把整本书读入内存。
+    参数含义与 split_string 相同, 切分结果也相同。
+    """
+    heading_pattern = _heading_pattern(numbered_headings)
+    yield from _merge_sections(_iter_file_sections(file_path, heading_pattern, encoding), min_length, max_length, length_function)
+
+
+
+def build_translation_prompt(text, translation_prompt=None):
+    # 使用自定义翻译提示语，如果没有提供则使用默认提示语，并附加需要翻译的内容
+    return f"{translation_prompt}\n{text}" if translation_prompt else f"请翻译以下内容:\n{text}"
+
 
+def build_polishing_prompt(original_text, translated_text, polishing_prompt=None):
+    return f"{polishing_prompt}\n原文：{original_text}\n翻译：{translated_text}" if polishing_prompt else f"请根据以下原文对翻译后的文本进行润色：\n原文：{original_text}\n翻译：{translated_text}"
 
 
 class Translator:
-    def __init__(self, translation_model, polishing_model, api_key, baseurl, temperature=0.7, top_p=1, stream=False, max_retries_translater=4):
+    def __init__(self, translation_model, polishing_model, api_key, baseurl, temperature=0.7, top_p=1, stream=False, max_retries_translater=4,
+                 pool_size=10, timeout=(10, 300), memory=None):
         """
         初始化 Translator 类
         :param translation_model: 翻译使用的模型名称
@@ -60,9 +203,54 @@ class Translator:
         :param temperature: 生成文本的随机性
         :param top_p: 控制生成文本的多样性
         :param stream: 是否启用流式传输
+        :param pool_size: 每个模型的 HTTP 连接池大小, 建议与并发线程数一致
+        :param timeout: (连接超时, 读取超时) 秒
+        :param memory: 可选的 TranslationMemory, 重复出现的段落直接复用已有译文, 代码块不发给模型
         """
-        self.translation_chat = Chat_Retry(api_key=api_key, model=translation_model, baseurl=baseurl, temperature=temperature, top_p=top_p, stream=stream,max_retries=max_retries_translater)
-        self.polishing_chat = Chat_Retry(api_key=api_key, model=polishing_model, baseurl=baseurl, temperature=temperature, top_p=top_p, stream=stream,max_retries=max_retries_translater)
+        self.memory = memory
+        self.translation_chat = Chat_Retry(api_key=api_key, model=translation_model, baseurl=baseurl, temperature=temperature, top_p=top_p, stream=stream,max_retries=max_retries_translater,
+                                           pool_size=pool_size, timeout=timeout, metrics_stage='llm.translate')
+        self.polishing_chat = Chat_Retry(api_key=api_key, model=polishing_model, baseurl=baseurl, temperature=temperature, top_p=top_p, stream=stream,max_retries=max_retries_translater,
+                                         pool_size=pool_size, timeout=timeout, metrics_stage='llm.polish')
+
+    def _context(self, translation_prompt, polishing_prompt):
+        return TranslationMemory.make_context(self.translation_chat.model, self.polishing_chat.model, translation_prompt, polishing_prompt)
+
+    def _translate_segments(self, text, translation_prompt=None, polishing_prompt=None, on_delta=None):
+        """
+        翻译一个文本片段。没有翻译记忆时整个片段就是一个 Segment, 与直接调用翻译模型相同。
+        :param on_delta: 可选的回调, 按顺序传入翻译结果的各个部分, 拼接起来与 join_segments(segments, polished=False) 相同
+        """
+        start = time.perf_counter()
+        if self.memory is None:
+            segments = [Segment('text', [text])]
+        else:
+            segments = self.memory.plan(text, self._context(translation_prompt, polishing_prompt))
+        for i, segment in enumerate(segments):
+            if on_delta is not None and i:
+                on_delta("\n\n")
+            if segment.kind == 'text' and segment.translation is None:
+                segment.translation = self.translation_chat(build_translation_prompt(segment.source, translation_prompt), on_delta=on_delta)
+                if self.memory is not None:
+                    self.memory.record(segment, self._context(translation_prompt, polishing_prompt))
+            elif on_delta is not None:
+                on_delta(segment.output(polished=False))
+        metrics.record('translate', time.perf_counter() - start, bytes=len(text.encode('utf-8')))
+        return segments
+
+    def _polish_segments(self, segments, translation_prompt=None, polishing_prompt=None, on_delta=None):
+        with metrics.timer('polish'):
+            for i, segment in enumerate(segments):
+                if on_delta is not None and i:
+                    on_delta("\n\n")
+                if segment.kind == 'text' and segment.polished is None:
+                    segment.polished = self.polishing_chat(build_polishing_prompt(segment.source, segment.translation, polishing_prompt),
+                                                           on_delta=on_delta)
+                    if self.memory is not None:
+                        self.memory.record(segment, self._context(translation_prompt, polishing_prompt))
+                elif on_delta is not None:
+                    on_delta(segment.output())
+        return segments
 
     def translate(self, texts, translation_prompt=None, polish=False, polishing_prompt=None):
         """
@@ -73,25 +261,210 @@ class Translator:
         :param polishing_prompt: 可选的自定义润色提示语
         :return: 翻译后的文本数组（如果需要润色，则返回润色后的结果）
         """
-        translated_texts = []
-        
+        if self.memory is not None:
+            self.memory.reset()
         # Step 1: 翻译每个文本
-        for text in texts:
-            # 使用自定义翻译提示语，如果没有提供则使用默认提示语，并附加需要翻译的内容
-            prompt = f"{translation_prompt}\n{text}" if translation_prompt else f"请翻译以下内容:\n{text}"
-            translated_text = self.translation_chat(prompt)
-            translated_texts.append(translated_text)
+        translated_segments = [self._translate_segments(text, translation_prompt, polishing_prompt) for text in texts]
 
         # Step 2: 如果需要润色，调用润色模型，将原始文本和翻译后的文本一起发送给润色模型
         if polish:
-            polished_texts = []
-            for original_text, translated_text in zip(texts, translated_texts):
-                prompt = f"{polishing_prompt}\n原文：{original_text}\n翻译：{translated_text}" if polishing_prompt else f"请根据以下原文对翻译后的文本进行润色：\n原文：{original_text}\n翻译：{translated_text}"
-                polished_text = self.polishing_chat(prompt)
-                polished_texts.append(polished_text)
-            return polished_texts
-
-        return translated_texts
+            translated_segments = [self._polish_segments(segments, translation_prompt, polishing_prompt) for segments in translated_segments]
+
+        return [join_segments(segments, polish) for segments in translated_segments]
+
+    def translate_batch(self, texts, translation_prompt=None, polish=False, polishing_prompt=None,
+                        translation_workers=4, polishing_workers=4, on_result=None, on_delta=None):
+        """
+        以流水线方式批量翻译并润色: 翻译和润色各自使用独立的线程池(并发数分别设置),
+        某个片段的翻译一完成就立即提交它的润色, 不必等待所有片段翻译结束。
+        :param translation_workers: 翻译模型的并发数
+        :param polishing_workers: 润色模型的并发数
+        :param on_result: 可选的回调 on_result(片段序号, 结果), 每个片段完成后在调用线程中调用, 失败时结果为 None
+        :param on_delta: 可选的回调 on_delta(片段序号, 文本), 最终结果 (润色时为润色结果) 的流式输出, 在工作线程中调用
+        :return: (结果列表, {片段序号: 异常}), 结果顺序与输入一致, 失败的片段结果为 None
+        """
+        if self.memory is not None:
+            self.memory.reset()
+        results = [None] * len(texts)
+        errors = {}
+
+        def delta_callback(idx):
+            return None if on_delta is None else (lambda text: on_delta(idx, text))
+
+        def finish(idx, result=None, error=None):
+            results[idx] = result
+            if error is not None:
+                errors[idx] = error
+            if on_result is not None:
+                on_result(idx, result)
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=translation_workers) as translation_pool, \
+             concurrent.futures.ThreadPoolExecutor(max_workers=polishing_workers) as polishing_pool:
+
+            translation_futures = {translation_pool.submit(self._translate_segments, text, translation_prompt, polishing_prompt,
+                                                           None if polish else delta_callback(idx)): idx
+                                   for idx, text in enumerate(texts)}
+            polishing_futures = {}
+
+            # 翻译和润色的 future 在同一个循环中等待, 润色完成的片段立即交给 on_result, 不必等最慢的翻译结束
+            while translation_futures or polishing_futures:
+                done, _ = concurrent.futures.wait(list(translation_futures) + list(polishing_futures),
+                                                  return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    if future in polishing_futures:
+                        idx = polishing_futures.pop(future)
+                        try:
+                            finish(idx, join_segments(future.result()))
+                        except Exception as e:
+                            finish(idx, error=e)
+                        continue
+
+                    idx = translation_futures.pop(future)
+                    try:
+                        segments = future.result()
+                    except Exception as e:
+                        finish(idx, error=e)
+                        continue
+                    if polish:
+                        polishing_futures[polishing_pool.submit(self._polish_segments, segments, translation_prompt, polishing_prompt,
+                                                                delta_callback(idx))] = idx
+                    else:
+                        finish(idx, join_segments(segments, polished=False))
+
+        return results, errors
+
+    def translate_via_batch(self, texts, batch_client, job_store, name, translation_prompt=None, polish=False, polishing_prompt=None,
+                            poll_interval=30, max_rounds=3):
+        """
+        通过服务商的批处理接口 (/v1/batches) 翻译并润色: 所有片段的翻译请求作为一个任务提交, 完成后再提交润色任务。
+        价格更低且不占实时接口的限流额度, 但每个阶段通常需要数小时; 任务状态保存在 job_store 中, 中断后重新运行会继续等待。
+        :param batch_client: BatchClient 实例
+        :param job_store: BatchJobStore 实例
+        :param name: 任务名称前缀 (如文件名), 翻译和润色任务分别为 "name:translate" 和 "name:polish"
+        :param poll_interval: 轮询任务状态的间隔（秒）
+        :param max_rounds: 失败的请求最多重新提交的轮数
+        :return: (结果列表, {片段序号: 错误信息}), 结果顺序与输入一致, 失败的片段结果为 None
+        """
+        context = self._context(translation_prompt, polishing_prompt)
+        if self.memory is not None:
+            self.memory.reset()
+        plans = [[Segment('text', [text])] if self.memory is None else self.memory.plan(text, context) for text in texts]
+        errors = {}
+
+        def run_stage(stage, chat, build_prompt, attribute):
+            # 为每个未命中翻译记忆的文本段构造一个请求, custom_id 为 "阶段-片段序号-段序号"
+            batch_requests = []
+            for i, segments in enumerate(plans):
+                if i in errors:
+                    continue
+                for j, segment in enumerate(segments):
+                    if segment.kind == 'text' and getattr(segment, attribute) is None:
+                        batch_requests.append((f"{stage[0]}-{i}-{j}",
+                                               build_chat_body(build_prompt(segment), None, chat.model, chat.temperature, chat.top_p)))
+            if not batch_requests:
+                return
+            start = time.perf_counter()
+            results, failed = run_batch(batch_client, job_store, f"{name}:{stage}", batch_requests,
+                                        poll_interval=poll_interval, max_rounds=max_rounds)
+            metrics.record(stage, time.perf_counter() - start)
+            for custom_id, _ in batch_requests:
+                _, i, j = custom_id.split("-")
+                segment = plans[int(i)][int(j)]
+                if custom_id in results:
+                    setattr(segment, attribute, results[custom_id])
+                    if self.memory is not None:
+                        self.memory.record(segment, context)
+                else:
+                    errors.setdefault(int(i), failed.get(custom_id))
+
+        run_stage('translate', self.translation_chat, lambda segment: build_translation_prompt(segment.source, translation_prompt), 'translation')
+        if polish:
+            run_stage('polish', self.polishing_chat,
+                      lambda segment: build_polishing_prompt(segment.source, segment.translation, polishing_prompt), 'polished')
+        results = [None if i in errors else join_segments(segments, polish) for i, segments in enumerate(plans)]
+        return results, errors
+
+
+class AsyncTranslator:
+    def __init__(self, translation_model, polishing_model, api_key, baseurl, temperature=0.7, top_p=1, stream=False, max_retries_translater=4,
+                 max_concurrency=100, timeout=(10, 300), memory=None):
+        """
+        Translator 的异步版本, 所有文本片段在同一个事件循环中并发翻译和润色。
+        :param max_concurrency: 同时处理的文本片段上限
+        其余参数与 Translator 相同
+        """
+        self.memory = memory
+        self.translation_chat = AsyncChat_Retry(api_key=api_key, model=translation_model, baseurl=baseurl, temperature=temperature, top_p=top_p, stream=stream,
+                                                max_retries=max_retries_translater, pool_size=max_concurrency, timeout=timeout,
+                                                metrics_stage='llm.translate')
+        self.polishing_chat = AsyncChat_Retry(api_key=api_key, model=polishing_model, baseurl=baseurl, temperature=temperature, top_p=top_p, stream=stream,
+                                              max_retries=max_retries_translater, pool_size=max_concurrency, timeout=timeout,
+                                              metrics_stage='llm.polish')
+        self.max_concurrency = max_concurrency
+
+    async def translate_one(self, text, translation_prompt=None, polish=False, polishing_prompt=None, on_delta=None):
+        """
+        :param on_delta: 可选的回调, 按顺序传入最终结果的各个部分 (见 Translator._translate_segments)
+        """
+        context = TranslationMemory.make_context(self.translation_chat.model, self.polishing_chat.model, translation_prompt, polishing_prompt)
+        segments = [Segment('text', [text])] if self.memory is None else self.memory.plan(text, context)
+        # 片段内的翻译和润色交替进行, 分别累加两者的耗时, 与 Translator 记录的阶段一致
+        translate_seconds, polish_seconds = 0.0, 0.0
+        for i, segment in enumerate(segments):
+            if on_delta is not None and i:
+                on_delta("\n\n")
+            if segment.kind != 'text' or (segment.translation is not None and (not polish or segment.polished is not None)):
+                if on_delta is not None:
+                    on_delta(segment.output(polish))
+                continue
+            if segment.translation is None:
+                start = time.perf_counter()
+                segment.translation = await self.translation_chat(build_translation_prompt(segment.source, translation_prompt),
+                                                                  on_delta=None if polish else on_delta)
+                translate_seconds += time.perf_counter() - start
+            if polish:
+                start = time.perf_counter()
+                segment.polished = await self.polishing_chat(build_polishing_prompt(segment.source, segment.translation, polishing_prompt),
+                                                             on_delta=on_delta)
+                polish_seconds += time.perf_counter() - start
+            if self.memory is not None:
+                self.memory.record(segment, context)
+        metrics.record('translate', translate_seconds, bytes=len(text.encode('utf-8')))
+        if polish:
+            metrics.record('polish', polish_seconds)
+        return join_segments(segments, polish)
+
+    async def translate(self, texts, translation_prompt=None, polish=False, polishing_prompt=None, return_exceptions=False,
+                        on_result=None, on_delta=None):
+        """
+        并发翻译文本数组, 结果顺序与输入一致。
+        :param return_exceptions: 为 True 时单个片段失败不会中断其他片段, 失败位置返回对应的异常对象
+        :param on_result: 可选的回调 on_result(片段序号, 结果), 每个片段完成后调用, 失败时结果为 None
+        :param on_delta: 可选的回调 on_delta(片段序号, 文本), 见 Translator.translate_batch
+        :return: 翻译（或润色）后的文本数组
+        """
+        if self.memory is not None:
+            self.memory.reset()
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+
+        async def run(idx, text):
+            async with semaphore:
+                callback = None if on_delta is None else (lambda delta: on_delta(idx, delta))
+                try:
+                    result = await self.translate_one(text, translation_prompt, polish, polishing_prompt, callback)
+                except Exception:
+                    if on_result is not None:
+                        on_result(idx, None)
+                    raise
+                if on_result is not None:
+                    on_result(idx, result)
+                return result
+
+        return await asyncio.gather(*(run(idx, text) for idx, text in enumerate(texts)), return_exceptions=return_exceptions)
+
+    async def close(self):
+        await self.translation_chat.close()
+        await self.polishing_chat.close()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,65 @@
+import hashlib
+import json
+import os
+
+
+def chunk_hash(text):
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+class TranslationManifest:
+    def __init__(self, manifest_path, context=""):
+        """
+        记录上一次翻译的片段边界、原文哈希和译文 (JSON), 用于增量翻译:
+        重新 OCR 部分页面后, 只有原文发生变化的片段需要重新翻译和润色, 其余片段直接复用上次的译文。
+        :param manifest_path: 清单文件路径, 通常放在输出文件旁边
+        :param context: 模型和提示词等信息, 与上次不同时清单作废, 全部重新翻译
+        """
+        self.manifest_path = manifest_path
+        self.context = context
+        self.chunks = []
+        self._results = {}
+
+    def load(self):
+        """
+        :return: 是否读取到了可用的清单
+        """
+        self.chunks, self._results = [], {}
+        if not os.path.exists(self.manifest_path):
+            return False
+        try:
+            with open(self.manifest_path, 'r', encoding='utf-8') as f:
+                manifest = json.load(f)
+        except (OSError, json.JSONDecodeError):
+            return False
+        if manifest.get('context') != self.context:
+            return False
+        self.chunks = manifest['chunks']
+        self._results = {chunk['hash']: chunk['result'] for chunk in self.chunks if chunk['result'] is not None}
+        return True
+
+    def anchors(self):
+        """
+        上一次各片段的第一行, 作为 split_with_anchors 的切分锚点。
+        """
+        return [chunk['anchor'] for chunk in self.chunks]
+
+    def lookup(self, text):
+        """
+        :return: 原文完全相同的片段上次的译文, 没有时返回 None
+        """
+        return self._results.get(chunk_hash(text))
+
+    def save(self, texts, results):
+        """
+        保存本次的切分结果和译文, 失败的片段 (结果为 None) 下次会重新翻译。
+        先写入临时文件再替换, 进程中断不会留下损坏的清单。
+        """
+        chunks = [{"hash": chunk_hash(text), "anchor": text.split("\n", 1)[0], "length": len(text), "result": result}
+                  for text, result in zip(texts, results)]
+        tmp_path = self.manifest_path + ".tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({"context": self.context, "chunks": chunks}, f, ensure_ascii=False)
+        os.replace(tmp_path, self.manifest_path)
+        self.chunks = chunks
+        self._results = {chunk['hash']: chunk['result'] for chunk in chunks if chunk['result'] is not None}
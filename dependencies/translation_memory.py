@@ -0,0 +1,169 @@
+import hashlib
+import re
+import sqlite3
+import threading
+
+_FENCE = re.compile(r'^\s*(```|~~~)')
+
+
+def split_blocks(text):
+    """
+    将 Markdown 文本拆成段落和围栏代码块。
+    :return: [('text' 或 'code', 块内容), ...]，块内容去掉了首尾空行
+    """
+    blocks, lines, in_code = [], [], False
+
+    def flush(kind):
+        block = "\n".join(lines).strip("\n")
+        if block.strip():
+            blocks.append((kind, block))
+        lines.clear()
+
+    for line in text.split("\n"):
+        if _FENCE.match(line):
+            if in_code:
+                lines.append(line)
+                flush('code')
+            else:
+                flush('text')
+                lines.append(line)
+            in_code = not in_code
+        elif in_code:
+            lines.append(line)
+        elif line.strip():
+            lines.append(line)
+        else:
+            flush('text')
+    flush('code' if in_code else 'text')
+    return blocks
+
+
+def normalize(text):
+    # 忽略空白差异 (OCR 结果中换行和多余空格经常变化)
+    return " ".join(text.split())
+
+
+class Segment:
+    def __init__(self, kind, paragraphs, translation=None, polished=None):
+        """
+        翻译的最小单位: 一个代码块, 一个记忆库中已有的段落, 或若干个连续的新段落。
+        :param kind: 'text' 或 'code'，代码块原样保留, 不发给模型
+        :param paragraphs: 组成该单位的原文段落列表
+        """
+        self.kind = kind
+        self.paragraphs = paragraphs
+        self.source = "\n\n".join(paragraphs)
+        self.translation = translation
+        self.polished = polished
+
+    def output(self, polished=True):
+        if self.kind == 'code':
+            return self.source
+        return self.polished if polished and self.polished is not None else self.translation
+
+
+def join_segments(segments, polished=True):
+    """
+    按原文顺序拼接各单位的结果。
+    :param polished: 为 False 时只使用翻译结果, 忽略记忆库中可能已有的润色结果
+    """
+    return "\n\n".join(segment.output(polished) for segment in segments)
+
+
+class TranslationMemory:
+    def __init__(self, db_path):
+        """
+        段落级翻译记忆库 (SQLite)。按规范化后的段落内容和模型/提示词做哈希, 相同的段落直接复用上次的翻译和润色结果,
+        围栏代码块原样保留, 只有新出现的段落才会发给模型。
+        :param db_path: SQLite 数据库文件路径
+        """
+        self.db_path = db_path
+        self.reset()
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.execute("CREATE TABLE IF NOT EXISTS translation_memory ("
+                           "key TEXT PRIMARY KEY, translation TEXT, polished TEXT)")
+        self._conn.commit()
+
+    def reset(self):
+        """
+        清零命中/未命中计数, Translator 每次翻译调用开始时调用, summary() 只统计本次调用。
+        """
+        self.hits = 0
+        self.misses = 0
+        self.passthrough = 0
+
+    @staticmethod
+    def make_context(translation_model, polishing_model, translation_prompt, polishing_prompt):
+        return "\x1f".join(str(part) for part in (translation_model, polishing_model, translation_prompt, polishing_prompt))
+
+    @staticmethod
+    def _key(context, source):
+        return hashlib.sha256(f"{context}\x1e{normalize(source)}".encode('utf-8')).hexdigest()
+
+    def _lookup(self, key):
+        with self._lock:
+            return self._conn.execute("SELECT translation, polished FROM translation_memory WHERE key = ?", (key,)).fetchone()
+
+    def plan(self, text, context):
+        """
+        将一个文本片段拆成 Segment 列表: 命中记忆库的段落带上已有结果, 连续的新段落合并为一个待翻译单位。
+        """
+        segments, pending = [], []
+
+        def flush_pending():
+            if not pending:
+                return
+            row = self._lookup(self._key(context, "\n\n".join(pending)))
+            if row is not None:
+                self.hits += len(pending)
+            else:
+                self.misses += len(pending)
+            segments.append(Segment('text', list(pending), *(row or (None, None))))
+            pending.clear()
+
+        for kind, block in split_blocks(text):
+            if kind == 'code':
+                flush_pending()
+                segments.append(Segment('code', [block]))
+                self.passthrough += 1
+                continue
+            row = self._lookup(self._key(context, block))
+            if row is not None and row[0] is not None:
+                flush_pending()
+                segments.append(Segment('text', [block], *row))
+                self.hits += 1
+            else:
+                pending.append(block)
+        flush_pending()
+        return segments
+
+    def record(self, segment, context):
+        """
+        保存一个单位的翻译/润色结果。
+        如果模型返回的段落数与原文一致, 同时按段落保存, 之后单独出现的相同段落也能命中。
+        """
+        if segment.kind != 'text' or segment.translation is None:
+            return
+        rows, stale = [(self._key(context, segment.source), segment.translation, segment.polished)], []
+        if len(segment.paragraphs) > 1:
+            translated = [block for _, block in split_blocks(segment.translation)]
+            polished = [block for _, block in split_blocks(segment.polished)] if segment.polished is not None else None
+            keys = [self._key(context, paragraph) for paragraph in segment.paragraphs]
+            if len(translated) == len(keys) and (polished is None or len(polished) == len(keys)):
+                rows += [(key, translated[i], polished[i] if polished else None) for i, key in enumerate(keys)]
+            elif polished is not None:
+                # 润色结果无法按段落对应时, 删除翻译阶段写入的段落记录, 否则它们会遮住整体的润色结果
+                stale = [(key,) for key in keys]
+        with self._lock:
+            self._conn.executemany("INSERT OR REPLACE INTO translation_memory (key, translation, polished) VALUES (?, ?, ?)", rows)
+            self._conn.executemany("DELETE FROM translation_memory WHERE key = ? AND polished IS NULL", stale)
+            self._conn.commit()
+
+    def summary(self):
+        return (f"Translation memory: {self.hits} paragraphs reused, {self.misses} paragraphs sent to the model, "
+                f"{self.passthrough} code blocks passed through")
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
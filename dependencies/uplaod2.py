@@ -1,16 +1,28 @@
 import os
 import time
+import base64
+import hashlib
+import threading
 import concurrent.futures
 import oss2
 from io import BytesIO
 from oss2.credentials import EnvironmentVariableCredentialsProvider
 from PIL import Image
+from dependencies.pdfpreprocesser import encode_image, IMAGE_EXTENSIONS, normalize_image_format
+from dependencies.ratelimit import backoff_delay
+from dependencies.metrics import metrics
+
+FORBID_OVERWRITE = 'x-oss-forbid-overwrite'
 
 class OSSUploader:
-    def __init__(self, bucket_name, aliyun_oss_upload_url, aliyun_oss_download_url, second_folder=None, max_retries=8, max_workers=4):
+    def __init__(self, bucket_name, aliyun_oss_upload_url, aliyun_oss_download_url, second_folder=None, max_retries=8, max_workers=4,
+                 bucket=None, multipart_threshold=5 * 1024 * 1024, part_size=1024 * 1024):
         """
         初始化OSSUploader类。
         :param second_folder: 可选的二级目录，默认为None，表示使用根目录。
+        :param bucket: 可选的 bucket 对象, 默认按 bucket_name 创建 oss2.Bucket; 测试时可以传入本地的替身 (见 benchmarks/mock_services.py)
+        :param multipart_threshold: 超过该字节数的文件使用分片上传
+        :param part_size: 分片大小 (OSS 要求除最后一片外不小于 100KB)
         """
         self.bucket_name = bucket_name
         self.aliyun_oss_upload_url = aliyun_oss_upload_url
@@ -18,36 +30,121 @@ class OSSUploader:
         self.second_folder = second_folder
         self.max_retries = max_retries
         self.max_workers = max_workers
-        self.auth = oss2.ProviderAuth(EnvironmentVariableCredentialsProvider())
-        self.bucket = oss2.Bucket(self.auth, self.aliyun_oss_upload_url, self.bucket_name)
-    
-    def _upload_single(self, object_name, data, content_type=None):
-        success, retries = False, 0
-        while not success and retries < self.max_retries:
+        self.multipart_threshold = multipart_threshold
+        self.part_size = part_size
+        if bucket is None:
+            self.auth = oss2.ProviderAuth(EnvironmentVariableCredentialsProvider())
+            bucket = oss2.Bucket(self.auth, self.aliyun_oss_upload_url, self.bucket_name)
+        self.bucket = bucket
+        self.uploaded = 0
+        self.skipped = 0
+        self._known_objects = set()     # 本进程内已确认存在的对象, 不需要再次查询
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _check_etag(etag, data):
+        # 简单上传和单个分片的 ETag 就是内容的 MD5, 与本地计算的结果比较即可确认完整性, 不需要再发一次 head_object
+        md5 = hashlib.md5(data).hexdigest()
+        if etag is None or etag.strip('"').lower() != md5:
+            raise Exception(f"ETag mismatch: local MD5 {md5}, OSS ETag {etag}")
+
+    @staticmethod
+    def _md5_header(data, headers=None):
+        headers = dict(headers or {})
+        # 服务端会校验 Content-MD5, 传输过程中损坏的请求会被直接拒绝
+        headers['Content-MD5'] = base64.b64encode(hashlib.md5(data).digest()).decode()
+        return headers
+
+    def _put(self, object_name, data, headers):
+        result = self.bucket.put_object(object_name, data, headers=self._md5_header(data, headers))
+        self._check_etag(result.etag, data)
+
+    @staticmethod
+    def _already_exists(exc):
+        # 带 x-oss-forbid-overwrite 的上传在对象已存在时返回 409 FileAlreadyExists
+        return isinstance(exc, oss2.exceptions.ServerError) and exc.status == 409 and exc.code == 'FileAlreadyExists'
+
+    def _put_multipart(self, object_name, data, headers):
+        upload_id = self.bucket.init_multipart_upload(object_name, headers=headers).upload_id
+        try:
+            parts = []
+            for part_number, offset in enumerate(range(0, len(data), self.part_size), start=1):
+                chunk = data[offset:offset + self.part_size]
+                result = self.bucket.upload_part(object_name, upload_id, part_number, chunk, headers=self._md5_header(chunk))
+                self._check_etag(result.etag, chunk)
+                parts.append(oss2.models.PartInfo(part_number, result.etag, size=len(chunk)))
+            complete_headers = {FORBID_OVERWRITE: headers[FORBID_OVERWRITE]} if FORBID_OVERWRITE in headers else None
+            self.bucket.complete_multipart_upload(object_name, upload_id, parts, headers=complete_headers)
+        except Exception:
+            # 放弃未完成的分片, 避免残留的分片占用存储空间
             try:
-                
-                data.seek(0, os.SEEK_END)
-                file_size = data.tell()
-                data.seek(0)  
+                self.bucket.abort_multipart_upload(object_name, upload_id)
+            except Exception:
+                pass
+            raise
+
+    def _exists(self, object_name):
+        with self._lock:
+            if object_name in self._known_objects:
+                return True
+        return self.bucket.object_exists(object_name)
 
-                headers = {'Content-Type': content_type} if content_type else {}
-                self.bucket.put_object(object_name, data, headers=headers)
+    def _skip(self, object_name):
+        with self._lock:
+            self.skipped += 1
+            self._known_objects.add(object_name)
+        metrics.count('upload_skipped')
 
-                # 校验上传后的文件大小
-                oss_file_info = self.bucket.head_object(object_name)
-                oss_file_size = oss_file_info.content_length
+    def _upload_single(self, object_name, data, content_type=None, skip_if_exists=False, forbid_overwrite=False):
+        """
+        上传一个对象, 失败时按指数退避重试。
+        :param data: 字节串或 BytesIO
+        :param skip_if_exists: 上传前先用 HEAD 请求检查, 对象已存在时直接返回 URL
+        :param forbid_overwrite: 以不覆盖的方式上传 (x-oss-forbid-overwrite), 对象已存在时服务端返回 409, 视为已上传。
+                                 新对象只需要一次请求, 只应用于按内容哈希命名的对象
+        :return: 下载 URL, 重试次数用尽时返回 None
+        """
+        if isinstance(data, BytesIO):
+            data = data.getvalue()
+        url = f"{self.aliyun_oss_download_url}/{object_name}"
+        headers = {'Content-Type': content_type} if content_type else {}
+        if forbid_overwrite:
+            with self._lock:
+                known = object_name in self._known_objects
+            if known:
+                self._skip(object_name)
+                return url
+
+        start = time.perf_counter()
+        for retries in range(self.max_retries):
+            # 只在第一次尝试时检查/禁止覆盖: 校验失败后对象虽然存在, 内容却可能已损坏, 必须重新上传
+            try:
+                if skip_if_exists and retries == 0 and self._exists(object_name):
+                    self._skip(object_name)
+                    return url
 
-                if oss_file_size == file_size:
-                    success = True
-                    return f"{self.aliyun_oss_download_url}/{object_name}"
+                put_headers = dict(headers, **{FORBID_OVERWRITE: 'true'}) if forbid_overwrite and retries == 0 else headers
+                if len(data) > self.multipart_threshold:
+                    self._put_multipart(object_name, data, put_headers)
                 else:
-                    raise Exception(f"File size mismatch: Local size {file_size}, OSS size {oss_file_size}")
+                    self._put(object_name, data, put_headers)
+
+                with self._lock:
+                    self.uploaded += 1
+                    self._known_objects.add(object_name)
+                metrics.record('upload', time.perf_counter() - start, bytes=len(data), retries=retries)
+                return url
 
             except Exception as e:
-                retries += 1
-                print(f"Upload failed for {object_name}, retrying {retries}/{self.max_retries}... Error: {e}")
-                time.sleep(2)
+                if self._already_exists(e):
+                    self._skip(object_name)
+                    metrics.record('upload', time.perf_counter() - start, retries=retries)
+                    return url
+                print(f"Upload failed for {object_name}, retrying {retries + 1}/{self.max_retries}... Error: {e}")
+                if retries < self.max_retries - 1:
+                    time.sleep(backoff_delay(retries, 1, 30))
 
+        metrics.record('upload', time.perf_counter() - start, retries=self.max_retries - 1, errors=1)
         return None
 
     def _get_object_name(self, file_name):
@@ -59,6 +156,12 @@ class OSSUploader:
             return f"{self.second_folder}/{file_name}"
         return file_name
 
+    def content_object_name(self, data, extension):
+        """
+        按内容的 SHA-256 生成对象名称, 相同内容总是对应同一个对象, 重复上传可以直接跳过。
+        """
+        return self._get_object_name(f"{hashlib.sha256(data).hexdigest()[:32]}.{extension}")
+
     def upload_file(self, file_path):
         if not os.path.exists(file_path):
             print(f"Error: File {file_path} does not exist.")
@@ -67,47 +170,53 @@ class OSSUploader:
         file_name = os.path.basename(file_path)
         object_name = self._get_object_name(file_name)
         with open(file_path, 'rb') as f:
-            data = BytesIO(f.read())  # 使用 BytesIO 确保可以重复读取
+            data = f.read()
         url = self._upload_single(object_name, data)
         return [url] if url else []
 
-    def upload_image(self, object_name, image):
-        img_byte_arr = BytesIO()
-        image.save(img_byte_arr, format='PNG')
-        img_byte_arr.seek(0) 
-        object_name = self._get_object_name(object_name)
-        url = self._upload_single(object_name, img_byte_arr, content_type='image/png')
+    def upload_image(self, object_name, image, image_format='PNG', quality=None):
+        """
+        :param object_name: 对象名称; 为 None 时按编码后内容的哈希命名, 以不覆盖的方式上传, 已存在的对象不会重复上传
+        :param image_format: 'PNG'、'JPEG' 或 'WEBP'
+        :param quality: JPEG/WEBP 的压缩质量
+        """
+        data, content_type = encode_image(image, image_format, quality)
+        if object_name is None:
+            object_name = self.content_object_name(data, IMAGE_EXTENSIONS[normalize_image_format(image_format)])
+            url = self._upload_single(object_name, data, content_type=content_type, forbid_overwrite=True)
+        else:
+            url = self._upload_single(self._get_object_name(object_name), data, content_type=content_type)
         return [url] if url else []
 
-    def upload_files(self, file_paths):
+    def _upload_ordered(self, upload, items):
+        # 并行上传, 结果按输入顺序返回, 失败的位置为 None
         with concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers) as executor:
-            future_to_file = {executor.submit(self.upload_file, path): path for path in file_paths}
-            urls = [future.result()[0] for future in concurrent.futures.as_completed(future_to_file) if future.result()]
+            futures = [executor.submit(upload, item) for item in items]
+        urls = []
+        for future in futures:
+            try:
+                result = future.result()
+            except Exception as e:
+                print(f"Error during upload: {e}")
+                result = []
+            urls.append(result[0] if result else None)
+
+        failed = sum(1 for url in urls if url is None)
+        if failed:
+            print(f"Warning: Only {len(urls) - failed} out of {len(urls)} items were uploaded successfully.")
         return urls
 
-    def upload_images(self, images):
+    def upload_files(self, file_paths):
+        """
+        并行上传一组文件, 返回的 URL 与 file_paths 顺序一致, 上传失败的位置为 None。
+        """
+        return self._upload_ordered(self.upload_file, file_paths)
+
+    def upload_images(self, images, image_format='PNG', quality=None):
         """
-        上传一组图片，确保所有图片都被上传并返回其URL。
+        并行上传一组图片 (按内容哈希命名), 返回的 URL 与 images 顺序一致, 上传失败的位置为 None。
         """
-        urls = []
-        with concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers) as executor:
-            future_to_image = {executor.submit(self.upload_image, f"image_{i}.png", img): img for i, img in enumerate(images)}
-            
-            for future in concurrent.futures.as_completed(future_to_image):
-                try:
-                    result = future.result()
-                    if result:
-                        urls.extend(result)
-                    else:
-                        print(f"Warning: Upload returned no URL for an image.")
-                except Exception as e:
-                    print(f"Error during image upload: {e}")
-        
-        # 校验是否所有图片都上传成功
-        if len(urls) < len(images):
-            print(f"Warning: Only {len(urls)} out of {len(images)} images were uploaded successfully.")
-        
-        return urls
+        return self._upload_ordered(lambda image: self.upload_image(None, image, image_format, quality), images)
 
 # if __name__ == "__main__":
 #     # 初始化OSSUploader实例
@@ -1,11 +1,19 @@
 import os
 import time
+import asyncio
 import concurrent.futures
-from pdf2image import convert_from_path
+from collections import Counter, deque
+from functools import partial
 from math import ceil
 from dependencies.pdfpreprocesser import *
 from dependencies.uplaod2 import *
 from dependencies.chat import *
+from dependencies.ocr_cache import OCRCache, encoding_key, image_hash
+from dependencies.ocr_journal import OCRJournal, OrderedResultWriter
+from dependencies.async_chat import AsyncChat_Retry, async_ocr_with_chatgpt
+from dependencies.ratelimit import ConcurrencyController, get_rate_limiter
+from dependencies.metrics import metrics
+from dependencies.batch import BatchClient, BatchJobStore, run_batch
 
 # 文件路径和名称定义
 BASE_PATH = 'D:/Files/Code/Python/tips'
@@ -14,6 +22,7 @@ CROPPED_PDF_PATH = "D:/Files/Code/Python/tips"
 CROPPED_PDF_NAME = 'temp.pdf' 
 OCR_RESULT_PATH = "D:/Files/Code/Python/tips"
 OCR_RESULT_NAME = '256-287.txt'
+OCR_CACHE_NAME = 'ocr_cache.sqlite3'
 
 ALIYUNOSS_BUCKET = 'oss-for-nextweb'
 ALIYUNOSS_UPLOAD_URL = 'oss-cn-hongkong.aliyuncs.com'
@@ -37,6 +46,18 @@ MODEL  = "claude-3-haiku-20240307"        # THIS IS ENOUGH, CLUADE IN OCR IS BET
 temperature = 0.0
 top_p = 1.0
 
+MODEL_REQUESTS_PER_MINUTE = None    # 模型的每分钟请求数上限, None 表示不限制 (依据服务商的配额设置)
+MODEL_TOKENS_PER_MINUTE = None      # 模型的每分钟 token 数上限, None 表示不限制
+
+USE_ASYNC = False               # 使用 asyncio 客户端, 单进程内可同时发出上百个 OCR 请求 (依赖 httpx, 见 requirements.txt)
+ASYNC_MAX_CONCURRENCY = 100     # 异步模式下同时在途的页面组上限
+
+USE_BATCH = False               # 通过服务商的批处理接口 (/v1/batches) 提交全部页面组, 价格更低且不占实时限流额度, 但通常需要数小时
+BATCH_JOB_STORE_NAME = 'batch_jobs.sqlite3'     # 批处理任务状态, 中断后重新运行会继续等待已提交的任务
+
+METRICS_JSONL_NAME = None       # 每次运行的指标汇总追加到该 JSONL 文件, None 表示不导出
+METRICS_PROM_NAME = None        # Prometheus 文本格式的指标文件 (供 node_exporter textfile collector 采集), None 表示不导出
+
 # TOP_MARGIN = 0  # 顶部裁剪的像素数
 # BOTTOM_MARGIN = 0  # 底部裁剪的像素数
 
@@ -45,38 +66,502 @@ top_p = 1.0
 RAW_PDF_PATH = os.path.join(BASE_PATH, RAW_PDF_NAME)                    # 初始PDF路径
 CROPPED_PDF_PATH = os.path.join(CROPPED_PDF_PATH, CROPPED_PDF_NAME)     # 中间处理后的PDF路径
 OCR_CONTENT_DESTINATION = os.path.join(BASE_PATH, OCR_RESULT_NAME)      # 最终OCR识别结果保存的TXT路径
+OCR_CACHE_PATH = os.path.join(BASE_PATH, OCR_CACHE_NAME)                # OCR结果缓存数据库路径
+BATCH_JOB_STORE_PATH = os.path.join(BASE_PATH, BATCH_JOB_STORE_NAME)    # 批处理任务状态数据库路径
+METRICS_JSONL_PATH = METRICS_JSONL_NAME and os.path.join(BASE_PATH, METRICS_JSONL_NAME)    # 指标导出路径
+METRICS_PROM_PATH = METRICS_PROM_NAME and os.path.join(BASE_PATH, METRICS_PROM_NAME)
+
+
+
+# 4. 单个页面组的处理：上传(或内嵌) + OCR
+def page_group_source(group_index, image, image_transport='oss', image_format='JPEG', image_quality=85):
+    """
+    返回一个无参函数, 调用时才上传(或编码)图片并返回发给模型的 URL, 命中缓存时不会被调用。
+    """
+    def upload():
+        if image_transport == 'inline':
+            with metrics.timer('encode'):
+                data, mime_type = encode_image(image, image_format, image_quality)
+            metrics.record('encode', bytes=len(data))
+            return make_data_url(data, mime_type)
+        # 按内容哈希命名, 重跑或多个文档中相同的图片不会重复上传
+        urls = oss_uploader.upload_image(None, image, image_format, image_quality)
+        if not urls:
+            raise Exception(f"upload failed for image_{group_index}")
+        return urls[0]
+    return upload
 
 
+def ocr_page_group(group_index, image, chat_instance, ocr_max_retries=5, cache=None, digest=None,
+                   image_transport='oss', image_format='JPEG', image_quality=85, on_delta=None):
+    if cache is not None and digest is None:
+        digest = image_hash(image)
+    source = page_group_source(group_index, image, image_transport, image_format, image_quality)
+    return ocr_with_chatgpt(PROMPT, source, chat_instance, ocr_max_retries, cache=cache, image_hash=digest, on_delta=on_delta,
+                            encoding=encoding_key(image_format, image_quality))
+
+
+def open_journal(output_txt_path, journal_path=None, resume=False):
+    """
+    打开进度日志, 续跑时读取已完成的页面组, 否则清空日志。
+    :return: (OCRJournal, {组序号: 日志记录})
+    """
+    journal = OCRJournal(journal_path or f"{output_txt_path}.journal.jsonl")
+    if resume:
+        return journal, journal.load()
+    journal.reset()
+    return journal, {}
+
 
 # 5. 主流程
 def process_pdf_with_ocr_in_one(raw_pdf_path, cropped_pdf_path,  
                                 output_txt_path, chat_instance, 
                                 save_figure = False, output_figure_folder=None, 
-                                top_margin = None, bottom_margin = None,
-                                ocr_max_retries=5,  ocr_max_workers=4):
-    # Step 1: 裁剪PDF转化为图像
-    crop_pdf(raw_pdf_path, cropped_pdf_path, top_margin, bottom_margin)
-    
-    image_objects = pdf_to_images(cropped_pdf_path, output_folder = output_figure_folder, images_per_long=2, save_to_disk=save_figure)
-    
-    # oss_urls = oss_uplaoder.upload_files(image_paths)
-    oss_urls = oss_uploader.upload_images(image_objects)
-    
-    # Step 4: 使用ChatGPT进行OCR（使用OCR的线程数和重试次数）
-    ocr_results = []
-    with concurrent.futures.ThreadPoolExecutor(max_workers=ocr_max_workers) as executor:
-        future_to_url = {executor.submit(ocr_with_chatgpt, PROMPT, url, chat_instance, ocr_max_retries): i for i, url in enumerate(oss_urls)}
-        results_dict = {}
-        for future in concurrent.futures.as_completed(future_to_url):
-            index = future_to_url[future]
-            result = future.result()
-            results_dict[index] = result
-        
-        for i in range(len(oss_urls)):
-            ocr_results.append(results_dict[i])
+                                top_margin = None, bottom_margin = None, margin_aggregate='median', margin_sample_pages=None,
+                                ocr_max_retries=5,  ocr_max_workers=4,
+                                images_per_long=2, max_in_flight=None, render_workers=1,
+                                max_pixels=None, max_output_tokens=None, dpi=200, max_long_edge=None, color_mode=None,
+                                cache=None, resume=False, journal_path=None,
+                                image_transport='oss', image_format='JPEG', image_quality=85, skip_blank=True, text_layer=False,
+                                layout=False):
+    """
+    流水线方式处理 PDF：渲染一组页面后立即上传并提交 OCR，同时继续渲染下一组。
+    chat_instance 启用 stream 时, 模型的输出边生成边按页面顺序写入 output_txt_path。
+    :param cropped_pdf_path: 已不再使用，页面直接从原始 PDF 按边距裁剪渲染，保留该参数以兼容旧的调用方式
+    :param margin_aggregate: 未指定边距时自动检测页眉页脚的汇总方式 ('median'、'max' 或百分位数), 见 auto_detect_margins
+    :param margin_sample_pages: 自动检测边距时均匀抽取的页数, None 表示检测全部页面
+    :param images_per_long: 每张长图包含的页数 (设置了预算时为最多页数)
+    :param max_pixels: 每张长图的像素上限, 内容稀疏的页面会多拼几页, 减少请求次数
+    :param max_output_tokens: 每张长图预计输出 token 数的上限, 内容密集的页面少拼几页, 避免输出被截断
+    :param max_in_flight: 同时在内存中等待上传/OCR 的页面组上限，默认为 ocr_max_workers 的两倍
+    :param render_workers: 页面渲染和裁剪使用的进程数
+    :param cache: 可选的 OCRCache 实例, 命中时跳过上传和 OCR 请求
+    :param resume: 是否从进度日志续跑, 为 True 时跳过日志中已成功且图像未变化的页面组, 只重做缺失或失败的部分
+    :param journal_path: 进度日志路径, 默认为 output_txt_path 加上 .journal.jsonl 后缀
+    :param dpi: 页面渲染分辨率
+    :param max_long_edge: 拼接前将每一页的长边缩小到该像素数以内, None 表示不缩放 (见 iter_long_images)
+    :param color_mode: 上传前的颜色转换, None 保持彩色, 'L' 灰度, '1' 黑白二值
+    :param image_transport: 图片传给模型的方式, 'oss' 先上传到OSS再发送URL, 'inline' 以 base64 data URL 内嵌在请求中(跳过上传)
+    :param image_format: 图片的编码格式, 'JPEG'、'WEBP' 或 'PNG'
+    :param image_quality: JPEG/WEBP 压缩质量
+    :param skip_blank: 是否在上传前跳过空白页 (见 is_blank_page, 文本层有字符的页面不算空白), 空白页不占用长图的名额, 跳过的页码记录在进度日志中
+    :param text_layer: 是否启用文本层快速通道, 原生数字页面直接从文本层生成 Markdown, 只有扫描页才上传并调用视觉模型。
+                       含有代码、语法等列表块的页面仍交给视觉模型 (见 text_layer.has_listing_blocks); 默认关闭
+    :param layout: 是否按版面分割页面 (见 pdfpreprocesser.layout_crop): 去掉页边距和照片等非文本区域, 多栏页面按阅读顺序排成一栏
+    """
+    # 指标是模块级的, 每次运行从零开始统计, 否则同一进程中多次运行的报告会累加
+    metrics.reset()
+    # Step 1: 检测页眉页脚边距（不再生成中间 PDF）
+    if top_margin is None or bottom_margin is None:
+        with metrics.timer('crop'):
+            top_margin, bottom_margin = auto_detect_margins(raw_pdf_path, margin_sample_pages, margin_aggregate)
+
+    if max_in_flight is None:
+        max_in_flight = ocr_max_workers * 2
+
+    # 每完成一个页面组就追加到进度日志, 中断后可以续跑
+    journal, completed = open_journal(output_txt_path, journal_path, resume)
+
+    # Step 2: 逐组渲染, 上传并OCR, 结果按顺序写入文件
+    skipped_pages, group_sizes = [], []
+    page_groups = iter_long_images(raw_pdf_path, output_folder=output_figure_folder, images_per_long=images_per_long, save_to_disk=save_figure,
+                                   top_margin=top_margin, bottom_margin=bottom_margin, dpi=dpi, render_workers=render_workers,
+                                   skip_blank=skip_blank, skipped_pages=skipped_pages, text_layer=text_layer,
+                                   max_pixels=max_pixels, max_output_tokens=max_output_tokens, group_sizes=group_sizes, layout=layout,
+                                   max_long_edge=max_long_edge)
+
+    with open(output_txt_path, 'w', encoding='utf-8') as f, \
+         concurrent.futures.ThreadPoolExecutor(max_workers=ocr_max_workers) as executor:
+        writer = OrderedResultWriter(f, journal)
+
+        def collect(futures):
+            for future in futures:
+                group_index, digest, first_page, last_page = in_flight.pop(future)
+                writer.add(group_index, future.result(), digest, first_page, last_page)
+
+        in_flight = {}
+        resumed = 0
+        local_pages = 0
+        for group_index, first_page, last_page, image in page_groups:
+            if isinstance(image, str):
+                # 从文本层提取的页面, 不需要上传和OCR
+                writer.add(group_index, image, journal=False)
+                local_pages += 1
+                continue
+            # 先转换颜色再计算哈希 (缩放在拼接前已完成), 预处理参数不同的结果不会混用同一条缓存
+            with metrics.timer('prepare'):
+                image = prepare_image(image, color_mode=color_mode)
+            digest = image_hash(image)
+            entry = completed.get(group_index)
+            if entry is not None and entry['hash'] == digest:
+                writer.add(group_index, entry['result'], journal=False)
+                resumed += 1
+                continue
+
+            # 在途的页面组达到上限时, 等待至少一个完成再继续渲染
+            while len(in_flight) >= max_in_flight:
+                done, _ = concurrent.futures.wait(in_flight, return_when=concurrent.futures.FIRST_COMPLETED)
+                collect(done)
+            future = executor.submit(ocr_page_group, group_index, image, chat_instance, ocr_max_retries, cache, digest,
+                                     image_transport, image_format, image_quality, partial(writer.partial, group_index))
+            in_flight[future] = (group_index, digest, first_page, last_page)
+
+        while in_flight:
+            done, _ = concurrent.futures.wait(in_flight, return_when=concurrent.futures.FIRST_COMPLETED)
+            collect(done)
+
+    print(f"Stitched {sum(group_sizes)} pages into {len(group_sizes)} images, pages per image: {dict(sorted(Counter(group_sizes).items()))}")
+    if skip_blank:
+        journal.record_skipped(skipped_pages)
+        print(f"Skipped {len(skipped_pages)} blank pages: {skipped_pages} (recorded in {journal.journal_path})")
+    if text_layer:
+        print(f"Extracted {local_pages} pages from the text layer without OCR")
+    if resume:
+        print(f"Resumed {resumed} page groups from {journal.journal_path}")
+    if cache is not None:
+        print(cache.summary())
+    metrics.count('pages', sum(group_sizes) + local_pages + len(skipped_pages))
+    metrics.report()
+
+
+# 6. 异步主流程
+async def async_process_pdf_with_ocr_in_one(raw_pdf_path, output_txt_path, chat_instance,
+                                            save_figure=False, output_figure_folder=None,
+                                            top_margin=None, bottom_margin=None, margin_aggregate='median', margin_sample_pages=None,
+                                            ocr_max_retries=5, max_concurrency=100,
+                                            images_per_long=2, render_workers=1,
+                                            max_pixels=None, max_output_tokens=None, dpi=200, max_long_edge=None, color_mode=None,
+                                            cache=None, resume=False, journal_path=None,
+                                            image_transport='inline', image_format='JPEG', image_quality=85, skip_blank=True,
+                                            text_layer=False, layout=False):
+    """
+    process_pdf_with_ocr_in_one 的异步版本, chat_instance 需要是 AsyncChat / AsyncChat_Retry。
+    所有 OCR 请求在同一个事件循环中并发, 同时在途的页面组数量由信号量 max_concurrency 限制,
+    渲染和 OSS 上传这类阻塞操作放到线程中执行, 结果仍按页面顺序写入文件。
+    :param max_concurrency: 同时在途(已渲染未完成OCR)的页面组上限
+    其余参数与 process_pdf_with_ocr_in_one 相同
+    """
+    metrics.reset()
+    if top_margin is None or bottom_margin is None:
+        with metrics.timer('crop'):
+            top_margin, bottom_margin = await asyncio.to_thread(auto_detect_margins, raw_pdf_path,
+                                                                margin_sample_pages, margin_aggregate)
+
+    journal, completed = open_journal(output_txt_path, journal_path, resume)
+    skipped_pages, group_sizes = [], []
+    page_groups = iter_long_images(raw_pdf_path, output_folder=output_figure_folder, images_per_long=images_per_long, save_to_disk=save_figure,
+                                   top_margin=top_margin, bottom_margin=bottom_margin, dpi=dpi, render_workers=render_workers,
+                                   skip_blank=skip_blank, skipped_pages=skipped_pages, text_layer=text_layer,
+                                   max_pixels=max_pixels, max_output_tokens=max_output_tokens, group_sizes=group_sizes, layout=layout,
+                                   max_long_edge=max_long_edge)
+    semaphore = asyncio.Semaphore(max_concurrency)
 
     with open(output_txt_path, 'w', encoding='utf-8') as f:
-        f.writelines(f"{result}\n" for result in ocr_results)
+        writer = OrderedResultWriter(f, journal)
+
+        async def run_group(group_index, first_page, last_page, image, digest):
+            try:
+                upload = page_group_source(group_index, image, image_transport, image_format, image_quality)
+                result = await async_ocr_with_chatgpt(PROMPT, lambda: asyncio.to_thread(upload), chat_instance, ocr_max_retries,
+                                                      cache=cache, image_hash=digest, on_delta=partial(writer.partial, group_index),
+                                                      encoding=encoding_key(image_format, image_quality))
+                writer.add(group_index, result, digest, first_page, last_page)
+            finally:
+                semaphore.release()
+
+        tasks = []
+        resumed = 0
+        local_pages = 0
+        while True:
+            # 先占用名额再渲染下一组, 控制内存中的页面组数量
+            await semaphore.acquire()
+            group = await asyncio.to_thread(next, page_groups, None)
+            if group is None:
+                semaphore.release()
+                break
+
+            group_index, first_page, last_page, image = group
+            if isinstance(image, str):
+                writer.add(group_index, image, journal=False)
+                local_pages += 1
+                semaphore.release()
+                continue
+            with metrics.timer('prepare'):
+                image = prepare_image(image, color_mode=color_mode)
+            digest = image_hash(image)
+            entry = completed.get(group_index)
+            if entry is not None and entry['hash'] == digest:
+                writer.add(group_index, entry['result'], journal=False)
+                resumed += 1
+                semaphore.release()
+                continue
+            tasks.append(asyncio.create_task(run_group(group_index, first_page, last_page, image, digest)))
+
+        await asyncio.gather(*tasks)
+
+    print(f"Stitched {sum(group_sizes)} pages into {len(group_sizes)} images, pages per image: {dict(sorted(Counter(group_sizes).items()))}")
+    if skip_blank:
+        journal.record_skipped(skipped_pages)
+        print(f"Skipped {len(skipped_pages)} blank pages: {skipped_pages} (recorded in {journal.journal_path})")
+    if text_layer:
+        print(f"Extracted {local_pages} pages from the text layer without OCR")
+    if resume:
+        print(f"Resumed {resumed} page groups from {journal.journal_path}")
+    if cache is not None:
+        print(cache.summary())
+    metrics.count('pages', sum(group_sizes) + local_pages + len(skipped_pages))
+    metrics.report()
+
+
+# 7. 批处理主流程
+def batch_process_pdf_with_ocr(raw_pdf_path, output_txt_path, batch_client, job_store,
+                               top_margin=None, bottom_margin=None, margin_aggregate='median', margin_sample_pages=None,
+                               images_per_long=2, render_workers=1,
+                               max_pixels=None, max_output_tokens=None, dpi=200, max_long_edge=None, color_mode=None,
+                               cache=None, resume=False, journal_path=None, model=MODEL, poll_interval=30, max_rounds=3,
+                               image_transport='oss', image_format='JPEG', image_quality=85, skip_blank=True, text_layer=False,
+                               layout=False):
+    """
+    批处理方式处理 PDF: 渲染全部页面组并上传(或内嵌)后, 一次性写入 JSONL 通过 /v1/batches 提交, 轮询到完成后按页面顺序写入文件。
+    任务状态保存在 job_store 中, 中断后用相同的参数重新运行不会重复提交, 只会继续等待已提交的任务。
+    :param batch_client: BatchClient 实例
+    :param job_store: BatchJobStore 实例, 任务名称为 "PDF文件名:ocr"
+    :param model: 批处理请求使用的模型
+    :param poll_interval: 轮询任务状态的间隔（秒）
+    :param max_rounds: 失败的页面组最多重新提交的轮数, 仍失败的页面组写入 "OCR failed ..."
+    :param image_transport: 'oss' 时输入文件只包含图片URL; 'inline' 时图片内嵌在输入文件中, 文件较大时自动拆成多个任务
+    其余参数与 process_pdf_with_ocr_in_one 相同
+    """
+    metrics.reset()
+    if top_margin is None or bottom_margin is None:
+        with metrics.timer('crop'):
+            top_margin, bottom_margin = auto_detect_margins(raw_pdf_path, margin_sample_pages, margin_aggregate)
+
+    journal, completed = open_journal(output_txt_path, journal_path, resume)
+    skipped_pages, group_sizes = [], []
+    page_groups = iter_long_images(raw_pdf_path, images_per_long=images_per_long, save_to_disk=False,
+                                   top_margin=top_margin, bottom_margin=bottom_margin, dpi=dpi, render_workers=render_workers,
+                                   skip_blank=skip_blank, skipped_pages=skipped_pages, text_layer=text_layer,
+                                   max_pixels=max_pixels, max_output_tokens=max_output_tokens, group_sizes=group_sizes, layout=layout,
+                                   max_long_edge=max_long_edge)
+
+    with open(output_txt_path, 'w', encoding='utf-8') as f:
+        writer = OrderedResultWriter(f, journal)
+
+        # 渲染阶段: 文本层、续跑和缓存命中的页面组直接写入, 其余的上传后加入批处理请求
+        batch_requests, pending = [], {}
+        resumed = 0
+        local_pages = 0
+        for group_index, first_page, last_page, image in page_groups:
+            if isinstance(image, str):
+                writer.add(group_index, image, journal=False)
+                local_pages += 1
+                continue
+            with metrics.timer('prepare'):
+                image = prepare_image(image, color_mode=color_mode)
+            digest = image_hash(image)
+            entry = completed.get(group_index)
+            if entry is not None and entry['hash'] == digest:
+                writer.add(group_index, entry['result'], journal=False)
+                resumed += 1
+                continue
+            cache_key = None
+            if cache is not None:
+                cache_key = cache.make_key(digest, PROMPT, model, temperature, top_p, encoding_key(image_format, image_quality))
+            cached = cache.get(cache_key) if cache_key is not None else None
+            if cached is not None:
+                metrics.count('ocr_cache_hits')
+                writer.add(group_index, cached, digest, first_page, last_page)
+                continue
+            try:
+                url = page_group_source(group_index, image, image_transport, image_format, image_quality)()
+            except Exception as e:
+                writer.add(group_index, f"OCR failed for image_{group_index}: {e}", digest, first_page, last_page)
+                continue
+            custom_id = f"group-{group_index}"
+            batch_requests.append((custom_id, build_chat_body(PROMPT, url, model, temperature, top_p)))
+            pending[custom_id] = (group_index, digest, first_page, last_page, cache_key)
+
+        # 提交阶段: 等待批处理完成后按页面顺序写入
+        results, errors = run_batch(batch_client, job_store, f"{os.path.basename(raw_pdf_path)}:ocr", batch_requests,
+                                    poll_interval=poll_interval, max_rounds=max_rounds) if batch_requests else ({}, {})
+        for custom_id, (group_index, digest, first_page, last_page, cache_key) in pending.items():
+            if custom_id in results:
+                if cache_key is not None:
+                    cache.put(cache_key, results[custom_id])
+                writer.add(group_index, results[custom_id], digest, first_page, last_page)
+            else:
+                metrics.record('ocr', errors=1)
+                writer.add(group_index, f"OCR failed for image_{group_index}: {errors.get(custom_id)}", digest, first_page, last_page)
+
+    print(f"Stitched {sum(group_sizes)} pages into {len(group_sizes)} images, pages per image: {dict(sorted(Counter(group_sizes).items()))}")
+    print(f"Submitted {len(batch_requests)} page groups through the batch API, {len(errors)} failed")
+    if skip_blank:
+        journal.record_skipped(skipped_pages)
+        print(f"Skipped {len(skipped_pages)} blank pages: {skipped_pages} (recorded in {journal.journal_path})")
+    if text_layer:
+        print(f"Extracted {local_pages} pages from the text layer without OCR")
+    if resume:
+        print(f"Resumed {resumed} page groups from {journal.journal_path}")
+    if cache is not None:
+        print(cache.summary())
+    metrics.count('pages', sum(group_sizes) + local_pages + len(skipped_pages))
+    metrics.report()
+
+
+# 8. 多文档主流程
+class _Document:
+    def __init__(self, pdf_path, output_txt_path, resume, page_group_options, margin_options):
+        """
+        process_pdfs_with_ocr 中一个文档的处理状态: 输出文件、进度日志、页面组生成器和在途数量。
+        """
+        self.pdf_path = pdf_path
+        self.output_txt_path = output_txt_path
+        self.skipped_pages, self.group_sizes = [], []
+        self.local_pages = 0
+        self.resumed = 0
+        self.in_flight = 0
+        self.exhausted = False
+        self.error = None
+        self.start = time.perf_counter()
+
+        options = dict(page_group_options)
+        if options.get('top_margin') is None or options.get('bottom_margin') is None:
+            with metrics.timer('crop'):
+                options['top_margin'], options['bottom_margin'] = auto_detect_margins(pdf_path, **margin_options)
+        self.journal, self.completed = open_journal(output_txt_path, None, resume)
+        self.file = open(output_txt_path, 'w', encoding='utf-8')
+        self.writer = OrderedResultWriter(self.file, self.journal)
+        self.page_groups = iter_long_images(pdf_path, skipped_pages=self.skipped_pages, group_sizes=self.group_sizes, **options)
+
+    @property
+    def done(self):
+        return self.exhausted and self.in_flight == 0
+
+    def close(self):
+        self.page_groups.close()
+        self.file.close()
+        self.journal.record_skipped(self.skipped_pages)
+        metrics.count('pages', sum(self.group_sizes) + self.local_pages + len(self.skipped_pages))
+        status = "Finished" if self.error is None else f"Failed ({self.error}), partial output written"
+        print(f"{status} {self.pdf_path} -> {self.output_txt_path} in {time.perf_counter() - self.start:.1f}s: "
+              f"{sum(self.group_sizes)} pages in {len(self.group_sizes)} images, {self.local_pages} from the text layer, "
+              f"{len(self.skipped_pages)} blank, {self.resumed} resumed")
+
+
+def process_pdfs_with_ocr(pdf_paths, output_paths, chat_instance,
+                          ocr_max_retries=5, ocr_max_workers=8, max_in_flight=None, max_open_documents=4,
+                          top_margin=None, bottom_margin=None, margin_aggregate='median', margin_sample_pages=None,
+                          images_per_long=2, render_workers=1,
+                          max_pixels=None, max_output_tokens=None, dpi=200, max_long_edge=None, color_mode=None,
+                          cache=None, resume=False,
+                          image_transport='oss', image_format='JPEG', image_quality=85, skip_blank=True, text_layer=False,
+                          layout=False):
+    """
+    批量处理多个 PDF: 所有文档的页面组共用一个线程池和同一个在途上限, 逐个文档轮流取下一组提交 (公平交错),
+    前一个文档的长尾请求不会让线程池空闲, 总吞吐量只受 API 配额 (chat_instance 的限流和并发控制) 限制。
+    每个文档的结果按页面顺序写入各自的输出文件, 文档全部完成后立即关闭文件, 不必等待其他文档。
+    :param pdf_paths: PDF 路径列表
+    :param output_paths: 与 pdf_paths 一一对应的输出 TXT 路径, 进度日志为输出路径加上 .journal.jsonl 后缀
+    :param ocr_max_workers: 共享线程池的线程数
+    :param max_in_flight: 所有文档合计同时在途的页面组上限，默认为 ocr_max_workers 的两倍
+    :param max_open_documents: 同时渲染的文档数上限, 每个打开的文档占用一个输出文件和 render_workers 个渲染进程
+    其余参数与 process_pdf_with_ocr_in_one 相同, 对每个文档生效
+    """
+    if len(pdf_paths) != len(output_paths):
+        raise ValueError("pdf_paths and output_paths must have the same length")
+    metrics.reset()
+    if max_in_flight is None:
+        max_in_flight = ocr_max_workers * 2
+    page_group_options = dict(images_per_long=images_per_long, top_margin=top_margin, bottom_margin=bottom_margin, dpi=dpi,
+                              render_workers=render_workers, skip_blank=skip_blank, text_layer=text_layer,
+                              max_pixels=max_pixels, max_output_tokens=max_output_tokens, layout=layout, max_long_edge=max_long_edge)
+
+    queue = deque(zip(pdf_paths, output_paths))
+    active = deque()
+    in_flight = {}
+    failed = []
+
+    def finish(doc):
+        active.remove(doc)
+        doc.close()
+
+    def collect(futures):
+        for future in futures:
+            doc, group_index, digest, first_page, last_page = in_flight.pop(future)
+            doc.writer.add(group_index, future.result(), digest, first_page, last_page)
+            doc.in_flight -= 1
+            if doc.done:
+                finish(doc)
+
+    def next_group(doc):
+        # 取文档的下一组并提交; 文本层、续跑的页面组直接写入。返回是否提交了 OCR 请求
+        group = next(doc.page_groups, None)
+        if group is None:
+            doc.exhausted = True
+            if doc.done:
+                finish(doc)
+            return False
+        group_index, first_page, last_page, image = group
+        if isinstance(image, str):
+            doc.writer.add(group_index, image, journal=False)
+            doc.local_pages += 1
+            return False
+        with metrics.timer('prepare'):
+            image = prepare_image(image, color_mode=color_mode)
+        digest = image_hash(image)
+        entry = doc.completed.get(group_index)
+        if entry is not None and entry['hash'] == digest:
+            doc.writer.add(group_index, entry['result'], journal=False)
+            doc.resumed += 1
+            return False
+        future = executor.submit(ocr_page_group, group_index, image, chat_instance, ocr_max_retries, cache, digest,
+                                 image_transport, image_format, image_quality, partial(doc.writer.partial, group_index))
+        in_flight[future] = (doc, group_index, digest, first_page, last_page)
+        doc.in_flight += 1
+        return True
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=ocr_max_workers) as executor:
+        while queue or active or in_flight:
+            while queue and len(active) < max_open_documents:
+                pdf_path, output_txt_path = queue.popleft()
+                try:
+                    active.append(_Document(pdf_path, output_txt_path, resume, page_group_options,
+                                            dict(sample_pages=margin_sample_pages, aggregate=margin_aggregate)))
+                except Exception as e:
+                    print(f"Failed to open {pdf_path}: {e}")
+                    failed.append(pdf_path)
+
+            # 已完成的页面组立即写入, 文档全部完成时尽早关闭输出文件
+            collect([future for future in in_flight if future.done()])
+
+            # 轮流从每个还有页面的文档取一组 (取过的文档移到队尾), 直到在途数量达到上限
+            doc = next((doc for doc in active if not doc.exhausted), None)
+            if doc is not None and len(in_flight) < max_in_flight:
+                active.remove(doc)
+                active.append(doc)
+                try:
+                    next_group(doc)
+                except Exception as e:
+                    # 单个文档渲染或预处理出错 (如损坏的页面) 不影响其他文档: 停止提交该文档, 等在途的页面组完成后关闭
+                    print(f"Failed to process {doc.pdf_path}: {e}")
+                    doc.error = e
+                    doc.exhausted = True
+                    failed.append(doc.pdf_path)
+                    if doc.done:
+                        finish(doc)
+                continue
+            if in_flight:
+                done, _ = concurrent.futures.wait(in_flight, return_when=concurrent.futures.FIRST_COMPLETED)
+                collect(done)
+
+    if failed:
+        print(f"Failed to process {len(failed)} documents: {failed}")
+    if cache is not None:
+        print(cache.summary())
+    metrics.count('documents', len(pdf_paths) - len(failed))
+    metrics.report()
+    return failed
 
 
 
@@ -88,7 +573,7 @@ oss_uploader = OSSUploader(
         aliyun_oss_download_url=ALIYUNOSS_DOWNLOAD_URL,
         second_folder="pdf_ocr",
         max_retries=8,  # 上传重试次数
-        max_workers=1   # 并发线程数
+        max_workers=8   # upload_images 的并发线程数 (返回结果与输入顺序一致)
     )
 
 
@@ -97,22 +582,95 @@ chat_retry = Chat_Retry(
     model=MODEL,
     baseurl=BASE_URL,
     max_retries=5,  # 最大重试次数
-    retry_delay=2   # 每次重试的延迟时间
+    retry_delay=2,  # 每次重试的延迟时间
+    stream=True,    # 流式输出: 结果边生成边写入文件, 连接中断时从已收到的部分续写
+    pool_size=8,    # 连接池大小, 与OCR线程数保持一致
+    timeout=(10, 300),  # (连接超时, 读取超时) 秒
+    rate_limiter=get_rate_limiter(MODEL, MODEL_REQUESTS_PER_MINUTE, MODEL_TOKENS_PER_MINUTE),   # 按模型共享的限流器
+    concurrency=ConcurrencyController(initial=2, max_concurrency=8),    # 根据429和延迟自动调整并发数, 上限为OCR线程数
+    metrics_stage='llm.ocr'         # 请求耗时和 token 用量记录到该阶段
 )
 
 
 
 
-# 主程序入口
-process_pdf_with_ocr_in_one(
-    raw_pdf_path = RAW_PDF_PATH,              # 原始PDF路径
-    cropped_pdf_path = CROPPED_PDF_PATH,      # 裁剪后的PDF路径
-    output_txt_path = OCR_CONTENT_DESTINATION,                    # OCR结果保存的文本路径
-    chat_instance = chat_retry,               # 带重传机制的 Chat_Retry 实例
-    save_figure = False,                      # 是否需要保存中间图片
-    output_figure_folder=None,                # 中间图片文件目录
-    # top_margin = TOP_MARGIN,                # 裁剪的上边距(一般为了裁剪页眉页脚)  未设置则自动裁剪页眉, 设置成0不裁剪
-    # bottom_margin = BOTTOM_MARGIN,          # 裁剪的下边距
-    ocr_max_retries=5,                        # 设置OCR的重试次数覆盖
-    ocr_max_workers=2                         # 设置OCR的线程数
-)
+# 主程序入口 (多进程渲染在 Windows 上以 spawn 方式启动子进程, 必须放在 __main__ 保护下)
+if __name__ == "__main__":
+    ocr_cache = OCRCache(OCR_CACHE_PATH, max_bytes=512 * 1024 * 1024)   # OCR结果缓存, 超过大小上限后按LRU淘汰
+
+    if USE_BATCH:
+        batch_client = BatchClient(api_key=API_KEY, baseurl=BASE_URL)
+        batch_job_store = BatchJobStore(BATCH_JOB_STORE_PATH)
+        batch_process_pdf_with_ocr(
+            raw_pdf_path = RAW_PDF_PATH,
+            output_txt_path = OCR_CONTENT_DESTINATION,
+            batch_client = batch_client,              # 批处理接口客户端 (/v1/files, /v1/batches)
+            job_store = batch_job_store,              # 任务状态, 中断后重新运行继续等待已提交的任务
+            images_per_long=4,
+            render_workers=2,
+            max_pixels=5_000_000,
+            max_output_tokens=3000,
+            cache=ocr_cache,
+            color_mode='L',
+            image_format='PNG',
+            image_transport='oss',                    # 批处理输入文件只包含图片URL, 内嵌图片会使输入文件很大
+            poll_interval=60                          # 轮询任务状态的间隔(秒)
+        )
+        batch_client.close()
+        batch_job_store.close()
+    elif USE_ASYNC:
+        async_chat_retry = AsyncChat_Retry(api_key=API_KEY, model=MODEL, baseurl=BASE_URL, max_retries=5, retry_delay=2,
+                                           stream=True, pool_size=ASYNC_MAX_CONCURRENCY,
+                                           rate_limiter=get_rate_limiter(MODEL, MODEL_REQUESTS_PER_MINUTE, MODEL_TOKENS_PER_MINUTE),
+                                           concurrency=ConcurrencyController(initial=8, max_concurrency=ASYNC_MAX_CONCURRENCY),
+                                           metrics_stage='llm.ocr')
+        asyncio.run(async_process_pdf_with_ocr_in_one(
+            raw_pdf_path = RAW_PDF_PATH,
+            output_txt_path = OCR_CONTENT_DESTINATION,
+            chat_instance = async_chat_retry,         # 异步的 AsyncChat_Retry 实例
+            ocr_max_retries=5,
+            max_concurrency=ASYNC_MAX_CONCURRENCY,    # 同时在途的页面组上限
+            images_per_long=4,
+            render_workers=2,
+            max_pixels=5_000_000,
+            max_output_tokens=3000,
+            cache=ocr_cache,
+            color_mode='L',
+            image_format='PNG',
+            image_transport='inline'                  # 异步模式默认内嵌图片, 避免OSS上传成为瓶颈
+        ))
+    else:
+        process_pdf_with_ocr_in_one(
+            raw_pdf_path = RAW_PDF_PATH,              # 原始PDF路径
+            cropped_pdf_path = CROPPED_PDF_PATH,      # 裁剪后的PDF路径
+            output_txt_path = OCR_CONTENT_DESTINATION,                    # OCR结果保存的文本路径
+            chat_instance = chat_retry,               # 带重传机制的 Chat_Retry 实例
+            save_figure = False,                      # 是否需要保存中间图片
+            output_figure_folder=None,                # 中间图片文件目录
+            # top_margin = TOP_MARGIN,                # 裁剪的上边距(一般为了裁剪页眉页脚)  未设置则自动裁剪页眉, 设置成0不裁剪
+            # bottom_margin = BOTTOM_MARGIN,          # 裁剪的下边距
+            margin_aggregate='median',                # 自动检测边距的汇总方式: 'median' / 'max' / 百分位数(如 90)
+            ocr_max_retries=5,                        # 设置OCR的重试次数覆盖
+            ocr_max_workers=8,                        # 设置OCR的线程数(实际并发由 ConcurrencyController 自适应调整)
+            images_per_long=4,                        # 每张长图最多包含的页数
+            max_pixels=5_000_000,                     # 每张长图的像素上限(约两整页), 稀疏页面会多拼几页
+            max_output_tokens=3000,                   # 每张长图预计输出的token上限, 避免输出被截断
+            max_in_flight=16,                         # 同时在途(已渲染未完成OCR)的页面组上限, 控制内存占用
+            render_workers=2,                         # 页面渲染和裁剪的进程数
+            cache=ocr_cache,                          # OCR结果缓存, 设置为None不使用缓存
+            resume=False,                             # 是否从上次中断处续跑(根据进度日志跳过已完成的页面组)
+            image_transport='oss',                    # 'oss' 上传到OSS后发送URL; 'inline' 直接内嵌base64图片, 不需要OSS
+            dpi=200,                                  # 页面渲染分辨率
+            max_long_edge=None,                       # 每页长边的像素上限 (拼接前缩放), None 不缩放
+            color_mode='L',                           # 上传前的颜色转换: None 彩色 / 'L' 灰度 / '1' 黑白二值 (见 benchmarks/bench_image_prep.py)
+            image_format='PNG',                       # 图片编码格式: JPEG / WEBP / PNG (灰度PNG对文字页面无损且体积约为彩色PNG的一半)
+            image_quality=85,                         # JPEG/WEBP 的压缩质量
+            skip_blank=True,                          # 跳过空白页(不上传也不调用模型)
+            text_layer=False,                         # 原生数字PDF页面直接提取文本层(含代码的页面仍调用视觉模型), 默认关闭
+            layout=False                              # 按版面分割: 去掉页边距和照片区域, 双栏页面按阅读顺序排成一栏
+        )
+
+    if METRICS_JSONL_PATH:
+        metrics.write_jsonl(METRICS_JSONL_PATH)
+    if METRICS_PROM_PATH:
+        metrics.write_prometheus(METRICS_PROM_PATH)
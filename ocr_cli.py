@@ -0,0 +1,176 @@
+"""
+批量 OCR 的命令行入口: 一次处理多个 PDF (路径、目录或通配符), 所有文档的页面组共用一个线程池并轮流提交。
+用法: python ocr_cli.py "books/*.pdf" other.pdf --output-dir out --workers 16
+未指定的 API 参数使用 mainOCR.py 中的常量 (API_KEY, BASE_URL, MODEL), 也可以通过环境变量 OCR_API_KEY / OCR_BASE_URL 设置。
+图片默认以 base64 内嵌在请求中; 使用 --image-transport oss 时需要指定 OSS 的 bucket、endpoint 和下载地址
+(或环境变量 OCR_OSS_BUCKET / OCR_OSS_ENDPOINT / OCR_OSS_URL), 密钥从环境变量 OSS_ACCESS_KEY_ID / OSS_ACCESS_KEY_SECRET 读取。
+"""
+import argparse
+import glob
+import os
+
+import oss2
+
+import mainOCR
+from dependencies.chat import Chat_Retry
+from dependencies.metrics import metrics
+from dependencies.ocr_cache import OCRCache
+from dependencies.ratelimit import ConcurrencyController, get_rate_limiter
+from dependencies.uplaod2 import OSSUploader
+
+
+def expand_inputs(inputs):
+    """
+    展开命令行中的 PDF 路径、目录 (其中的 *.pdf) 和通配符, 去重并保持顺序。
+    """
+    paths = []
+    for item in inputs:
+        if os.path.isdir(item):
+            matches = sorted(glob.glob(os.path.join(item, "*.pdf")))
+        elif glob.has_magic(item):
+            matches = sorted(glob.glob(item, recursive=True))
+        else:
+            matches = [item]
+        for path in matches:
+            if os.path.abspath(path) not in map(os.path.abspath, paths):
+                paths.append(path)
+    return paths
+
+
+def output_paths_for(pdf_paths, output_dir=None):
+    """
+    每个 PDF 的输出路径: 指定 output_dir 时为 output_dir/文件名.txt, 否则与 PDF 放在同一目录。
+    """
+    outputs = []
+    for pdf_path in pdf_paths:
+        name = os.path.splitext(os.path.basename(pdf_path))[0] + ".txt"
+        outputs.append(os.path.join(output_dir if output_dir else os.path.dirname(pdf_path), name))
+    duplicates = {path for path in outputs if outputs.count(path) > 1}
+    if duplicates:
+        raise ValueError(f"several PDFs would be written to the same output file: {sorted(duplicates)}")
+    return outputs
+
+
+def margin_aggregate(value):
+    """
+    --margin-aggregate 的取值: 'median'、'max' 或 0-100 之间的百分位数。
+    """
+    if value in ('median', 'max'):
+        return value
+    try:
+        percentile = float(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected 'median', 'max' or a percentile between 0 and 100, got {value!r}")
+    if not 0 <= percentile <= 100:
+        raise argparse.ArgumentTypeError(f"percentile must be between 0 and 100, got {value!r}")
+    return percentile
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("inputs", nargs="+", help="PDF 文件、目录或通配符 (如 'books/**/*.pdf')")
+    parser.add_argument("-o", "--output-dir", help="输出目录, 默认与每个 PDF 放在同一目录")
+    parser.add_argument("--workers", type=int, default=8, help="所有文档共用的 OCR 线程数")
+    parser.add_argument("--max-in-flight", type=int, help="所有文档合计同时在途的页面组上限, 默认为线程数的两倍")
+    parser.add_argument("--max-open-documents", type=int, default=4, help="同时渲染的文档数上限")
+    parser.add_argument("--render-workers", type=int, default=1, help="每个打开的文档使用的渲染进程数")
+    parser.add_argument("--images-per-long", type=int, default=4)
+    parser.add_argument("--max-pixels", type=int, default=5_000_000)
+    parser.add_argument("--max-output-tokens", type=int, default=3000)
+    parser.add_argument("--dpi", type=int, default=200)
+    parser.add_argument("--margin-aggregate", type=margin_aggregate, default='median',
+                        help="自动检测页眉页脚的汇总方式: median / max / 0-100 的百分位数")
+    parser.add_argument("--margin-sample-pages", type=int, help="自动检测边距时均匀抽取的页数, 默认检测全部页面")
+    parser.add_argument("--color-mode", default='L', help="None 彩色 / L 灰度 / 1 黑白二值")
+    parser.add_argument("--image-format", default='PNG', choices=['PNG', 'JPEG', 'WEBP'])
+    parser.add_argument("--image-transport", default='inline', choices=['oss', 'inline'],
+                        help="inline 以 base64 内嵌在请求中; oss 先上传到 OSS 再发送 URL, 需要指定 --oss-bucket/--oss-endpoint/--oss-url")
+    parser.add_argument("--oss-bucket", default=os.environ.get("OCR_OSS_BUCKET"), help="OSS bucket 名称")
+    parser.add_argument("--oss-endpoint", default=os.environ.get("OCR_OSS_ENDPOINT"), help="OSS 上传 endpoint, 如 oss-cn-hongkong.aliyuncs.com")
+    parser.add_argument("--oss-url", default=os.environ.get("OCR_OSS_URL"), help="模型下载图片使用的地址前缀, 如 https://bucket.example.com")
+    parser.add_argument("--text-layer", action="store_true", help="原生数字页面直接提取文本层, 含代码的页面和扫描页仍走视觉模型")
+    parser.add_argument("--no-skip-blank", action="store_true", help="不跳过空白页")
+    parser.add_argument("--layout", action="store_true", help="按版面分割页面: 去掉页边距和照片区域, 多栏页面按阅读顺序排成一栏")
+    parser.add_argument("--cache", help=f"OCR结果缓存路径, 默认为输出目录 (未指定时为当前目录) 下的 {mainOCR.OCR_CACHE_NAME}, 设为空字符串不使用缓存")
+    parser.add_argument("--resume", action="store_true", help="根据各文档的进度日志续跑")
+    parser.add_argument("--api-key", default=os.environ.get("OCR_API_KEY", mainOCR.API_KEY))
+    parser.add_argument("--base-url", default=os.environ.get("OCR_BASE_URL", mainOCR.BASE_URL))
+    parser.add_argument("--model", default=mainOCR.MODEL)
+    parser.add_argument("--requests-per-minute", type=int, default=mainOCR.MODEL_REQUESTS_PER_MINUTE)
+    parser.add_argument("--tokens-per-minute", type=int, default=mainOCR.MODEL_TOKENS_PER_MINUTE)
+    parser.add_argument("--metrics-jsonl", help="指标汇总追加到该 JSONL 文件")
+    parser.add_argument("--metrics-prom", help="Prometheus 文本格式的指标文件")
+    args = parser.parse_args()
+
+    pdf_paths = expand_inputs(args.inputs)
+    if not pdf_paths:
+        parser.error("no PDF files matched")
+    missing = [path for path in pdf_paths if not os.path.isfile(path)]
+    if missing:
+        parser.error(f"file(s) not found: {', '.join(missing)}")
+    try:
+        output_paths = output_paths_for(pdf_paths, args.output_dir)
+    except ValueError as e:
+        parser.error(str(e))
+    if args.image_transport == 'oss':
+        missing = [option for option, value in (("--oss-bucket", args.oss_bucket), ("--oss-endpoint", args.oss_endpoint),
+                                                ("--oss-url", args.oss_url)) if not value]
+        if missing:
+            parser.error(f"--image-transport oss requires {', '.join(missing)}")
+        # page_group_source 上传时使用 mainOCR 的模块级上传器
+        try:
+            mainOCR.oss_uploader = OSSUploader(args.oss_bucket, args.oss_endpoint, args.oss_url.rstrip('/'), second_folder="pdf_ocr",
+                                               max_retries=8, max_workers=8)
+        except oss2.exceptions.ClientError as e:
+            parser.error(f"invalid OSS configuration: {e.body}")
+    if args.output_dir:
+        os.makedirs(args.output_dir, exist_ok=True)
+    if args.cache is None:
+        args.cache = os.path.join(args.output_dir or ".", mainOCR.OCR_CACHE_NAME)
+    if args.cache and os.path.dirname(args.cache):
+        os.makedirs(os.path.dirname(args.cache), exist_ok=True)
+
+    chat = Chat_Retry(api_key=args.api_key, model=args.model, baseurl=args.base_url, max_retries=5, retry_delay=2, stream=True,
+                      pool_size=args.workers,
+                      rate_limiter=get_rate_limiter(args.model, args.requests_per_minute, args.tokens_per_minute),
+                      concurrency=ConcurrencyController(initial=2, max_concurrency=args.workers),
+                      metrics_stage='llm.ocr')
+    cache = OCRCache(args.cache, max_bytes=512 * 1024 * 1024) if args.cache else None
+    print(f"Processing {len(pdf_paths)} PDFs with {args.workers} shared workers")
+    try:
+        failed = mainOCR.process_pdfs_with_ocr(
+            pdf_paths, output_paths, chat,
+            ocr_max_workers=args.workers,
+            max_in_flight=args.max_in_flight,
+            max_open_documents=args.max_open_documents,
+            images_per_long=args.images_per_long,
+            render_workers=args.render_workers,
+            max_pixels=args.max_pixels,
+            max_output_tokens=args.max_output_tokens,
+            dpi=args.dpi,
+            margin_aggregate=args.margin_aggregate,
+            margin_sample_pages=args.margin_sample_pages,
+            color_mode=None if args.color_mode == 'None' else args.color_mode,
+            cache=cache,
+            resume=args.resume,
+            image_transport=args.image_transport,
+            image_format=args.image_format,
+            skip_blank=not args.no_skip_blank,
+            text_layer=args.text_layer,
+            layout=args.layout,
+        )
+    finally:
+        chat.close()
+        if cache is not None:
+            cache.close()
+
+    if args.metrics_jsonl:
+        metrics.write_jsonl(args.metrics_jsonl)
+    if args.metrics_prom:
+        metrics.write_prometheus(args.metrics_prom)
+    return 1 if failed else 0
+
+
+# 多进程渲染在 Windows 上以 spawn 方式启动子进程, 必须放在 __main__ 保护下
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,54 @@
+"""
+dependencies/batch.py 的测试, 批处理接口由 benchmarks/mock_services.py 中的 MockBatchServer 模拟。
+"""
+import os
+import random
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.mock_services import MockBatchServer
+from dependencies.batch import BatchClient, BatchJobStore, run_batch
+from dependencies.chat import build_chat_body
+
+
+def make_requests(count):
+    return [(f"req-{i}", build_chat_body(f"text {i}", None, "mock-model", 0.0, 1.0)) for i in range(count)]
+
+
+def test_run_batch_resubmits_failures_and_resumes(tmp_path):
+    batch_requests = make_requests(30)
+    random.seed(3)
+    with MockBatchServer(processing_time=0.05, failure_rate=0.3, echo=True) as server:
+        client = BatchClient("test", server.url)
+        store = BatchJobStore(str(tmp_path / "batch_jobs.sqlite3"))
+        # 每个输入文件最多 4 个请求: 第一轮的 8 个分片一起提交, 只有重新提交失败的请求才算新的一轮
+        results, errors = run_batch(client, store, "doc:ocr", batch_requests, poll_interval=0.01, max_rounds=6, max_requests=4)
+        submitted = server.submitted_requests
+
+        assert errors == {}
+        assert results == {custom_id: f"text {custom_id[4:]}" for custom_id, _ in batch_requests}
+        assert submitted > len(batch_requests)
+        assert len(server.batches) > -(-len(batch_requests) // 4)
+
+        # 相同的请求再次运行: 结果全部来自任务状态库, 不再提交
+        assert run_batch(client, store, "doc:ocr", batch_requests, poll_interval=0.01) == (results, {})
+        assert server.submitted_requests == submitted
+        client.close()
+        store.close()
+
+
+def test_run_batch_reports_requests_that_keep_failing(tmp_path):
+    batch_requests = make_requests(5)
+    with MockBatchServer(processing_time=0.0, failure_rate=1.0) as server:
+        client = BatchClient("test", server.url)
+        store = BatchJobStore(str(tmp_path / "batch_jobs.sqlite3"))
+        results, errors = run_batch(client, store, "doc:ocr", batch_requests, poll_interval=0.01, max_rounds=2, max_requests=2)
+        client.close()
+        store.close()
+
+    assert results == {}
+    assert sorted(errors) == [custom_id for custom_id, _ in batch_requests]
+    # 两轮, 每轮 3 个输入文件
+    assert server.submitted_requests == 2 * len(batch_requests)
+    assert len(server.batches) == 6
@@ -0,0 +1,34 @@
+"""
+ocr_cli.py 的参数校验测试。
+"""
+import argparse
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import ocr_cli
+
+TEST_PDF = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "test.pdf")
+
+
+def test_margin_aggregate_values():
+    assert ocr_cli.margin_aggregate("median") == "median"
+    assert ocr_cli.margin_aggregate("max") == "max"
+    assert ocr_cli.margin_aggregate("90") == 90.0
+    for value in ("mean", "150", "-1"):
+        with pytest.raises(argparse.ArgumentTypeError):
+            ocr_cli.margin_aggregate(value)
+
+
+@pytest.mark.parametrize("extra", [["--margin-aggregate", "p90"], ["--image-transport", "oss"]])
+def test_invalid_options_exit_with_usage_error(monkeypatch, capsys, extra):
+    for name in ("OCR_OSS_BUCKET", "OCR_OSS_ENDPOINT", "OCR_OSS_URL"):
+        monkeypatch.delenv(name, raising=False)
+    monkeypatch.setattr(sys, "argv", ["ocr_cli.py", TEST_PDF] + extra)
+    with pytest.raises(SystemExit) as exc_info:
+        ocr_cli.main()
+    assert exc_info.value.code == 2
+    assert extra[0] in capsys.readouterr().err
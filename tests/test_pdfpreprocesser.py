@@ -0,0 +1,150 @@
+"""
+dependencies/pdfpreprocesser.py 的测试, 测试用的 PDF 用 PyMuPDF 在临时目录中生成。
+"""
+import os
+import random
+import sys
+
+import fitz
+import pytest
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from dependencies.pdfpreprocesser import (auto_detect_margins, is_blank_page, iter_long_images, page_clip_rect, render_page,
+                                          segment_page)
+
+
+@pytest.fixture
+def cropbox_inset_pdf(tmp_path):
+    # MediaBox 为 600x800, CropBox 上下各内缩 100pt, 可见区域 (page.rect) 为 600x600
+    path = str(tmp_path / "cropbox.pdf")
+    with fitz.open() as doc:
+        page = doc.new_page(width=600, height=800)
+        page.set_cropbox(fitz.Rect(0, 100, 600, 700))
+        page.insert_text((50, 20), "Running header", fontsize=10)
+        for i in range(20):
+            page.insert_text((50, 100 + i * 20), f"body line {i}", fontsize=11)
+        page.insert_text((50, 590), "Page footer 12", fontsize=10)
+        doc.save(path)
+    return path
+
+
+def test_margins_cropped_on_cropbox_inset_page(cropbox_inset_pdf):
+    top_margin, bottom_margin = auto_detect_margins(cropbox_inset_pdf)
+    assert top_margin > 0 and bottom_margin > 0
+
+    with fitz.open(cropbox_inset_pdf) as doc:
+        page = doc[0]
+        clip = page_clip_rect(page, top_margin, bottom_margin)
+        # 边距相对于 page.rect, 不能再按 CropBox 与 MediaBox 的间距抵消一次
+        assert clip == fitz.Rect(0, top_margin, 600, 600 - bottom_margin)
+        text = page.get_text("text", clip=clip)
+        assert "body line 0" in text and "body line 19" in text
+        assert "Running header" not in text and "Page footer" not in text
+
+        image = render_page(page, top_margin, bottom_margin, dpi=72)
+        # 裁剪区域的边界按像素向外取整
+        assert abs(image.height - clip.height) <= 2
+
+
+def test_max_long_edge_scales_each_page_before_stitching(tmp_path):
+    path = str(tmp_path / "pages.pdf")
+    with fitz.open() as doc:
+        for page_num in range(4):
+            page = doc.new_page(width=595, height=842)
+            page.insert_text((50, 60), f"Page {page_num + 1} first line", fontsize=12)
+            page.insert_text((50, 790), f"Page {page_num + 1} last line", fontsize=12)
+        doc.save(path)
+
+    groups = list(iter_long_images(path, images_per_long=4, dpi=150, max_long_edge=1000))
+    assert len(groups) == 1
+    _, first_page, last_page, long_image = groups[0]
+    assert (first_page, last_page) == (1, 4)
+    # 每页 (裁掉上下空白后) 的长边即高度缩到 1000 像素, 宽度仍在 700 像素以上; 缩放整张长图时宽度只剩约 1/4
+    assert long_image.height == 4 * 1000
+    assert long_image.width >= 700
+
+
+@pytest.fixture
+def sparse_pages_pdf(tmp_path):
+    # 1: 正文页, 2: 空白页, 3: 只有一个页码 (8pt), 4: 只有一个短标题, 5: 只有极浅的文字 (图像几乎空白, 但文本层有字符)
+    path = str(tmp_path / "sparse.pdf")
+    with fitz.open() as doc:
+        page = doc.new_page(width=595, height=842)
+        for i in range(30):
+            page.insert_text((60, 80 + i * 22), f"Body text line {i}", fontsize=11)
+        doc.new_page(width=595, height=842)
+        doc.new_page(width=595, height=842).insert_text((290, 800), "12", fontsize=8)
+        doc.new_page(width=595, height=842).insert_text((250, 400), "Part II", fontsize=14)
+        doc.new_page(width=595, height=842).insert_text((60, 80), "faint", fontsize=4, color=(0.99, 0.99, 0.99))
+        doc.save(path)
+    return path
+
+
+def test_is_blank_page_ignores_scan_noise_only():
+    image = Image.new('RGB', (1654, 2339), 'white')
+    assert is_blank_page(image)
+    # 一两个孤立的噪点仍视为空白
+    for x, y in ((100, 200), (900, 1500)):
+        image.putpixel((x, y), (0, 0, 0))
+    assert is_blank_page(image)
+
+
+def test_skip_blank_keeps_sparse_pages(sparse_pages_pdf):
+    skipped = []
+    with fitz.open(sparse_pages_pdf) as doc:
+        assert not is_blank_page(render_page(doc[2]))
+        assert not is_blank_page(render_page(doc[3]))
+        assert is_blank_page(render_page(doc[1]))
+
+    groups = list(iter_long_images(sparse_pages_pdf, images_per_long=1, skip_blank=True, skipped_pages=skipped))
+    assert skipped == [2]
+    # 只有页码、短标题和文本层有字符的浅色页面都保留
+    assert [(first_page, last_page) for _, first_page, last_page, _ in groups] == [(1, 1), (3, 3), (4, 4), (5, 5)]
+
+
+def ragged_column(page, rng, left, width=235, lines=55):
+    # 左对齐、右侧不对齐的正文栏: 每行长度为栏宽的 55%~100%, 每 9 行空一行分段
+    words = "the of and a to in is was that for it with as his on be at by had are but from or have an they which".split()
+    for i in range(lines):
+        if i % 9 == 8:
+            continue
+        line, target = "", width * rng.uniform(0.55, 1.0)
+        while True:
+            word = rng.choice(words)
+            if fitz.get_text_length(f"{line} {word}", fontsize=10) > target:
+                break
+            line = f"{line} {word}".strip()
+        page.insert_text((left, 70 + i * 13), line, fontsize=10)
+
+
+def test_segment_page_splits_ragged_right_columns():
+    rng = random.Random(0)
+    with fitz.open() as doc:
+        page = doc.new_page(width=595, height=842)
+        ragged_column(page, rng, 50)
+        ragged_column(page, rng, 310)
+        image = render_page(page, dpi=150)
+
+    boxes = segment_page(image)
+    middle = image.width // 2
+    # 每个区域都只在一栏之内, 先左栏后右栏
+    assert all(right < middle or left > middle for left, _, right, _ in boxes)
+    sides = [int(left > middle) for left, _, _, _ in boxes]
+    assert sides == sorted(sides) and sides[0] == 0 and sides[-1] == 1
+
+
+def test_segment_page_keeps_code_with_trailing_comments():
+    rng = random.Random(0)
+    with fitz.open() as doc:
+        page = doc.new_page(width=595, height=842)
+        for i in range(55):
+            code = " " * rng.choice([0, 4, 8]) + f"x{i} = compute({', '.join('a' * rng.randint(1, 4) for _ in range(rng.randint(0, 4)))})"
+            page.insert_text((50, 70 + i * 12), code, fontsize=9, fontname='cour')
+            if rng.random() < 0.6:
+                page.insert_text((330, 70 + i * 12), f"# comment about step {i}", fontsize=9, fontname='cour')
+        image = render_page(page, dpi=150)
+
+    # 代码和右侧对齐的注释之间的空白不是分栏
+    assert len(segment_page(image)) == 1
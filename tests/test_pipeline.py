@@ -0,0 +1,164 @@
+"""
+使用 benchmarks/mock_services.py 中的模拟服务测试 OCR 流水线, 不需要网络和 API 密钥。
+运行: python -m pytest -q tests
+"""
+import asyncio
+import io
+import os
+import random
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import mainOCR
+from benchmarks.mock_services import MockBucket, MockChatServer
+from dependencies.async_chat import AsyncChat_Retry
+from dependencies.chat import Chat, Chat_Retry
+from dependencies.metrics import metrics
+from dependencies.ocr_cache import OCRCache
+from dependencies.ocr_journal import OrderedResultWriter
+from dependencies.uplaod2 import OSSUploader
+
+TEST_PDF = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "test.pdf")
+
+
+@pytest.fixture
+def mock_uploader(monkeypatch):
+    # 替换 mainOCR 中的模块级上传器, 图片上传到内存中的 MockBucket
+    bucket = MockBucket()
+    monkeypatch.setattr(mainOCR, "oss_uploader",
+                        OSSUploader("test", "mock-oss", "https://mock-oss", second_folder="pdf_ocr", bucket=bucket))
+    return bucket
+
+
+def test_stream_resumes_after_drop():
+    # 回显不重复的长文本: 周期性的回复 (如 response_size 生成的) 会被 strip_overlap 当作模型重复的开头
+    prompt = "".join(f"line {i}\n" for i in range(300))
+    random.seed(0)
+    with MockChatServer(echo=True, stream_drop_rate=0.5) as server:
+        expected = Chat(api_key="test", model="mock-model", baseurl=server.url).send_request(prompt)
+        chat = Chat_Retry(api_key="test", model="mock-model", baseurl=server.url, stream=True, max_retries=20, retry_delay=0.01)
+        deltas = [[] for _ in range(10)]
+        results = [chat.send_request(prompt, on_delta=deltas[i].append) for i in range(10)]
+        dropped = server.server.dropped_count
+        requests = server.server.request_count
+
+    assert dropped > 0
+    # 每次中断都多一个续写请求, 而续写后的结果与完整回复一致 (没有重复或缺失)
+    assert requests == 1 + 10 + dropped
+    assert expected == prompt
+    assert results == [expected] * 10
+    # 续写而不是从头重新生成: 流式回调收到的文本恰好是完整回复一次
+    assert ["".join(parts) for parts in deltas] == [expected] * 10
+
+
+def test_backoff_on_429_honours_retry_after():
+    random.seed(1)
+    with MockChatServer(throttle_rate=0.5, retry_after=0.2) as server:
+        chat = Chat_Retry(api_key="test", model="mock-model", baseurl=server.url, max_retries=20, retry_delay=0.01)
+        start = time.monotonic()
+        results = [chat.send_request("ocr") for _ in range(6)]
+        elapsed = time.monotonic() - start
+        throttled = server.server.throttled_count
+        requests = server.server.request_count
+
+    assert results == ["mock response"] * 6
+    assert throttled > 0
+    assert requests == 6 + throttled
+    # 每次 429 之后按 Retry-After 等待, 而不是按 retry_delay 立即重试
+    assert elapsed >= throttled * 0.2
+
+
+def test_async_client_resumes_and_backs_off():
+    # 异步客户端 (httpx) 的续写和 429 重试规则与同步版本相同
+    prompt = "".join(f"line {i}\n" for i in range(300))
+    random.seed(2)
+    with MockChatServer(echo=True, stream_drop_rate=0.3, throttle_rate=0.3, retry_after=0.05) as server:
+        async def run():
+            chat = AsyncChat_Retry(api_key="test", model="mock-model", baseurl=server.url, stream=True, max_retries=20, retry_delay=0.01)
+            try:
+                return await asyncio.gather(*(chat.send_request(prompt) for _ in range(10)))
+            finally:
+                await chat.close()
+        results = asyncio.run(run())
+        dropped, throttled = server.server.dropped_count, server.server.throttled_count
+
+    assert dropped > 0 and throttled > 0
+    assert results == [prompt] * 10
+
+
+def test_ordered_output_with_out_of_order_streams():
+    # 各组的请求乱序完成, 流式输出边生成边写入, 文件中仍按组序号排列
+    output = io.StringIO()
+    writer = OrderedResultWriter(output)
+    with MockChatServer(echo=True, response_size=200) as server:
+        chat = Chat(api_key="test", model="mock-model", baseurl=server.url, stream=True)
+
+        def ocr(index):
+            time.sleep(random.uniform(0, 0.05))
+            writer.add(index, chat.send_request(f"group {index:02d} " + "x" * 40, on_delta=partial(writer.partial, index)))
+
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            list(executor.map(ocr, reversed(range(20))))
+
+    assert output.getvalue() == "".join(f"group {index:02d} " + "x" * 40 + "\n" for index in range(20))
+
+
+def test_cache_hit_skips_upload_and_ocr(tmp_path, mock_uploader):
+    cache = OCRCache(str(tmp_path / "ocr_cache.sqlite3"))
+    with MockChatServer(response_text="page text") as server:
+        chat = Chat_Retry(api_key="test", model="mock-model", baseurl=server.url, max_retries=3)
+        options = dict(images_per_long=1, top_margin=0, bottom_margin=0, cache=cache, image_transport='oss')
+        mainOCR.process_pdf_with_ocr_in_one(TEST_PDF, None, str(tmp_path / "first.txt"), chat, **options)
+        first_requests, first_uploads = server.server.request_count, mock_uploader.request_count
+        misses = cache.misses
+
+        mainOCR.process_pdf_with_ocr_in_one(TEST_PDF, None, str(tmp_path / "second.txt"), chat, **options)
+        chat.close()
+        second_requests = server.server.request_count
+    cache.close()
+
+    assert first_requests > 0 and first_uploads > 0
+    # 第二次运行全部命中缓存: 没有新的 OCR 请求, 也不上传图片
+    assert second_requests == first_requests
+    assert mock_uploader.request_count == first_uploads
+    assert cache.hits == misses
+    assert (tmp_path / "second.txt").read_text(encoding='utf-8') == (tmp_path / "first.txt").read_text(encoding='utf-8')
+
+
+def test_cache_key_includes_image_encoding(tmp_path):
+    cache = OCRCache(str(tmp_path / "ocr_cache.sqlite3"))
+    with MockChatServer(response_text="page text") as server:
+        chat = Chat_Retry(api_key="test", model="mock-model", baseurl=server.url, max_retries=3)
+        requests = []
+        for run, (image_format, image_quality) in enumerate([('JPEG', 30), ('PNG', 30), ('PNG', 90), ('JPEG', 90)]):
+            mainOCR.process_pdf_with_ocr_in_one(TEST_PDF, None, str(tmp_path / f"run{run}.txt"), chat, images_per_long=3,
+                                                top_margin=0, bottom_margin=0, cache=cache, image_transport='inline',
+                                                image_format=image_format, image_quality=image_quality)
+            requests.append(server.server.request_count)
+        chat.close()
+    cache.close()
+
+    # 低质量 JPEG 的结果不会在要求 PNG 时复用; PNG 忽略 quality, 第三次命中缓存; JPEG 质量不同时重新 OCR
+    assert requests == [1, 2, 2, 3]
+
+
+def test_metrics_reset_per_run(tmp_path):
+    # 同一进程中连续运行, 每次的报告只包含本次运行的页数和请求
+    with MockChatServer(response_text="page text") as server:
+        chat = Chat_Retry(api_key="test", model="mock-model", baseurl=server.url, max_retries=3, metrics_stage='llm.ocr')
+        summaries = []
+        for run in range(3):
+            mainOCR.process_pdf_with_ocr_in_one(TEST_PDF, None, str(tmp_path / f"run{run}.txt"), chat,
+                                                images_per_long=1, top_margin=0, bottom_margin=0, image_transport='inline')
+            summaries.append(metrics.summary())
+        chat.close()
+
+    assert [summary["counters"]["pages"] for summary in summaries] == [3, 3, 3]
+    assert [summary["stages"]["llm.ocr"]["count"] for summary in summaries] == [3, 3, 3]
+    assert summaries[0]["started"] < summaries[1]["started"] < summaries[2]["started"]
@@ -0,0 +1,150 @@
+"""
+dependencies/text_translater.py 的测试, 模型请求发往 benchmarks/mock_services.py 中的 MockChatServer。
+"""
+import os
+import random
+import sys
+import threading
+import time
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.mock_services import MockChatServer
+from dependencies.text_translater import (Translator, estimate_text_tokens, iter_split_file, split_string,
+                                          split_with_anchors)
+from dependencies.translation_manifest import TranslationManifest
+from dependencies.translation_memory import TranslationMemory
+
+
+def make_book(chapters=40, seed=0):
+    # 带编号标题的 Markdown, 章节长短不一, 其中几章远超单个片段的上限
+    rng = random.Random(seed)
+    parts = []
+    for chapter in range(1, chapters + 1):
+        parts.append(f"# {chapter}. Chapter {chapter}\n\n")
+        for paragraph in range(rng.choice([1, 3, 8, 60])):
+            parts.append(" ".join(f"word{rng.randint(0, 999)}" for _ in range(rng.randint(5, 60))) + "\n\n")
+    return "".join(parts)
+
+
+class SlowChat:
+    # 包装翻译模型: 提示词中含有 marker 的请求先等待 delay 秒
+    def __init__(self, chat, marker, delay):
+        self.chat = chat
+        self.model = chat.model
+        self.marker = marker
+        self.delay = delay
+        self.finished = None
+
+    def __call__(self, prompt, **kwargs):
+        if self.marker in prompt:
+            time.sleep(self.delay)
+            self.finished = time.monotonic()
+        return self.chat(prompt, **kwargs)
+
+
+def test_translate_batch_delivers_polished_results_before_slowest_translation():
+    with MockChatServer(echo=True) as server:
+        translator = Translator("translate-model", "polish-model", "test", server.url)
+        slow = translator.translation_chat = SlowChat(translator.translation_chat, "slow chunk", 1.0)
+        delivered = []
+        lock = threading.Lock()
+
+        def on_result(idx, result):
+            with lock:
+                delivered.append((idx, time.monotonic(), result))
+
+        results, errors = translator.translate_batch(["slow chunk", "fast chunk 1", "fast chunk 2"], polish=True,
+                                                     translation_workers=3, polishing_workers=3, on_result=on_result)
+
+    assert errors == {}
+    assert all(results)
+    order = [idx for idx, _, _ in delivered]
+    assert sorted(order[:2]) == [1, 2] and order[2] == 0
+    # 快的片段润色完成后立即交付, 不等最慢的翻译结束
+    assert all(delivered_at < slow.finished for idx, delivered_at, _ in delivered if idx != 0)
+
+
+@pytest.mark.parametrize("length_function", [len, estimate_text_tokens])
+def test_split_string_bounds(tmp_path, length_function):
+    text = make_book()
+    min_length, max_length = (3000, 4000) if length_function is len else (800, 1000)
+    chunks = split_string(text, min_length, max_length, length_function=length_function)
+
+    assert "".join(chunks) == text
+    assert len(chunks) > 5
+    assert all(length_function(chunk) <= max_length for chunk in chunks)
+    # 短于 min_length 的片段只能是因为再并入下一部分就会超过 max_length
+    for chunk, next_chunk in zip(chunks, chunks[1:]):
+        assert length_function(chunk) >= min_length or length_function(chunk) + length_function(next_chunk) > max_length
+
+    path = tmp_path / "book.md"
+    path.write_text(text, encoding='utf-8')
+    assert list(iter_split_file(str(path), min_length, max_length, length_function=length_function)) == chunks
+
+
+def test_split_string_hard_splits_a_single_long_line():
+    text = "# 1. Title\n" + "x" * 10000
+    chunks = split_string(text, 500, 1000)
+    assert "".join(chunks) == text
+    assert all(len(chunk) <= 1000 for chunk in chunks)
+
+
+def test_translation_memory_reuses_paragraphs(tmp_path):
+    texts = ["First paragraph.\n\nSecond paragraph.\n\n```\ncode()\n```", "Third paragraph."]
+    with MockChatServer(echo=True) as server:
+        memory = TranslationMemory(str(tmp_path / "memory.sqlite3"))
+        translator = Translator("translate-model", "polish-model", "test", server.url, memory=memory)
+        first, errors = translator.translate_batch(texts, polish=True)
+        assert errors == {}
+        requests = server.server.request_count
+        assert requests == 4     # 两个片段各一次翻译和一次润色, 代码块不发给模型
+        assert memory.summary() == ("Translation memory: 0 paragraphs reused, 3 paragraphs sent to the model, "
+                                    "1 code blocks passed through")
+
+        # 相同的片段直接使用记忆库中的翻译和润色结果
+        again, errors = translator.translate_batch(texts, polish=True)
+        assert errors == {}
+        assert again == first
+        assert server.server.request_count == requests
+        # 计数只统计本次调用
+        assert memory.summary().startswith("Translation memory: 3 paragraphs reused, 0 paragraphs sent to the model")
+        memory.close()
+
+
+def test_translation_memory_reuses_paragraphs_in_new_chunks(tmp_path):
+    with MockChatServer(echo=True) as server:
+        memory = TranslationMemory(str(tmp_path / "memory.sqlite3"))
+        translator = Translator("translate-model", "polish-model", "test", server.url, memory=memory)
+        translator.translate_batch(["First paragraph.\n\nSecond paragraph."])
+        assert server.server.request_count == 1
+
+        # 回复的段落数与原文一致时按段落保存, 重新组合的片段只翻译新段落
+        results, errors = translator.translate_batch(["Second paragraph.\n\nFirst paragraph.\n\nNew paragraph."])
+        assert errors == {}
+        assert server.server.request_count == 2
+        assert results[0].endswith("New paragraph.")
+        memory.close()
+
+
+def test_manifest_reuses_unchanged_chunks(tmp_path):
+    text = make_book(chapters=12, seed=1)
+    chunks = split_string(text, 3000, 4000)
+    path = str(tmp_path / "book.manifest.json")
+    manifest = TranslationManifest(path, context="model-a")
+    manifest.save(chunks, [f"translated {i}" for i in range(len(chunks))])
+
+    # 只修改第一章: 按上次的锚点切分, 后面的片段边界不变, 可以直接复用
+    edited = text.replace("# 1. Chapter 1\n\n", "# 1. Chapter 1\n\nA new opening paragraph.\n\n", 1)
+    manifest = TranslationManifest(path, context="model-a")
+    assert manifest.load()
+    new_chunks = split_with_anchors(edited, manifest.anchors(), 3000, 4000)
+    assert "".join(new_chunks) == edited
+    reused = [manifest.lookup(chunk) for chunk in new_chunks]
+    assert reused[0] is None
+    assert reused[1:] == [f"translated {i}" for i in range(1, len(chunks))]
+
+    # 模型或提示词变化时清单作废
+    assert not TranslationManifest(path, context="model-b").load()
@@ -0,0 +1,72 @@
+"""
+dependencies/uplaod2.py 的测试, 使用 benchmarks/mock_services.py 中内存里的 MockBucket 代替 OSS。
+"""
+import os
+import sys
+
+import pytest
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.mock_services import MockBucket
+from dependencies.uplaod2 import OSSUploader
+
+
+@pytest.fixture
+def bucket(monkeypatch):
+    bucket = MockBucket()
+    bucket.head_count = 0
+    object_exists = bucket.object_exists
+
+    def counting_object_exists(key):
+        bucket.head_count += 1
+        return object_exists(key)
+    monkeypatch.setattr(bucket, "object_exists", counting_object_exists)
+    return bucket
+
+
+def make_uploader(bucket, **kwargs):
+    return OSSUploader("test", "mock-oss", "https://mock-oss", second_folder="pdf_ocr", bucket=bucket, **kwargs)
+
+
+@pytest.mark.parametrize("multipart_threshold", [5 * 1024 * 1024, 100])
+def test_content_hash_upload_is_one_request(bucket, multipart_threshold):
+    image = Image.new('RGB', (300, 300), 'white')
+    first = make_uploader(bucket, multipart_threshold=multipart_threshold)
+    urls = first.upload_image(None, image)
+    assert bucket.head_count == 0
+    assert first.uploaded == 1
+    if multipart_threshold > 100:
+        # 新对象只有一次 PUT, 不再先发 HEAD
+        assert bucket.request_count == 1
+
+    # 另一个进程 (不知道对象已存在) 上传相同内容: 一次不覆盖的上传, 409 视为已上传
+    requests = bucket.request_count
+    second = make_uploader(bucket, multipart_threshold=multipart_threshold)
+    assert second.upload_image(None, image) == urls
+    assert bucket.request_count == requests + 1
+    assert (second.uploaded, second.skipped) == (0, 1)
+    assert bucket.head_count == 0
+
+    # 同一个上传器再次上传时直接返回, 不发请求
+    assert second.upload_image(None, image) == urls
+    assert bucket.request_count == requests + 1
+
+
+def test_skip_if_exists_still_uses_head(bucket):
+    uploader = make_uploader(bucket)
+    assert uploader._upload_single("pdf_ocr/a.txt", b"data", skip_if_exists=True) == "https://mock-oss/pdf_ocr/a.txt"
+    assert uploader._upload_single("pdf_ocr/a.txt", b"data", skip_if_exists=True) == "https://mock-oss/pdf_ocr/a.txt"
+    assert bucket.head_count == 1
+    assert (uploader.uploaded, uploader.skipped) == (1, 1)
+
+
+def test_named_upload_overwrites(bucket):
+    uploader = make_uploader(bucket)
+    # 指定名称的对象不禁止覆盖, 新内容替换旧内容
+    uploader.upload_image("page.png", Image.new('RGB', (10, 10), 'white'))
+    white = bucket.objects["pdf_ocr/page.png"]
+    uploader.upload_image("page.png", Image.new('RGB', (10, 10), 'black'))
+    assert uploader.uploaded == 2
+    assert bucket.objects["pdf_ocr/page.png"] != white
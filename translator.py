@@ -1,6 +1,12 @@
-import concurrent.futures
+import os
+import asyncio
 from dependencies.chat import *
 from dependencies.text_translater import *
+from dependencies.translation_memory import TranslationMemory
+from dependencies.translation_manifest import TranslationManifest
+from dependencies.ocr_journal import OrderedResultWriter
+from dependencies.metrics import metrics
+from dependencies.batch import BatchClient, BatchJobStore
 
 
 
@@ -24,55 +30,149 @@ POLISHING_PROMPT =      """担任翻译润色的角色, 通过对比翻译前后
                         """
 
 
-MAX_WORKERS = 4
+CHUNK_MIN_TOKENS = 2000        # 每个翻译片段的最小 token 数 (估计值)
+CHUNK_MAX_TOKENS = 3000        # 每个翻译片段的最大 token 数, 约等于原来的 12000 个英文字符
+
+TRANSLATION_WORKERS = 4        # 翻译模型的并发数
+POLISHING_WORKERS = 4          # 润色模型的并发数
 MAX_RETRIES = 8
+STREAM = True                  # 流式输出: 译文边生成边按顺序写入 FILE_SAVE, 连接中断时从已收到的部分续写
+
+TRANSLATION_MEMORY_PATH = "translation_memory.sqlite3"   # 段落级翻译记忆库, 重复段落不再调用模型; 设为 None 关闭
+INCREMENTAL = True                                       # 增量翻译: 只重新翻译原文有变化的片段, 其余片段沿用上次的译文
+MANIFEST_PATH = FILE_SAVE + ".manifest.json"             # 增量翻译使用的片段清单
+
+USE_ASYNC = False               # 使用 asyncio 客户端并发处理所有片段 (依赖 httpx, 见 requirements.txt)
+ASYNC_MAX_CONCURRENCY = 100     # 异步模式下同时处理的片段上限
+
+USE_BATCH = False               # 通过服务商的批处理接口 (/v1/batches) 提交全部片段, 价格更低但通常需要数小时, 不支持流式写入
+BATCH_JOB_STORE_PATH = "batch_jobs.sqlite3"     # 批处理任务状态, 中断后重新运行会继续等待已提交的任务
+
+METRICS_JSONL_PATH = None       # 每次运行的指标汇总追加到该 JSONL 文件, None 表示不导出
+METRICS_PROM_PATH = None        # Prometheus 文本格式的指标文件, None 表示不导出
+
+
+async def async_translate_and_polish(texts, translation_prompt, polishing_prompt, memory=None, on_result=None, on_delta=None):
+    """
+    异步翻译并润色所有片段, 结果顺序与输入一致, 失败的片段返回 None。
+    """
+    translator = AsyncTranslator(TRANSLATER_MODEL, POLISHING_MODEL, API_KEY, BASEURL, stream=STREAM, max_retries_translater=MAX_RETRIES,
+                                 max_concurrency=ASYNC_MAX_CONCURRENCY, memory=memory)
+    try:
+        results = await translator.translate(texts, translation_prompt=translation_prompt, polish=True,
+                                             polishing_prompt=polishing_prompt, return_exceptions=True,
+                                             on_result=on_result, on_delta=on_delta)
+    finally:
+        await translator.close()
+
+    for idx, result in enumerate(results):
+        if isinstance(result, Exception):
+            print(f"Chunk {idx} generated an exception: {result}")
+            results[idx] = None
+    return results
 
 
 if __name__ == "__main__":
+    # 指标从本次运行开始统计
+    metrics.reset()
     api_key = API_KEY
     baseurl = BASEURL
     translation_model =  TRANSLATER_MODEL   
     polishing_model =  POLISHING_MODEL
     
 
-    translator = Translator(translation_model, polishing_model, api_key, baseurl, max_retries_translater=MAX_RETRIES)
+    memory = TranslationMemory(TRANSLATION_MEMORY_PATH) if TRANSLATION_MEMORY_PATH else None
+    translator = Translator(translation_model, polishing_model, api_key, baseurl, stream=STREAM, max_retries_translater=MAX_RETRIES,
+                            pool_size=max(TRANSLATION_WORKERS, POLISHING_WORKERS), memory=memory)
     
-    # 分割需要翻译的文本
-    with open(FILE_TO_TRANSLATER, 'r', encoding='utf-8') as file:
-        content = file.read()  
-
-    texts = split_string(content, min_length=8000, max_length=12000, numbered_headings=True)   
-
     custom_translation_prompt = TRANSLATE_PROMPT
     custom_polishing_prompt = POLISHING_PROMPT
-    
-    # 定义一个函数，用于翻译和润色单个文本片段
-    def translate_and_polish(text, idx):
-        print(f"Processing chunk {idx}...")
-        return translator.translate(
-            [text], 
-            polish=True, 
-            translation_prompt=custom_translation_prompt, 
-            polishing_prompt=custom_polishing_prompt
-        )[0]  
-
-    # 使用多线程来并行处理翻译和润色
-    translated_and_polished = [None] * len(texts)  
-    with concurrent.futures.ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor: 
-  
-        future_to_idx = {executor.submit(translate_and_polish, texts[idx], idx): idx for idx in range(len(texts))}
-    
-        for future in concurrent.futures.as_completed(future_to_idx):
-            idx = future_to_idx[future]
-            try:
-                translated_and_polished[idx] = future.result()  # 将结果放入对应位置
-            except Exception as exc:
-                print(f"Chunk {idx} generated an exception: {exc}")
+
+    manifest = None
+    if INCREMENTAL:
+        manifest = TranslationManifest(MANIFEST_PATH, TranslationMemory.make_context(translation_model, polishing_model,
+                                                                                     custom_translation_prompt, custom_polishing_prompt))
+
+    if manifest is not None and manifest.load():
+        # 在上次各片段的起始标题处切分, 修改过的章节不会让后面的片段边界整体移动
+        with open(FILE_TO_TRANSLATER, 'r', encoding='utf-8') as f:
+            texts = split_with_anchors(f.read(), manifest.anchors(), min_length=CHUNK_MIN_TOKENS, max_length=CHUNK_MAX_TOKENS,
+                                       numbered_headings=True, length_function=estimate_text_tokens)
+    else:
+        # 分割需要翻译的文本 (逐行读取文件, 按估计的 token 数切分, 超长章节会在段落处继续切分)
+        texts = list(iter_split_file(FILE_TO_TRANSLATER, min_length=CHUNK_MIN_TOKENS, max_length=CHUNK_MAX_TOKENS,
+                                     numbered_headings=True, length_function=estimate_text_tokens))
+
+    translated_and_polished = [manifest.lookup(text) if manifest is not None else None for text in texts]
+    pending = [idx for idx, result in enumerate(translated_and_polished) if result is None]
+    print(f"{len(texts) - len(pending)} of {len(texts)} chunks unchanged, translating {len(pending)} chunks")
+    pending_texts = [texts[idx] for idx in pending]
+
+    # 结果按片段顺序写入文件: 未变化的片段立即写出, 其余片段完成 (或流式输出到达) 时写出
+    with open(FILE_SAVE, 'w', encoding='utf-8') as f:
+        writer = OrderedResultWriter(f)
+        for idx, result in enumerate(translated_and_polished):
+            if result is not None:
+                writer.add(idx, result)
+        on_result = lambda i, result: writer.add(pending[i], result)
+        on_delta = lambda i, text: writer.partial(pending[i], text)
+
+        if USE_BATCH:
+            batch_client = BatchClient(api_key, baseurl)
+            batch_job_store = BatchJobStore(BATCH_JOB_STORE_PATH)
+            pending_results, errors = translator.translate_via_batch(
+                pending_texts,
+                batch_client,
+                batch_job_store,
+                name=os.path.basename(FILE_TO_TRANSLATER),
+                polish=True,
+                translation_prompt=custom_translation_prompt,
+                polishing_prompt=custom_polishing_prompt,
+                poll_interval=60
+            )
+            batch_client.close()
+            batch_job_store.close()
+            for i, result in enumerate(pending_results):
+                on_result(i, result)
+            for idx, error in sorted(errors.items()):
+                print(f"Chunk {pending[idx]} failed in the batch job: {error}")
+        elif USE_ASYNC:
+            pending_results = asyncio.run(async_translate_and_polish(pending_texts, custom_translation_prompt, custom_polishing_prompt, memory,
+                                                                     on_result, on_delta))
+        else:
+            # 翻译和润色分两个阶段流水线执行, 每个片段翻译完成后立即开始润色
+            pending_results, errors = translator.translate_batch(
+                pending_texts,
+                polish=True,
+                translation_prompt=custom_translation_prompt,
+                polishing_prompt=custom_polishing_prompt,
+                translation_workers=TRANSLATION_WORKERS,
+                polishing_workers=POLISHING_WORKERS,
+                on_result=on_result,
+                on_delta=on_delta
+            )
+            for idx, exc in sorted(errors.items()):
+                print(f"Chunk {pending[idx]} generated an exception: {exc}")
+
+    for idx, result in zip(pending, pending_results):
+        translated_and_polished[idx] = result
+    metrics.count('chunks', len(pending))
+    metrics.count('chunks_unchanged', len(texts) - len(pending))
     
     # 打印结果
     # for idx, result in enumerate(translated_and_polished):
     #     print(f"Original: {texts[idx]}")
     #     print(f"Translated and Polished: {result}")
 
-    with open(FILE_SAVE, 'w', encoding='utf-8') as f:
-        f.writelines(f"{result}\n" for result in translated_and_polished)
+    if manifest is not None:
+        manifest.save(texts, translated_and_polished)
+
+    if memory is not None:
+        print(memory.summary())
+        memory.close()
+
+    metrics.report()
+    if METRICS_JSONL_PATH:
+        metrics.write_jsonl(METRICS_JSONL_PATH)
+    if METRICS_PROM_PATH:
+        metrics.write_prometheus(METRICS_PROM_PATH)